@@ -0,0 +1,298 @@
+"""On-disk cache of transcoded audio for the music bot.
+
+Tracks that keep getting played are transcoded once to Ogg/Opus in Discord's
+format (48 kHz stereo) and kept on disk, so later plays read a local file:
+no extraction, no HTTPS stream, and with no filters active the Opus packets
+are passed straight through.
+
+Play counts are kept for every track. Once a track reaches ``min_plays`` it
+is handed to the background downloader. Past the byte cap, files are evicted
+by a score that mixes recency and frequency: the time of the last play plus
+``play_weight`` seconds for every play, lowest first.
+
+Files are checked when written: ffmpeg must succeed, the result must be
+Ogg/Opus, and its length must match the track's. They are checked again at
+startup (size and SHA-256), and a file whose size has changed is dropped
+when it is looked up.
+
+The index lives in memory for lookups from the event loop and is mirrored to
+SQLite in the cache directory. Loading, downloading and flushing run on one
+background thread. Only the standard library is imported, so the cache can be
+inspected or pruned without loading the bot.
+"""
+import hashlib
+import os
+import sqlite3
+import struct
+import subprocess
+import threading
+import time
+
+INDEX_NAME = "index.db"
+FILE_SUFFIX = ".opus"
+PART_SUFFIX = ".part"
+OPUS_SAMPLE_RATE = 48000
+TAIL_BYTES = 65536
+
+
+def _sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def ogg_opus_duration(path):
+    """Length in seconds of an Ogg/Opus file, or None if it isn't one
+
+    Read from the OpusHead header and the granule position of the last page,
+    so only the two ends of the file are touched.
+    """
+    size = os.path.getsize(path)
+    with open(path, "rb") as f:
+        head = f.read(64)
+        f.seek(max(0, size - TAIL_BYTES))
+        tail = f.read()
+    if head[:4] != b"OggS" or head[28:36] != b"OpusHead":
+        return None
+    pre_skip = struct.unpack_from("<H", head, 38)[0]
+    last_page = tail.rfind(b"OggS")
+    if last_page < 0 or last_page + 14 > len(tail):
+        return None
+    granule = struct.unpack_from("<q", tail, last_page + 6)[0]
+    if granule <= pre_skip:
+        return None
+    return (granule - pre_skip) / OPUS_SAMPLE_RATE
+
+
+class AudioCache:
+    """Play counts and cached files for frequently played tracks"""
+
+    def __init__(self, directory, max_bytes, min_plays=3, play_weight=3600.0,
+                 max_duration=900, forget_after=7 * 86400):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.min_plays = min_plays
+        self.play_weight = play_weight
+        self.max_duration = max_duration
+        self.forget_after = forget_after
+        # key -> {"file", "size", "sha256", "plays", "last_played"}
+        self.entries = {}
+        self.pending = set()
+        self.dirty = set()
+        self.total_bytes = 0
+        self.lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "downloads": 0, "failures": 0,
+                      "evictions": 0, "corrupt": 0}
+        self._conn = None
+
+    def _connection(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(os.path.join(self.directory, INDEX_NAME))
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS entries (
+                    key TEXT PRIMARY KEY,
+                    file TEXT, size INTEGER, sha256 TEXT,
+                    plays INTEGER NOT NULL, last_played REAL NOT NULL)""")
+            self._conn.commit()
+        return self._conn
+
+    def _path(self, file):
+        return os.path.join(self.directory, file)
+
+    def load(self):
+        """Read the index and check every cached file; run on the cache thread"""
+        os.makedirs(self.directory, exist_ok=True)
+        rows = self._connection().execute(
+            "SELECT key, file, size, sha256, plays, last_played FROM entries").fetchall()
+        entries = {}
+        for key, file, size, sha256, plays, last_played in rows:
+            entry = {"file": file, "size": size, "sha256": sha256,
+                     "plays": plays, "last_played": last_played}
+            if file is not None:
+                path = self._path(file)
+                if (not os.path.exists(path) or os.path.getsize(path) != size
+                        or _sha256(path) != sha256):
+                    self.stats["corrupt"] += 1
+                    self._remove_file(file)
+                    entry.update(file=None, size=None, sha256=None)
+                    self.dirty.add(key)
+            entries[key] = entry
+
+        # Leftovers from interrupted downloads or lost index rows
+        known = {entry["file"] for entry in entries.values() if entry["file"]}
+        for name in os.listdir(self.directory):
+            if name.endswith((FILE_SUFFIX, PART_SUFFIX)) and name not in known:
+                self._remove_file(name)
+
+        with self.lock:
+            # Plays recorded while loading are added on top
+            for key, entry in self.entries.items():
+                if key in entries:
+                    entries[key]["plays"] += entry["plays"]
+                    entries[key]["last_played"] = entry["last_played"]
+                else:
+                    entries[key] = entry
+            self.entries = entries
+            self.total_bytes = sum(entry["size"] for entry in entries.values() if entry["file"])
+        self._evict()
+        self.flush()
+        return len(known)
+
+    def __contains__(self, key):
+        entry = self.entries.get(key)
+        return entry is not None and entry["file"] is not None
+
+    def path_for(self, key):
+        """Local file for a track, or None; called from the event loop"""
+        entry = self.entries.get(key)
+        if entry is None or entry["file"] is None:
+            self.stats["misses"] += 1
+            return None
+        path = self._path(entry["file"])
+        try:
+            intact = os.path.getsize(path) == entry["size"]
+        except OSError:
+            intact = False
+        if not intact:
+            self.stats["corrupt"] += 1
+            self._drop(key)
+            self.stats["misses"] += 1
+            return None
+        self.stats["hits"] += 1
+        return path
+
+    def record_play(self, key, duration):
+        """Count a play; True when the track should now be downloaded"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                entry = self.entries[key] = {"file": None, "size": None, "sha256": None,
+                                             "plays": 0, "last_played": 0.0}
+            entry["plays"] += 1
+            entry["last_played"] = time.time()
+            self.dirty.add(key)
+            if (entry["file"] is not None or key in self.pending
+                    or entry["plays"] < self.min_plays
+                    or not duration or duration > self.max_duration):
+                return False
+            self.pending.add(key)
+            return True
+
+    def abandon(self, key):
+        with self.lock:
+            self.pending.discard(key)
+
+    def download(self, key, url, ffmpeg_path, copy, duration, timeout=None):
+        """Transcode a track into the cache; run on the cache thread
+
+        Returns the file's size, or None if it failed a check.
+        """
+        file = hashlib.sha1(key.encode()).hexdigest() + FILE_SUFFIX
+        final_path = self._path(file)
+        part_path = final_path + PART_SUFFIX
+        codec = ["-c:a", "copy"] if copy else [
+            "-c:a", "libopus", "-b:a", "128k", "-ar", "48000", "-ac", "2"]
+        args = [ffmpeg_path, "-nostdin", "-loglevel", "error",
+                "-reconnect", "1", "-reconnect_streamed", "1", "-reconnect_delay_max", "5",
+                "-i", url, "-vn", "-map_metadata", "-1", *codec, "-f", "opus", "-y", part_path]
+        try:
+            result = subprocess.run(args, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL,
+                                    stderr=subprocess.PIPE, timeout=timeout or duration * 2 + 60)
+            length = ogg_opus_duration(part_path) if result.returncode == 0 else None
+            if length is None or abs(length - duration) > max(2.0, duration * 0.02):
+                self.stats["failures"] += 1
+                error = result.stderr.decode(errors="replace").strip()[-200:]
+                print(f"Audio cache rejected {key}: length {length} for {duration}s {error}")
+                self._remove_file(file + PART_SUFFIX)
+                return None
+            size = os.path.getsize(part_path)
+            sha256 = _sha256(part_path)
+            os.replace(part_path, final_path)
+        except (OSError, subprocess.SubprocessError) as e:
+            self.stats["failures"] += 1
+            print(f"Audio cache download failed for {key}: {e}")
+            self._remove_file(file + PART_SUFFIX)
+            return None
+        finally:
+            self.abandon(key)
+
+        with self.lock:
+            entry = self.entries.setdefault(key, {"file": None, "size": None, "sha256": None,
+                                                  "plays": 0, "last_played": time.time()})
+            if entry["file"] is not None:
+                self.total_bytes -= entry["size"]
+            entry.update(file=file, size=size, sha256=sha256)
+            self.total_bytes += size
+            self.dirty.add(key)
+        self.stats["downloads"] += 1
+        self._evict()
+        return size
+
+    def _score(self, entry):
+        return entry["last_played"] + entry["plays"] * self.play_weight
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes:
+            with self.lock:
+                cached = [(self._score(entry), key) for key, entry in self.entries.items()
+                          if entry["file"] is not None]
+            if not cached:
+                break
+            self._drop(min(cached)[1])
+            self.stats["evictions"] += 1
+
+    def _drop(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry["file"] is None:
+                return
+            file = entry["file"]
+            self.total_bytes -= entry["size"]
+            entry.update(file=None, size=None, sha256=None)
+            self.dirty.add(key)
+        self._remove_file(file)
+
+    def _remove_file(self, name):
+        try:
+            os.remove(self._path(name))
+        except FileNotFoundError:
+            pass
+
+    def flush(self):
+        """Write changed index rows; run on the cache thread"""
+        cutoff = time.time() - self.forget_after
+        with self.lock:
+            # Tracks that never got popular are forgotten after a while
+            for key, entry in list(self.entries.items()):
+                if entry["file"] is None and entry["last_played"] < cutoff \
+                        and key not in self.pending:
+                    del self.entries[key]
+                    self.dirty.add(key)
+            upserts, deletes = [], []
+            for key in self.dirty:
+                entry = self.entries.get(key)
+                if entry is None:
+                    deletes.append((key,))
+                else:
+                    upserts.append((key, entry["file"], entry["size"], entry["sha256"],
+                                    entry["plays"], entry["last_played"]))
+            self.dirty.clear()
+        conn = self._connection()
+        with conn:
+            conn.executemany(
+                "INSERT INTO entries (key, file, size, sha256, plays, last_played) "
+                "VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT(key) DO UPDATE SET "
+                "file=excluded.file, size=excluded.size, sha256=excluded.sha256, "
+                "plays=excluded.plays, last_played=excluded.last_played", upserts)
+            conn.executemany("DELETE FROM entries WHERE key = ?", deletes)
+        return len(upserts) + len(deletes)
+
+    def get_stats(self):
+        with self.lock:
+            cached = sum(1 for entry in self.entries.values() if entry["file"] is not None)
+            tracked = len(self.entries)
+        return dict(self.stats, files=cached, tracked=tracked, bytes=self.total_bytes,
+                    max_bytes=self.max_bytes, pending=len(self.pending))
@@ -0,0 +1,374 @@
+"""Out-of-process audio pipelines for the music bot.
+
+Each worker process runs many guilds' media pipelines: it owns their ffmpeg
+processes, reads the Opus packets, paces them at 20 ms and sends them as
+encrypted RTP straight to Discord's voice server on the guild's voice UDP
+socket, which the bot passes over. The bot keeps the gateway and voice
+websockets and drives the worker with control messages; the worker reports
+playback events back. Only the standard library and PyNaCl are imported here,
+so starting a worker doesn't load the bot.
+
+Started by main.py as ``python audio_worker.py <fd>``, where fd is this
+process's end of a socketpair used as a multiprocessing Connection.
+"""
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+from collections import deque
+from multiprocessing.connection import Connection
+from multiprocessing.reduction import recv_handle
+
+import nacl.bindings
+import nacl.secret
+import nacl.utils
+
+FRAME_LENGTH = 0.02
+SAMPLES_PER_FRAME = 960
+PREBUFFER_FRAMES = 50
+POSITION_REPORT_FRAMES = 50
+PREPARE_WAIT = 5.0
+SILENCE_FRAME = b"\xf8\xff\xfe"
+
+SUPPORTED_MODES = (
+    "aead_xchacha20_poly1305_rtpsize",
+    "xsalsa20_poly1305_lite",
+    "xsalsa20_poly1305_suffix",
+    "xsalsa20_poly1305",
+)
+
+
+def iter_ogg_packets(stream):
+    """Yield the Opus packets in an Ogg stream, skipping the header packets"""
+    partial = b""
+    while True:
+        header = stream.read(27)
+        if len(header) < 27 or header[:4] != b"OggS":
+            return
+        segment_count = header[26]
+        segments = stream.read(segment_count)
+        body = stream.read(sum(segments))
+        offset = 0
+        for size in segments:
+            partial += body[offset:offset + size]
+            offset += size
+            if size < 255:
+                if partial and not partial.startswith((b"OpusHead", b"OpusTags")):
+                    yield partial
+                partial = b""
+
+
+class VoiceTarget:
+    """Builds and sends encrypted RTP packets for one voice connection"""
+
+    def __init__(self, sock, addr, ssrc, key, mode):
+        self.sock = sock
+        self.addr = tuple(addr)
+        self.ssrc = ssrc
+        self.key = bytes(key)
+        self.mode = mode
+        self.box = nacl.secret.SecretBox(self.key)
+        self.sequence = 0
+        self.timestamp = 0
+        self.nonce = 0
+
+    def _encrypt(self, header, data):
+        if self.mode == "aead_xchacha20_poly1305_rtpsize":
+            nonce = struct.pack(">I", self.nonce) + bytes(20)
+            self.nonce = (self.nonce + 1) & 0xFFFFFFFF
+            return header + nacl.bindings.crypto_aead_xchacha20poly1305_ietf_encrypt(
+                data, header, nonce, self.key) + nonce[:4]
+        if self.mode == "xsalsa20_poly1305_lite":
+            nonce = struct.pack(">I", self.nonce) + bytes(20)
+            self.nonce = (self.nonce + 1) & 0xFFFFFFFF
+            return header + self.box.encrypt(data, nonce).ciphertext + nonce[:4]
+        if self.mode == "xsalsa20_poly1305_suffix":
+            nonce = nacl.utils.random(nacl.secret.SecretBox.NONCE_SIZE)
+            return header + self.box.encrypt(data, nonce).ciphertext + nonce
+        nonce = header + bytes(12)
+        return header + self.box.encrypt(data, nonce).ciphertext
+
+    def send(self, opus):
+        header = struct.pack(">BBHII", 0x80, 0x78, self.sequence, self.timestamp, self.ssrc)
+        self.sequence = (self.sequence + 1) & 0xFFFF
+        self.timestamp = (self.timestamp + SAMPLES_PER_FRAME) & 0xFFFFFFFF
+        try:
+            self.sock.sendto(self._encrypt(header, opus), self.addr)
+        except OSError:
+            # Same as discord.py: a dropped packet isn't worth stopping for
+            pass
+
+    def close(self):
+        self.sock.close()
+
+
+class Stream:
+    """One ffmpeg process producing Opus packets, with a read-ahead buffer"""
+
+    def __init__(self, ref, args, offset=0.0, speed=1.0):
+        self.ref = ref
+        self.args = args
+        self.start_offset = offset
+        self.speed = speed
+        self.frames_played = 0
+        self.buffer = deque()
+        if offset:
+            args = [args[0], "-ss", f"{offset:.2f}", *args[1:]]
+        self.process = subprocess.Popen(args, stdin=subprocess.DEVNULL,
+                                        stdout=subprocess.PIPE)
+        self.packets = iter_ogg_packets(self.process.stdout)
+
+    @property
+    def position(self):
+        return self.start_offset + self.frames_played * FRAME_LENGTH * self.speed
+
+    def prebuffer(self, frames=PREBUFFER_FRAMES):
+        while len(self.buffer) < frames:
+            packet = next(self.packets, b"")
+            if not packet:
+                break
+            self.buffer.append(packet)
+
+    def read(self):
+        packet = self.buffer.popleft() if self.buffer else next(self.packets, b"")
+        if packet:
+            self.frames_played += 1
+        return packet
+
+    def advance_to(self, position):
+        while self.position < position:
+            if not self.read():
+                break
+
+    def close(self):
+        if self.process.poll() is None:
+            self.process.kill()
+        self.process.wait()
+        self.process.stdout.close()
+
+
+class GuildPipeline:
+    """Plays one guild's tracks: a pacing thread per track, like AudioPlayer"""
+
+    def __init__(self, guild, emit):
+        self.guild = guild
+        self.emit = emit
+        self.voice = None
+        self.stream = None
+        self.prepared = None
+        self.lock = threading.Lock()
+        # Held while a prepared stream is built, so play can wait for it
+        self.prepare_lock = threading.Lock()
+        self.prepare_id = 0
+        self.stopped = threading.Event()
+        self.report_on_stop = True
+        self.thread = None
+        self.play_id = None
+
+    def _take_prepared(self):
+        waited = self.prepare_lock.acquire(timeout=PREPARE_WAIT)
+        try:
+            with self.lock:
+                # A prepare still building or not yet started is now stale
+                self.prepare_id += 1
+                prepared, self.prepared = self.prepared, None
+        finally:
+            if waited:
+                self.prepare_lock.release()
+        return prepared
+
+    def play(self, message):
+        self.stop(report=False)
+        prepared = self._take_prepared()
+        if (prepared is not None and not message["offset"]
+                and (prepared.ref, prepared.args) == (message["ref"], message["args"])):
+            stream = prepared
+        else:
+            if prepared is not None:
+                prepared.close()
+            stream = Stream(message["ref"], message["args"], message["offset"], message["speed"])
+        self.voice.sequence = message["sequence"]
+        self.voice.timestamp = message["timestamp"]
+        self.voice.nonce = message["nonce"]
+        with self.lock:
+            self.stream = stream
+        self.stopped = threading.Event()
+        self.report_on_stop = True
+        self.play_id = message["id"]
+        self.thread = threading.Thread(target=self._run, args=(self.stopped, self.play_id),
+                                       name=f"audio-{self.guild}", daemon=True)
+        self.thread.start()
+
+    def claim_prepare(self, message):
+        """Number a prepare before its thread starts; a later play supersedes it"""
+        with self.lock:
+            self.prepare_id += 1
+            message["prepare_id"] = self.prepare_id
+
+    def prepare(self, message):
+        with self.prepare_lock:
+            if message["prepare_id"] != self.prepare_id:
+                return
+            stream = Stream(message["ref"], message["args"], 0.0, message["speed"])
+            stream.prebuffer()
+            with self.lock:
+                if message["prepare_id"] == self.prepare_id:
+                    stream, self.prepared = self.prepared, stream
+        if stream is not None:
+            stream.close()
+
+    def respawn(self, message):
+        """Restart the current track with new settings, swapping in seamlessly"""
+        current = self.stream
+        if current is None:
+            return
+        new = Stream(current.ref, message["args"], current.position, message["speed"])
+        new.prebuffer()
+        new.advance_to(current.position)
+        with self.lock:
+            if self.stream is not current:
+                new.close()
+                return
+            self.stream = new
+        current.close()
+
+    def stop(self, report=True):
+        thread = self.thread
+        if thread is None:
+            return
+        self.report_on_stop = report
+        self.stopped.set()
+        # Killing ffmpeg unblocks a read that is waiting on the network
+        stream = self.stream
+        if stream is not None and stream.process.poll() is None:
+            stream.process.kill()
+        thread.join()
+        self.thread = None
+
+    def _run(self, stopped, play_id):
+        error = None
+        position = 0.0
+        loops = 0
+        start = time.perf_counter()
+        try:
+            while not stopped.is_set():
+                with self.lock:
+                    stream = self.stream
+                packet = stream.read()
+                if not packet:
+                    break
+                self.voice.send(packet)
+                loops += 1
+                if loops == 1:
+                    self.emit({"event": "started", "guild": self.guild, "id": play_id})
+                elif loops % POSITION_REPORT_FRAMES == 0:
+                    self.emit({"event": "position", "guild": self.guild, "id": play_id,
+                               "position": stream.position})
+                delay = start + FRAME_LENGTH * loops - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            for _ in range(5):
+                self.voice.send(SILENCE_FRAME)
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+        finally:
+            with self.lock:
+                current = self.stream
+                self.stream = None
+            if current is not None:
+                position = current.position
+                current.close()
+        if not stopped.is_set() or self.report_on_stop:
+            self.emit({
+                "event": "finished",
+                "guild": self.guild,
+                "id": play_id,
+                "error": error,
+                "position": position,
+                "sequence": self.voice.sequence,
+                "timestamp": self.voice.timestamp,
+                "nonce": self.voice.nonce
+            })
+
+    def release(self):
+        self.stop(report=False)
+        prepared = self._take_prepared()
+        if prepared is not None:
+            prepared.close()
+        if self.voice is not None:
+            self.voice.close()
+            self.voice = None
+
+
+def worker_main(fd):
+    conn = Connection(fd)
+    send_lock = threading.Lock()
+    pipelines = {}
+
+    def emit(event):
+        with send_lock:
+            conn.send(event)
+
+    def pipeline_for(guild):
+        if guild not in pipelines:
+            pipelines[guild] = GuildPipeline(guild, emit)
+        return pipelines[guild]
+
+    def run_async(func, message):
+        # prepare/respawn buffer audio; don't hold up other guilds' commands
+        def target():
+            try:
+                func(message)
+            except Exception as e:
+                print(f"Audio worker {message['op']} failed for {message['guild']}: {e}",
+                      file=sys.stderr)
+        threading.Thread(target=target, daemon=True).start()
+
+    while True:
+        try:
+            message = conn.recv()
+        except EOFError:
+            break
+        op = message["op"]
+        pipeline = pipeline_for(message["guild"])
+        try:
+            if op == "voice":
+                fd = recv_handle(conn)
+                voice = VoiceTarget(socket.socket(fileno=fd), message["addr"],
+                                    message["ssrc"], message["key"], message["mode"])
+                old = pipeline.voice
+                if old is not None:
+                    # A reconnect mid-track keeps the RTP numbering going
+                    voice.sequence, voice.timestamp, voice.nonce = (
+                        old.sequence, old.timestamp, old.nonce)
+                pipeline.voice = voice
+                if old is not None:
+                    old.close()
+            elif op == "play":
+                pipeline.play(message)
+            elif op == "prepare":
+                pipeline.claim_prepare(message)
+                run_async(pipeline.prepare, message)
+            elif op == "respawn":
+                run_async(pipeline.respawn, message)
+            elif op == "stop":
+                pipeline.stop()
+            elif op == "release":
+                pipeline.release()
+                del pipelines[message["guild"]]
+        except Exception as e:
+            print(f"Audio worker {op} failed for {message['guild']}: {e}", file=sys.stderr)
+            if op == "play":
+                emit({"event": "finished", "guild": message["guild"], "id": message["id"],
+                      "error": f"{type(e).__name__}: {e}", "position": message["offset"],
+                      "sequence": message["sequence"], "timestamp": message["timestamp"],
+                      "nonce": message["nonce"]})
+
+    for pipeline in pipelines.values():
+        pipeline.release()
+
+
+if __name__ == "__main__":
+    worker_main(int(sys.argv[1]))
@@ -0,0 +1,110 @@
+"""Compare the deque-based queue with TrackQueue at radio-station sizes.
+
+Old path: a deque of tracks. Total duration walks every entry, indexed access
+and positional changes are O(n), and /skipto copies the queue into a list and
+back.
+New path: TrackQueue, an implicit treap that keeps count and total duration up
+to date and does positional operations in O(log n).
+
+Reports microseconds per operation at each queue size.
+
+    python bench_queue.py [size ...]
+"""
+import random
+import sys
+import time
+from collections import deque
+
+from track_queue import TrackQueue
+
+REPEAT = 200
+SKIP = 10
+
+
+class Track:
+    __slots__ = ("ref", "title", "duration")
+
+    def __init__(self, ref, title, duration):
+        self.ref = ref
+        self.title = title
+        self.duration = duration
+
+
+def make_tracks(size):
+    return [Track(f"youtube:{i:011d}", f"Track {i}", random.randint(60, 600))
+            for i in range(size)]
+
+
+def timed(func, repeat=REPEAT):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat * 1e6
+
+
+def deque_ops(tracks):
+    queue = deque(tracks)
+    size = len(queue)
+    middle = size // 2
+
+    def skip_to():
+        # What /skipto did: copy out, slice, copy back (then refill to size)
+        nonlocal queue
+        queue_list = list(queue)
+        queue = deque(queue_list[SKIP:])
+        queue.extend(tracks[:SKIP])
+
+    def move():
+        track = queue[middle]
+        del queue[middle]
+        queue.insert(size // 4, track)
+
+    return {
+        "total duration": lambda: sum(track.duration or 0 for track in queue),
+        "get middle": lambda: queue[middle],
+        "insert middle": lambda: (queue.insert(middle, tracks[0]), queue.pop()),
+        "remove middle": lambda: (queue.rotate(-middle), queue.popleft(),
+                                  queue.rotate(middle), queue.append(tracks[0])),
+        "move": move,
+        "page of 10": lambda: list(queue)[middle:middle + 10],
+        "skipto": skip_to,
+    }
+
+
+def track_queue_ops(tracks):
+    queue = TrackQueue(tracks)
+    size = len(queue)
+    middle = size // 2
+
+    def skip_to():
+        queue.drop_front(SKIP)
+        queue.extend(tracks[:SKIP])
+
+    return {
+        "total duration": lambda: queue.total_duration,
+        "get middle": lambda: queue[middle],
+        "insert middle": lambda: (queue.insert(middle, tracks[0]), queue.pop()),
+        "remove middle": lambda: (queue.pop(middle), queue.append(tracks[0])),
+        "move": lambda: queue.move(middle, size // 4),
+        "page of 10": lambda: queue.slice(middle, middle + 10),
+        "skipto": skip_to,
+    }
+
+
+def main():
+    sizes = [int(arg) for arg in sys.argv[1:]] or [10_000, 100_000]
+    for size in sizes:
+        tracks = make_tracks(size)
+        start = time.perf_counter()
+        TrackQueue(tracks)
+        build = (time.perf_counter() - start) * 1e3
+        print(f"\n{size} tracks (TrackQueue build {build:.1f} ms)")
+        print(f"{'operation':16} {'deque us/op':>14} {'TrackQueue us/op':>18}")
+        old = deque_ops(tracks)
+        new = track_queue_ops(tracks)
+        for name in old:
+            print(f"{name:16} {timed(old[name]):14.1f} {timed(new[name]):18.1f}")
+
+
+if __name__ == "__main__":
+    main()
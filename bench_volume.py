@@ -0,0 +1,68 @@
+"""Compare the voice-thread cost of the old and new gain paths.
+
+Old path: ffmpeg decodes to PCM, PCMVolumeTransformer scales each frame in
+Python and libopus encodes it in-process.
+New path: ffmpeg applies the gain in its filter graph and encodes Opus, so the
+voice thread only forwards packets.
+
+Reports frames per second per core (frames / CPU seconds spent by the reading
+thread). Needs ffmpeg on PATH and libopus loadable by discord.py.
+
+    python bench_volume.py [seconds_of_audio]
+"""
+import sys
+import time
+
+import discord
+from discord.opus import Encoder
+
+SINE = "sine=frequency=440:sample_rate=48000"
+VOLUME = 0.5
+
+
+def run(source, per_frame=None):
+    frames = 0
+    start = time.thread_time()
+    try:
+        while True:
+            data = source.read()
+            if not data:
+                break
+            if per_frame:
+                per_frame(data)
+            frames += 1
+    finally:
+        source.cleanup()
+    return frames, time.thread_time() - start
+
+
+def old_path(seconds):
+    if not discord.opus.is_loaded():
+        discord.opus._load_default()
+    encoder = Encoder()
+    source = discord.FFmpegPCMAudio(f"{SINE}:duration={seconds}",
+                                    before_options="-f lavfi",
+                                    options="-vn")
+    source = discord.PCMVolumeTransformer(source, volume=VOLUME)
+    return run(source, lambda pcm: encoder.encode(pcm, encoder.SAMPLES_PER_FRAME))
+
+
+def new_path(seconds):
+    source = discord.FFmpegOpusAudio(f"{SINE}:duration={seconds}",
+                                     before_options="-f lavfi",
+                                     options=f"-vn -af volume={VOLUME:.2f}")
+    return run(source)
+
+
+def main():
+    seconds = int(sys.argv[1]) if len(sys.argv) > 1 else 60
+    for name, path in (("PCM + PCMVolumeTransformer", old_path),
+                       ("ffmpeg gain + Opus", new_path)):
+        frames, cpu = path(seconds)
+        rate = frames / cpu if cpu else float("inf")
+        print(f"{name:28} {frames:6d} frames  {cpu:7.3f}s CPU  "
+              f"{rate:12.0f} frames/s/core")
+
+
+if __name__ == "__main__":
+    main()
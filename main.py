@@ -1,50 +1,372 @@
 import os
+import sys
+import signal
 import discord
 from discord.ext import commands
 from discord import app_commands
 from dotenv import load_dotenv
 import yt_dlp
-from collections import deque
+from collections import deque, OrderedDict
 import asyncio
 import random
 import time
 import json
 import re
+import threading
+import functools
+import io
+import itertools
+import sqlite3
+import shutil
+import shlex
+import socket
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.connection import Connection
+from multiprocessing.reduction import send_handle
+from urllib.parse import urlparse, parse_qs
 from typing import Optional, List, Dict, Any
+from audio_worker import SUPPORTED_MODES as AUDIO_WORKER_MODES
+from track_queue import TrackQueue
+from audio_cache import AudioCache
+import metrics
+import playlist_store
+import rating_store
+
+load_dotenv()
+TOKEN = os.getenv("TOKEN")
+
+# Cluster mode: the supervisor (see run_cluster) starts one worker process per
+# group of shards and tells it which shards it owns through the environment.
+SHARD_IDS = [int(shard) for shard in os.getenv("SHARD_IDS", "").split(",") if shard]
+SHARD_COUNT = int(os.getenv("SHARD_COUNT", "0")) or None
+CLUSTER_ID = int(os.getenv("CLUSTER_ID", "0"))
+CLUSTER_WORKERS = int(os.getenv("CLUSTER_WORKERS", "1"))
+if SHARD_IDS and not SHARD_COUNT:
+    sys.exit("SHARD_IDS needs SHARD_COUNT to be set as well")
+if SHARD_COUNT and not all(0 <= shard < SHARD_COUNT for shard in SHARD_IDS):
+    sys.exit(f"SHARD_IDS must be between 0 and SHARD_COUNT - 1 ({SHARD_COUNT - 1})")
+
+CLUSTER_MAX_BACKOFF = 60
+CLUSTER_STABLE_AFTER = 300
+
+
+def fetch_recommended_shards():
+    import urllib.request
+    request = urllib.request.Request(
+        "https://discord.com/api/v10/gateway/bot",
+        headers={"Authorization": f"Bot {TOKEN}", "User-Agent": "DiscordBot"})
+    with urllib.request.urlopen(request, timeout=15) as response:
+        return json.load(response)["shards"]
+
+
+def run_cluster(worker_count):
+    """Supervise worker processes that each own a disjoint set of shards"""
+    shard_count = SHARD_COUNT or max(fetch_recommended_shards(), worker_count)
+    assignments = [list(range(shard_count))[i::worker_count] for i in range(worker_count)]
+    print(f"Starting {worker_count} workers for {shard_count} shards")
+
+    workers = {}  # cluster id -> {"process", "started_at", "backoff"}
+
+    def start_worker(cluster_id):
+        env = dict(os.environ,
+                   CLUSTER_ID=str(cluster_id),
+                   SHARD_IDS=",".join(map(str, assignments[cluster_id])),
+                   SHARD_COUNT=str(shard_count))
+        process = subprocess.Popen([sys.executable, os.path.abspath(__file__)], env=env)
+        backoff = workers.get(cluster_id, {}).get("backoff", 1)
+        workers[cluster_id] = {"process": process, "started_at": time.monotonic(),
+                               "backoff": backoff, "restart_at": None}
+        print(f"Worker {cluster_id} (pid {process.pid}) owns shards {assignments[cluster_id]}")
+
+    def stop_all(signum, frame):
+        for worker in workers.values():
+            if worker["process"].poll() is None:
+                worker["process"].terminate()
+        for worker in workers.values():
+            try:
+                worker["process"].wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                worker["process"].kill()
+        sys.exit(0)
+
+    signal.signal(signal.SIGTERM, stop_all)
+    signal.signal(signal.SIGINT, stop_all)
+
+    for cluster_id in range(worker_count):
+        start_worker(cluster_id)
+
+    while True:
+        time.sleep(1)
+        now = time.monotonic()
+        for cluster_id, worker in workers.items():
+            if worker["restart_at"] is not None:
+                if now >= worker["restart_at"]:
+                    start_worker(cluster_id)
+                continue
+            code = worker["process"].poll()
+            if code is None:
+                continue
+            if now - worker["started_at"] > CLUSTER_STABLE_AFTER:
+                worker["backoff"] = 1
+            print(f"Worker {cluster_id} exited with {code}; restarting in {worker['backoff']}s")
+            worker["restart_at"] = now + worker["backoff"]
+            worker["backoff"] = min(worker["backoff"] * 2, CLUSTER_MAX_BACKOFF)
+
+
+# The supervisor only starts and watches workers, so it stops here rather
+# than building a bot, probing ffmpeg and opening caches it would never use
+if __name__ == "__main__" and CLUSTER_WORKERS > 1 and not SHARD_IDS:
+    run_cluster(CLUSTER_WORKERS)
+
 
 # Create bot instance
 intents = discord.Intents.default()
 intents.message_content = True
-bot = commands.Bot(command_prefix='!', intents=intents)
-
-node_ffmpeg = os.path.join(os.getcwd(), 'node_modules', 'ffmpeg-static', 'ffmpeg')
-
-os.environ["FFMPEG_BINARY"] = node_ffmpeg
+if SHARD_IDS:
+    bot = commands.AutoShardedBot(command_prefix='!', intents=intents,
+                                  shard_ids=SHARD_IDS, shard_count=SHARD_COUNT)
+else:
+    bot = commands.Bot(command_prefix='!', intents=intents)
+
+
+def owns_guild(guild_id):
+    """Whether this process's shards include the given guild"""
+    if not SHARD_IDS:
+        return True
+    return (int(guild_id) >> 22) % SHARD_COUNT in SHARD_IDS
+
+
+def _run_ffmpeg(path, *args):
+    result = subprocess.run([path, "-hide_banner", *args],
+                            capture_output=True, text=True, timeout=15)
+    return result.stdout
+
+
+def _parse_ffmpeg_table(output):
+    """Names from `ffmpeg -filters` / `-encoders` style listings"""
+    names = set()
+    for line in output.splitlines():
+        parts = line.split()
+        # Rows look like " T.. name  A->A  Description" or " A..... libopus  Desc";
+        # legend rows have "=" in second place
+        if len(parts) >= 2 and parts[1] != "=":
+            names.add(parts[1])
+    return names
+
+
+def probe_ffmpeg():
+    """Locate ffmpeg once at startup and record what it can do"""
+    candidates = [
+        os.getenv("FFMPEG_BINARY"),
+        os.path.join(os.getcwd(), 'node_modules', 'ffmpeg-static', 'ffmpeg'),
+        shutil.which("ffmpeg")
+    ]
+    for path in candidates:
+        if not path or not os.path.isfile(path) or not os.access(path, os.X_OK):
+            continue
+        try:
+            version = _run_ffmpeg(path, "-version").splitlines()[0]
+            return {
+                "available": True,
+                "path": path,
+                "version": version,
+                "filters": _parse_ffmpeg_table(_run_ffmpeg(path, "-filters")),
+                "encoders": _parse_ffmpeg_table(_run_ffmpeg(path, "-encoders"))
+            }
+        except (OSError, IndexError, subprocess.SubprocessError) as e:
+            print(f"Skipping ffmpeg at {path}: {e}")
+
+    return {"available": False, "path": "ffmpeg", "version": None,
+            "filters": set(), "encoders": set()}
+
+
+FFMPEG_INFO = probe_ffmpeg()
+if FFMPEG_INFO["available"]:
+    print(f"Using ffmpeg at: {FFMPEG_INFO['path']} ({FFMPEG_INFO['version']})")
+    print(f"libopus encoder: {'yes' if 'libopus' in FFMPEG_INFO['encoders'] else 'no'}")
+else:
+    print("FFmpeg was not found; playback will be unavailable")
+
+# Persisted per-guild settings; per-user ones are read from the data store
+# (see USER_NAMESPACES) and runtime state lives in GuildSession below
+VOICE_CHANNEL_LOCKS = {}
+SESSION_SNAPSHOTS = {}
+QUEUE_SNAPSHOTS = {}
+
+
+class Track:
+    """A queued track: a lightweight reference, resolved to a stream just in time"""
+
+    __slots__ = ("ref", "title", "duration")
+
+    def __init__(self, ref, title, duration):
+        self.ref = ref
+        self.title = title
+        self.duration = duration
+
+    @classmethod
+    def from_list(cls, entry):
+        return cls(*entry)
+
+    def to_list(self):
+        return [self.ref, self.title, self.duration]
+
+    def memory_size(self):
+        return sys.getsizeof(self) + sys.getsizeof(self.ref) + sys.getsizeof(self.title)
+
+
+# Unity gain by default, so Opus streams can be passed straight through.
+# DEFAULT_VOLUME=0.5 restores the old quieter default, but every track is then
+# decoded and re-encoded to apply it.
+DEFAULT_VOLUME = min(max(float(os.getenv("DEFAULT_VOLUME", "1.0")), 0.01), 1.0)
+
+
+# Bumped whenever any session's queue or current track is replaced, so caches
+# keyed on it never confuse a new object with one that had the same id()
+SESSION_GENERATIONS = itertools.count(1)
+
+
+class GuildSession:
+    """Runtime state for one guild, created on first use and evicted when idle"""
+
+    __slots__ = ("guild_id", "_queue", "history", "history_bytes", "_current", "generation",
+                 "current_url", "started_at", "volume", "filters", "nightcore", "balance",
+                 "visualizer", "game", "text_channel_id", "resume_offset", "prefetch_task",
+                 "prewarmed",
+                 "transition_task", "track_ended_at", "respawn_task",
+                 "queue_fingerprint", "import_cancel", "resolve_limit", "play_requested_at",
+                 "last_active")
+
+    def __init__(self, guild_id):
+        self.guild_id = guild_id
+        self.generation = 0
+        self.queue = TrackQueue()
+        self.history = deque(maxlen=50)
+        self.history_bytes = 0
+        self.current = None  # Track
+        self.current_url = None
+        self.started_at = 0.0
+        self.volume = DEFAULT_VOLUME
+        self.filters = []
+        self.nightcore = False
+        self.balance = None
+        self.visualizer = False
+        self.game = None
+        self.text_channel_id = None
+        self.resume_offset = 0
+        self.prefetch_task = None
+        self.prewarmed = None  # {"ref", "source", "pipeline", "created_at"}
+        self.transition_task = None
+        self.track_ended_at = None
+        self.respawn_task = None
+        self.queue_fingerprint = None
+        self.import_cancel = None  # threading.Event of a running playlist import
+        self.resolve_limit = None  # asyncio.Semaphore for saved-playlist lookups
+        self.play_requested_at = None  # perf_counter of a /play waiting for audio
+        self.last_active = time.monotonic()
+
+    @property
+    def queue(self):
+        return self._queue
+
+    @queue.setter
+    def queue(self, queue):
+        self._queue = queue
+        self.generation = next(SESSION_GENERATIONS)
+
+    @property
+    def current(self):
+        return self._current
+
+    @current.setter
+    def current(self, track):
+        self._current = track
+        self.generation = next(SESSION_GENERATIONS)
+
+    def add_history(self, track):
+        if len(self.history) == self.history.maxlen:
+            self.history_bytes -= self.history[0].memory_size()
+        self.history.append(track)
+        self.history_bytes += track.memory_size()
+
+    def memory_size(self):
+        """Approximate bytes held by this session, queued tracks included
+
+        The queue and history keep running totals, so this doesn't grow with
+        their length.
+        """
+        size = sys.getsizeof(self)
+        for name in self.__slots__:
+            if name != "_queue":
+                size += sys.getsizeof(getattr(self, name))
+        return size + self.queue.memory_size() + self.history_bytes
+
+    def close(self):
+        if self.import_cancel is not None:
+            self.import_cancel.set()
+        for task in (self.prefetch_task, self.transition_task, self.respawn_task):
+            if task is not None and not task.done():
+                task.cancel()
+        if self.prewarmed is not None:
+            self.prewarmed["source"].cleanup()
+            self.prewarmed = None
+
+
+SESSIONS = {}  # guild id (int) -> GuildSession
+SESSION_IDLE_TIMEOUT = int(os.getenv("SESSION_IDLE_TIMEOUT", "1800"))
+SESSION_EVICT_TASK = None
+
+
+def get_session(guild_id):
+    """The guild's session, created on first use"""
+    guild_id = int(guild_id)
+    session = SESSIONS.get(guild_id)
+    if session is None:
+        session = SESSIONS[guild_id] = GuildSession(guild_id)
+    session.last_active = time.monotonic()
+    return session
+
+
+def find_session(guild_id):
+    """The guild's session if it has one; never creates one"""
+    return SESSIONS.get(int(guild_id))
+
+
+def evict_idle_sessions():
+    """Drop sessions of guilds that aren't connected and haven't been used lately"""
+    cutoff = time.monotonic() - SESSION_IDLE_TIMEOUT
+    evicted = 0
+    for guild_id, session in list(SESSIONS.items()):
+        if session.last_active > cutoff or session.current is not None:
+            continue
+        guild = bot.get_guild(guild_id)
+        if guild is not None and guild.voice_client is not None:
+            continue
+        session.close()
+        del SESSIONS[guild_id]
+        evicted += 1
+    return evicted
+
+
+def get_session_stats():
+    sizes = {guild_id: session.memory_size() for guild_id, session in SESSIONS.items()}
+    largest = max(sizes.items(), key=lambda item: item[1], default=(None, 0))
+    return {
+        "sessions": len(sizes),
+        "bytes": sum(sizes.values()),
+        "largest_guild": largest[0],
+        "largest_bytes": largest[1]
+    }
 
-print(f"Using ffmpeg at: {node_ffmpeg}")
-print(f"File exists: {os.path.exists(node_ffmpeg)}")
 
-load_dotenv()
-TOKEN = os.getenv("TOKEN")
+async def session_eviction_loop():
+    while True:
+        await asyncio.sleep(300)
+        evicted = evict_idle_sessions()
+        if evicted:
+            print(f"Evicted {evicted} idle sessions ({get_session_stats()})")
 
-# Global variables with optimized initialization
-SONG_QUEUES = {}
-VOLUME_LEVELS = {}
-SONG_HISTORY = {}
-SONG_RATINGS = {}
-CUSTOM_PLAYLISTS = {}
-CURRENT_TRACKS = {}
-VOICE_CHANNEL_LOCKS = {}
-AUTO_JOIN_CHANNELS = {}
-FILTERS = {}
-SONG_TIMESTAMPS = {}
-NIGHTCORE_ENABLED = {}
-EQUALIZER_SETTINGS = {}
-AUDIO_BALANCE = {}
-LANGUAGE_PREFERENCES = {}
-ACTIVE_GAME_SESSIONS = {}
-SONG_CACHE = {}
-VISUALIZER_ACTIVE = {}
 
 SUPPORTED_LANGUAGES = {
     "en": "English",
@@ -60,25 +382,60 @@ SUPPORTED_LANGUAGES = {
     "nl": "Dutch"
 }
 
+# Each filter is (stage, value). The filter-graph compiler groups effects by
+# stage, merges speed changes into a single asetrate, and adds the shared
+# resample stage once instead of once per filter.
 AVAILABLE_FILTERS = {
-    "bassboost":
-    "aresample=48000,aformat=sample_fmts=s16:channel_layouts=stereo,bass=g=10",
-    "nightcore":
-    "aresample=48000,asetrate=48000*1.25,aformat=sample_fmts=s16:channel_layouts=stereo",
-    "8d": "apulsator=hz=0.09",
-    "vaporwave":
-    "aresample=48000,asetrate=48000*0.8,aformat=sample_fmts=s16:channel_layouts=stereo",
-    "tremolo": "tremolo=f=6.0:d=0.8",
-    "vibrato": "vibrato=f=6.5:d=0.5",
-    "reverse": "areverse",
-    "normalizer": "dynaudnorm=f=200",
-    "echo": "aecho=0.8:0.88:60:0.4"
+    "bassboost": ("eq", "bass=g=10"),
+    "nightcore": ("speed", 1.25),
+    "8d": ("modulation", "apulsator=hz=0.09"),
+    "vaporwave": ("speed", 0.8),
+    "tremolo": ("modulation", "tremolo=f=6.0:d=0.8"),
+    "vibrato": ("modulation", "vibrato=f=6.5:d=0.5"),
+    "reverse": ("time", "areverse"),
+    "normalizer": ("dynamics", "dynaudnorm=f=200"),
+    "echo": ("time", "aecho=0.8:0.88:60:0.4")
+}
+FILTER_STAGE_ORDER = ("speed", "eq", "modulation", "time", "dynamics")
+FILTER_DISPLAY_NAMES = {
+    "bassboost": "Bass Boost",
+    "nightcore": "Nightcore",
+    "8d": "8D Audio",
+    "vaporwave": "Vaporwave",
+    "tremolo": "Tremolo",
+    "vibrato": "Vibrato",
+    "reverse": "Reverse",
+    "normalizer": "Normalizer",
+    "echo": "Echo"
+}
+
+
+def filter_supported(name):
+    """Whether the probed ffmpeg binary has everything a filter needs"""
+    stage, value = AVAILABLE_FILTERS[name]
+    if stage == "speed":
+        required = {"aresample", "asetrate"}
+    else:
+        required = {value.split("=", 1)[0]}
+    return required <= FFMPEG_INFO["filters"]
+
+
+SUPPORTED_FILTERS = [name for name in AVAILABLE_FILTERS if filter_supported(name)]
+if FFMPEG_INFO["available"] and len(SUPPORTED_FILTERS) < len(AVAILABLE_FILTERS):
+    print("Filters unsupported by this ffmpeg: " + ", ".join(
+        name for name in AVAILABLE_FILTERS if name not in SUPPORTED_FILTERS))
+
+# Filters that change playback speed, as track seconds per output second
+FILTER_SPEEDS = {
+    name: value
+    for name, (stage, value) in AVAILABLE_FILTERS.items() if stage == "speed"
 }
 
 # Optimized yt-dlp configuration
 # Optimized and fixed yt-dlp configuration
 ydl_opts_base = {
-    "format": "bestaudio/best",
+    # Prefer Opus so tracks without processing can be passed straight through
+    "format": "bestaudio[acodec=opus]/bestaudio/best",
     "noplaylist": True,
     "quiet": True,
     "no_warnings": True,
@@ -96,69 +453,1345 @@ ydl_opts_base = {
     }
 }
 
+class CountingExecutor(ThreadPoolExecutor):
+    """ThreadPoolExecutor that counts jobs still waiting for a thread"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.waiting = 0
+        self._waiting_lock = threading.Lock()
+
+    def _count(self, amount):
+        with self._waiting_lock:
+            self.waiting += amount
+
+    def submit(self, fn, /, *args, **kwargs):
+        def run():
+            self._count(-1)
+            return fn(*args, **kwargs)
+
+        self._count(1)
+        try:
+            future = super().submit(run)
+        except BaseException:
+            self._count(-1)
+            raise
+        # A job cancelled before it started never runs
+        future.add_done_callback(lambda future: future.cancelled() and self._count(-1))
+        return future
+
+
+# Pooled yt-dlp extractors. Each extraction thread keeps its own warm
+# YoutubeDL instances (one per option set) so extractor registration, option
+# parsing and the HTTP session are paid once per thread instead of per lookup.
+YTDL_POOL_WORKERS = int(os.getenv("YTDL_POOL_WORKERS", "4"))
+YTDL_RECYCLE_AFTER = int(os.getenv("YTDL_RECYCLE_AFTER", "250"))
+YTDL_MAX_AGE = int(os.getenv("YTDL_MAX_AGE", "3600"))
+
+YTDL_EXECUTOR = CountingExecutor(max_workers=YTDL_POOL_WORKERS,
+                                   thread_name_prefix="ytdl")
+_ytdl_local = threading.local()
+
+
+def _ydl_opts_key(ydl_opts):
+    return json.dumps(ydl_opts, sort_keys=True, default=str)
+
+
+def _acquire_ydl(ydl_opts):
+    """Return this thread's warm YoutubeDL for the given option set"""
+    instances = getattr(_ytdl_local, "instances", None)
+    if instances is None:
+        instances = _ytdl_local.instances = {}
+
+    key = _ydl_opts_key(ydl_opts)
+    entry = instances.get(key)
+    if entry is not None:
+        too_old = time.monotonic() - entry["created_at"] > YTDL_MAX_AGE
+        if not entry["healthy"] or entry["uses"] >= YTDL_RECYCLE_AFTER or too_old:
+            _release_ydl(key)
+            entry = None
+
+    if entry is None:
+        entry = {
+            "ydl": yt_dlp.YoutubeDL(dict(ydl_opts)),
+            "uses": 0,
+            "created_at": time.monotonic(),
+            "healthy": True
+        }
+        instances[key] = entry
+
+    entry["uses"] += 1
+    return key, entry
+
+
+def _release_ydl(key):
+    entry = _ytdl_local.instances.pop(key, None)
+    if entry is not None:
+        try:
+            entry["ydl"].close()
+        except Exception as e:
+            print(f"Error closing extractor: {e}")
+
+
+class LRUCache:
+    """Size-capped mapping that evicts the least recently used entry"""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        try:
+            value = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def peek(self, key, default=None):
+        return self._data.get(key, default)
+
+    def set(self, key, value):
+        self._data[key] = value
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+            self.evictions += 1
+
+    def pop(self, key, default=None):
+        return self._data.pop(key, default)
+
+    def stats(self):
+        return {
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions
+        }
+
+
+# Two-tier resolution cache. Durable metadata is small and never expires, so it
+# lives in size-capped LRUs. Stream URLs are signed and expire, so they are kept
+# separately, keyed by track id, with the expiry parsed out of the URL itself.
+METADATA_CACHE_SIZE = int(os.getenv("METADATA_CACHE_SIZE", "5000"))
+QUERY_CACHE = LRUCache(METADATA_CACHE_SIZE * 2)  # query -> track key
+TRACK_METADATA_CACHE = LRUCache(METADATA_CACHE_SIZE)  # track key -> metadata
+STREAM_URL_CACHE = {}  # track key -> {"url", "expires_at", "last_used"}
+STREAM_URL_STATS = {"hits": 0, "misses": 0, "evictions": 0, "refreshes": 0}
+STREAM_REFRESH_TASK = None
+
+INFLIGHT_LOOKUPS = {}  # (query, options) -> running extraction task
+INFLIGHT_STATS = {"coalesced": 0}
+
+STREAM_URL_DEFAULT_TTL = 3600
+STREAM_URL_SAFETY_MARGIN = 60
+STREAM_URL_REFRESH_MARGIN = 600
+STREAM_URL_KEEP_WARM = 1800
+
+METADATA_FIELDS = ("id", "title", "duration", "uploader", "thumbnail",
+                   "webpage_url")
+
+_EXPIRE_PATTERN = re.compile(r"[?&/]expire[=/](\d+)")
+
+
+def parse_stream_expiry(url):
+    """Return the unix time a signed stream URL stops working"""
+    match = _EXPIRE_PATTERN.search(url or "")
+    if match:
+        return int(match.group(1))
+    return time.time() + STREAM_URL_DEFAULT_TTL
+
+
+def track_cache_key(info, query=""):
+    """YouTube tracks are keyed by video id, anything else by its page URL"""
+    video_id = info.get("id") or ""
+    webpage_url = info.get("webpage_url") or ""
+    if _VIDEO_ID_PATTERN.match(video_id) and canonicalize_query(webpage_url) == "youtube:" + video_id:
+        return video_id
+    return webpage_url or video_id or query
+
+
+def track_key_query(key):
+    """Turn a track key (or any stored reference) back into a resolvable query"""
+    if _VIDEO_ID_PATTERN.match(key):
+        return "https://www.youtube.com/watch?v=" + key
+    return key
+
+
+def get_cached_stream_url(key):
+    entry = STREAM_URL_CACHE.get(key)
+    now = time.time()
+    if entry is not None:
+        if entry["expires_at"] - STREAM_URL_SAFETY_MARGIN > now:
+            entry["last_used"] = now
+            STREAM_URL_STATS["hits"] += 1
+            return entry["url"]
+        del STREAM_URL_CACHE[key]
+        STREAM_URL_STATS["evictions"] += 1
+    STREAM_URL_STATS["misses"] += 1
+    return None
+
+
+def cache_track(query, info):
+    key = track_cache_key(info, query)
+    alias = canonicalize_query(query)
+    metadata = {field: info.get(field) for field in METADATA_FIELDS}
+    QUERY_CACHE.set(alias, key)
+    TRACK_METADATA_CACHE.set(key, metadata)
+    queue_index_write(alias, key, metadata)
+    if info.get("webpage_url"):
+        page_alias = canonicalize_query(info["webpage_url"])
+        if page_alias != alias:
+            QUERY_CACHE.set(page_alias, key)
+            queue_index_write(page_alias, key, metadata)
+    if info.get("url"):
+        previous = STREAM_URL_CACHE.get(key)
+        STREAM_URL_CACHE[key] = {
+            "url": info["url"],
+            "acodec": info.get("acodec"),
+            "expires_at": parse_stream_expiry(info["url"]),
+            "last_used": previous["last_used"] if previous else time.time()
+        }
+
+
+def get_cache_stats():
+    return {
+        "queries": QUERY_CACHE.stats(),
+        "metadata": TRACK_METADATA_CACHE.stats(),
+        "stream_urls": dict(STREAM_URL_STATS, size=len(STREAM_URL_CACHE)),
+        "inflight": dict(INFLIGHT_STATS, running=len(INFLIGHT_LOOKUPS))
+    }
+
+
+YOUTUBE_HOSTS = {
+    "youtube.com", "www.youtube.com", "m.youtube.com", "music.youtube.com",
+    "youtube-nocookie.com", "www.youtube-nocookie.com", "youtu.be",
+    "www.youtu.be"
+}
+_VIDEO_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{11}$")
+
+
+def canonicalize_query(query):
+    """Map equivalent queries and URLs to one stable resolution key
+
+    youtu.be links, watch?v= links, music.youtube.com links, shorts and embeds
+    of the same video (with or without timestamps) all collapse to
+    ``youtube:<id>``. Searches are compared case- and whitespace-insensitively.
+    """
+    query = query.strip()
+    if query.startswith("ytsearch1:"):
+        query = query[len("ytsearch1:"):]
+
+    if not query.startswith("http"):
+        return "search:" + " ".join(query.casefold().split())
+
+    parsed = urlparse(query)
+    host = (parsed.hostname or "").lower()
+    if host in YOUTUBE_HOSTS:
+        video_id = None
+        path_parts = [part for part in parsed.path.split("/") if part]
+        if host.endswith("youtu.be") and path_parts:
+            video_id = path_parts[0]
+        elif parsed.path == "/watch":
+            video_id = parse_qs(parsed.query).get("v", [None])[0]
+        elif len(path_parts) >= 2 and path_parts[0] in ("shorts", "embed", "live", "v"):
+            video_id = path_parts[1]
+        if video_id and _VIDEO_ID_PATTERN.match(video_id):
+            return "youtube:" + video_id
+
+    return "url:" + parsed._replace(netloc=parsed.netloc.lower(), fragment="").geturl()
+
+
+# Persistent resolution index. Maps canonical queries to track keys and durable
+# metadata so a restart doesn't send every query back through yt-dlp. All
+# SQLite access happens on one dedicated thread; writes are batched.
+RESOLUTION_INDEX_PATH = os.getenv("RESOLUTION_INDEX_PATH", "resolution_index.db")
+RESOLUTION_INDEX_MAX_TRACKS = int(os.getenv("RESOLUTION_INDEX_MAX_TRACKS", "100000"))
+RESOLUTION_INDEX_FLUSH_INTERVAL = 5
+RESOLUTION_INDEX_BATCH_SIZE = 500
+
+INDEX_EXECUTOR = CountingExecutor(max_workers=1,
+                                    thread_name_prefix="resolution-index")
+PENDING_INDEX_WRITES = {}  # alias -> (track key, metadata, used at)
+RESOLUTION_INDEX_TASK = None
+_index_local = threading.local()
+
+
+def _index_connection():
+    conn = getattr(_index_local, "conn", None)
+    if conn is None:
+        # Cluster workers share this file, so wait for each other's locks
+        conn = sqlite3.connect(RESOLUTION_INDEX_PATH, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS tracks (
+                track_key TEXT PRIMARY KEY,
+                id TEXT, title TEXT, duration INTEGER, uploader TEXT,
+                thumbnail TEXT, webpage_url TEXT,
+                last_used REAL NOT NULL)""")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS aliases (
+                alias TEXT PRIMARY KEY,
+                track_key TEXT NOT NULL,
+                last_used REAL NOT NULL)""")
+        conn.execute("CREATE INDEX IF NOT EXISTS tracks_last_used ON tracks(last_used)")
+        conn.execute("CREATE INDEX IF NOT EXISTS aliases_track_key ON aliases(track_key)")
+        conn.commit()
+        _index_local.conn = conn
+    return conn
+
+
+def _index_lookup(alias):
+    conn = _index_connection()
+    row = conn.execute(
+        "SELECT t.track_key, t.id, t.title, t.duration, t.uploader, t.thumbnail, "
+        "t.webpage_url FROM aliases a JOIN tracks t ON t.track_key = a.track_key "
+        "WHERE a.alias = ?", (alias,)).fetchone()
+    if row is None:
+        return None
+    return row[0], dict(zip(METADATA_FIELDS, row[1:]))
+
+
+def _index_write_batch(batch):
+    conn = _index_connection()
+    with conn:
+        conn.executemany(
+            "INSERT INTO tracks (track_key, id, title, duration, uploader, thumbnail, "
+            "webpage_url, last_used) VALUES (?, ?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT(track_key) DO UPDATE SET id=excluded.id, title=excluded.title, "
+            "duration=excluded.duration, uploader=excluded.uploader, "
+            "thumbnail=excluded.thumbnail, webpage_url=excluded.webpage_url, "
+            "last_used=excluded.last_used",
+            [(key, *(metadata.get(field) for field in METADATA_FIELDS), used_at)
+             for _, (key, metadata, used_at) in batch])
+        conn.executemany(
+            "INSERT INTO aliases (alias, track_key, last_used) VALUES (?, ?, ?) "
+            "ON CONFLICT(alias) DO UPDATE SET track_key=excluded.track_key, "
+            "last_used=excluded.last_used",
+            [(alias, key, used_at) for alias, (key, _, used_at) in batch])
+
+        overflow = conn.execute("SELECT COUNT(*) FROM tracks").fetchone()[0] - RESOLUTION_INDEX_MAX_TRACKS
+        if overflow > 0:
+            conn.execute(
+                "DELETE FROM tracks WHERE track_key IN (SELECT track_key FROM tracks "
+                "ORDER BY last_used LIMIT ?)", (overflow,))
+            conn.execute(
+                "DELETE FROM aliases WHERE track_key NOT IN (SELECT track_key FROM tracks)")
+
+
+def queue_index_write(alias, key, metadata):
+    PENDING_INDEX_WRITES[alias] = (key, metadata, time.time())
+
+
+async def lookup_resolution_index(alias):
+    loop = asyncio.get_running_loop()
+    try:
+        return await loop.run_in_executor(INDEX_EXECUTOR, _index_lookup, alias)
+    except sqlite3.Error as e:
+        print(f"Resolution index lookup error: {e}")
+        return None
+
+
+async def flush_resolution_index():
+    if not PENDING_INDEX_WRITES:
+        return
+    batch = list(PENDING_INDEX_WRITES.items())
+    PENDING_INDEX_WRITES.clear()
+    loop = asyncio.get_running_loop()
+    for start in range(0, len(batch), RESOLUTION_INDEX_BATCH_SIZE):
+        try:
+            await loop.run_in_executor(
+                INDEX_EXECUTOR, _index_write_batch,
+                batch[start:start + RESOLUTION_INDEX_BATCH_SIZE])
+        except sqlite3.Error as e:
+            print(f"Resolution index write error: {e}")
+
+
+async def resolution_index_writer():
+    while True:
+        await asyncio.sleep(RESOLUTION_INDEX_FLUSH_INTERVAL)
+        await flush_resolution_index()
+
+
+def flush_resolution_index_sync():
+    """Write out anything still pending; used once the bot has shut down"""
+    if PENDING_INDEX_WRITES:
+        batch = list(PENDING_INDEX_WRITES.items())
+        PENDING_INDEX_WRITES.clear()
+        INDEX_EXECUTOR.submit(_index_write_batch, batch).result()
+
+
+def _first_entry(results):
+    if not results:
+        return None
+    if "entries" in results:
+        entries = [entry for entry in results["entries"] if entry]
+        return entries[0] if entries else None
+    return results
+
+
+async def _lookup_metadata(alias):
+    """Find durable metadata for a canonical query in memory, then on disk"""
+    key = QUERY_CACHE.get(alias)
+    metadata = TRACK_METADATA_CACHE.get(key) if key is not None else None
+    if metadata is None:
+        indexed = await lookup_resolution_index(alias)
+        if indexed is not None:
+            key, metadata = indexed
+            QUERY_CACHE.set(alias, key)
+            TRACK_METADATA_CACHE.set(key, metadata)
+            queue_index_write(alias, key, metadata)
+    return key, metadata
+
+
 async def search_ytdlp_async(query, ydl_opts):
-    if query in SONG_CACHE:
-        return SONG_CACHE[query]
-        
+    """Resolve a query to track info with a fresh stream URL, or None"""
+    started = time.perf_counter()
+    source = "cache"
+    try:
+        extract_query = query
+        alias = canonicalize_query(query)
+        key, metadata = await _lookup_metadata(alias)
+        if metadata is not None:
+            stream_url = get_cached_stream_url(key)
+            if stream_url:
+                return dict(metadata, url=stream_url, key=key)
+            # Metadata is still good; only the stream URL needs refreshing,
+            # which is a direct lookup rather than a search
+            extract_query = metadata.get("webpage_url") or query
+
+        source = "extract"
+        # Single-flight: identical lookups that arrive while an extraction is
+        # already running wait for that extraction instead of starting another
+        inflight_key = (alias, _ydl_opts_key(ydl_opts))
+        task = INFLIGHT_LOOKUPS.get(inflight_key)
+        if task is None:
+            task = asyncio.ensure_future(
+                _resolve_uncached(query, extract_query, ydl_opts))
+            INFLIGHT_LOOKUPS[inflight_key] = task
+            task.add_done_callback(
+                lambda done: _finish_inflight_lookup(inflight_key, done))
+        else:
+            INFLIGHT_STATS["coalesced"] += 1
+            source = "coalesced"
+
+        # Shielded so one caller giving up doesn't cancel the lookup for the rest
+        info = await asyncio.shield(task)
+        return dict(info) if info else None
+    except Exception:
+        SEARCH_FAILURES.inc(source)
+        raise
+    finally:
+        SEARCH_SECONDS.observe(time.perf_counter() - started, source)
+
+
+def _finish_inflight_lookup(inflight_key, task):
+    if INFLIGHT_LOOKUPS.get(inflight_key) is task:
+        del INFLIGHT_LOOKUPS[inflight_key]
+    # Mark the error as retrieved even if every waiter was cancelled
+    if not task.cancelled():
+        task.exception()
+
+
+async def _resolve_uncached(query, extract_query, ydl_opts):
     loop = asyncio.get_running_loop()
     try:
-        result = await loop.run_in_executor(None, lambda: _extract(query, ydl_opts))
-        SONG_CACHE[query] = result
-        return result
+        results = await loop.run_in_executor(YTDL_EXECUTOR, _extract, extract_query, ydl_opts)
     except Exception as e:
         print(f"YT-DLP error: {str(e)}")
         raise
 
-def _extract(query, ydl_opts):
-    with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-        try:
-            info = ydl.extract_info(query, download=False)
-            return info
-        except Exception as e:
-            print(f"Extraction error: {str(e)}")
-            raise
+    track = _first_entry(results)
+    if track is None:
+        return None
+
+    info = get_track_info(track)
+    info["key"] = track_cache_key(info, query)
+    cache_track(query, info)
+    return info
+
+
+async def resolve_track_metadata(query):
+    """Resolve a query to track metadata without needing a fresh stream URL
+
+    Used when enqueueing: a known track costs no extraction at all, and its
+    stream URL is only fetched shortly before it plays.
+    """
+    key, metadata = await _lookup_metadata(canonicalize_query(query))
+    if metadata is not None:
+        return dict(metadata, key=key)
+    return await search_ytdlp_async(query, ydl_opts_base)
+
+
+async def resolve_stream_url(ref):
+    """Return a playable stream URL for a queued track reference, or None"""
+    stream_url = get_cached_stream_url(ref)
+    if stream_url:
+        return stream_url
+    info = await search_ytdlp_async(track_key_query(ref), ydl_opts_base)
+    return info["url"] if info else None
+
+
+def _stream_entry(ref):
+    key = ref if ref in STREAM_URL_CACHE else QUERY_CACHE.peek(
+        canonicalize_query(track_key_query(ref)))
+    return STREAM_URL_CACHE.get(key) if key is not None else None
+
+
+def is_stream_ready(ref):
+    """Whether a queued reference already has an unexpired stream URL cached"""
+    entry = _stream_entry(ref)
+    return entry is not None and entry["expires_at"] - STREAM_URL_SAFETY_MARGIN > time.time()
+
+
+def stream_codec(ref):
+    entry = _stream_entry(ref)
+    return entry.get("acodec") if entry else None
+
 
+# Queue entries are lightweight (track key, title, duration) references. A
+# per-guild prefetch task keeps stream URLs for the next few entries resolved
+# while the current track plays, and is restarted whenever the queue changes
+# under it.
+PREFETCH_DEPTH = int(os.getenv("PREFETCH_DEPTH", "3"))
+PREFETCH_STATS = {"ready": 0, "late": 0}
 
-async def prefetch_next_track(guild_id, voice_client):
-    guild_id_str = str(guild_id)
-    if guild_id_str in SONG_QUEUES and len(SONG_QUEUES[guild_id_str]) > 0:
-        next_track = SONG_QUEUES[guild_id_str][0]
+
+async def prefetch_next_tracks(session):
+    refs = [track.ref for track in session.queue.slice(0, PREFETCH_DEPTH)]
+    # Resolve in queue order so the very next track is never waiting on later ones
+    for ref in refs:
+        if is_stream_ready(ref) or is_cached_locally(ref):
+            continue
         try:
-            if not hasattr(next_track, 'url'):
-                results = await search_ytdlp_async(next_track[1],
-                                                   ydl_opts_base)
-                if "entries" in results:
-                    next_track_info = results["entries"][0]
-                else:
-                    next_track_info = results
-                SONG_QUEUES[guild_id_str][0] = (next_track_info["url"],
-                                                next_track_info["title"],
-                                                next_track_info["duration"])
+            if not await resolve_stream_url(ref):
+                print(f"Prefetch could not resolve {ref}")
         except Exception as e:
-            print(f"Prefetch error: {e}")
+            print(f"Prefetch error for {ref}: {e}")
 
 
-def get_ffmpeg_options(guild_id):
-    filters = FILTERS.get(str(guild_id), [])
+def schedule_prefetch(guild_id, restart=False):
+    """Start the guild's prefetcher, or retarget it after the queue changed"""
+    session = get_session(guild_id)
+    task = session.prefetch_task
+    if task is not None and not task.done():
+        if not restart:
+            return
+        task.cancel()
+    session.prefetch_task = bot.loop.create_task(prefetch_next_tracks(session))
+
+
+def cancel_prefetch(guild_id):
+    session = find_session(guild_id)
+    if session is None:
+        return
+    task, session.prefetch_task = session.prefetch_task, None
+    if task is not None and not task.done():
+        task.cancel()
+
+
+def get_prefetch_stats():
+    total = PREFETCH_STATS["ready"] + PREFETCH_STATS["late"]
+    return dict(PREFETCH_STATS,
+                ready_ratio=PREFETCH_STATS["ready"] / total if total else None)
+
+
+async def refresh_stream_urls():
+    """Re-resolve stream URLs that are about to expire and still in use"""
+    while True:
+        await asyncio.sleep(60)
+        now = time.time()
+        refreshed = dropped = 0
+
+        for key, entry in list(STREAM_URL_CACHE.items()):
+            if entry["expires_at"] - STREAM_URL_REFRESH_MARGIN > now:
+                continue
+
+            metadata = TRACK_METADATA_CACHE.peek(key)
+            recently_used = now - entry["last_used"] < STREAM_URL_KEEP_WARM
+            if not recently_used or not metadata or not metadata.get("webpage_url"):
+                STREAM_URL_CACHE.pop(key, None)
+                STREAM_URL_STATS["evictions"] += 1
+                dropped += 1
+                continue
+
+            try:
+                loop = asyncio.get_running_loop()
+                results = await loop.run_in_executor(
+                    YTDL_EXECUTOR, _extract, metadata["webpage_url"], ydl_opts_base)
+                track = _first_entry(results)
+                if track is None:
+                    raise ValueError("no result")
+                cache_track(metadata["webpage_url"], get_track_info(track))
+                STREAM_URL_STATS["refreshes"] += 1
+                refreshed += 1
+            except Exception as e:
+                print(f"Stream URL refresh failed for {key}: {e}")
+                STREAM_URL_CACHE.pop(key, None)
+                STREAM_URL_STATS["evictions"] += 1
+                dropped += 1
+
+        if refreshed or dropped:
+            print(f"Stream URL cache: refreshed {refreshed}, dropped {dropped}, "
+                  f"stats {get_cache_stats()}")
 
-    if NIGHTCORE_ENABLED.get(str(guild_id),
-                             False) and "nightcore" not in filters:
-        filters.append("nightcore")
 
+def _extract(query, ydl_opts):
+    _, entry = _acquire_ydl(ydl_opts)
+    try:
+        info = entry["ydl"].extract_info(query, download=False)
+        return info
+    except yt_dlp.utils.DownloadError as e:
+        # The video itself failed; the extractor instance is still fine
+        print(f"Extraction error: {str(e)}")
+        raise
+    except Exception as e:
+        # Anything else may have left the session in a bad state
+        entry["healthy"] = False
+        print(f"Extraction error: {str(e)}")
+        raise
+
+
+_FILTER_STAGE_PATTERN = re.compile(r"^[a-z0-9_]+(=[A-Za-z0-9_.:=*+-]*)?$")
+
+
+def get_active_filters(guild_id):
+    session = get_session(guild_id)
+    active = frozenset(session.filters)
+    if session.nightcore:
+        active |= {"nightcore"}
+    return active
+
+
+@functools.lru_cache(maxsize=512)
+def compile_filter_graph(active_filters, volume):
+    """Compile a set of filter names and a gain into one ffmpeg -af chain
+
+    Results are cached per (filter set, volume), so validation and string
+    building happen once per combination rather than once per track.
+    """
+    stages = {stage: [] for stage in FILTER_STAGE_ORDER}
+    speed = 1.0
+    for name in sorted(active_filters):
+        if name not in SUPPORTED_FILTERS:
+            print(f"Ignoring unknown or unsupported filter: {name}")
+            continue
+        stage, value = AVAILABLE_FILTERS[name]
+        if stage == "speed":
+            speed *= value
+        else:
+            stages[stage].append(value)
+
+    chain = []
+    if speed != 1.0:
+        # Resample once so asetrate scales from a known rate; the encoder's
+        # -ar 48000 converts back afterwards
+        chain += ["aresample=48000", f"asetrate={round(48000 * speed)}"]
+    for stage in FILTER_STAGE_ORDER[1:]:
+        chain += stages[stage]
+    if volume != 1.0:
+        # Gain is applied by ffmpeg rather than per frame in Python
+        chain.append(f"volume={volume:.2f}")
+
+    for stage in chain:
+        if not _FILTER_STAGE_PATTERN.match(stage):
+            raise ValueError(f"Invalid filter stage: {stage}")
+    return ",".join(chain)
+
+
+def get_ffmpeg_options(guild_id):
     ffmpeg_options = {
         "before_options":
         "-reconnect 1 -reconnect_streamed 1 -reconnect_delay_max 5 -nostdin",
         "options": "-vn -threads 2",
     }
 
-    if filters:
-        filter_string = ",".join(
-            [AVAILABLE_FILTERS[f] for f in filters if f in AVAILABLE_FILTERS])
-        if filter_string:
-            ffmpeg_options["options"] += f" -af \"{filter_string}\""
+    filter_graph = compile_filter_graph(get_active_filters(guild_id),
+                                        get_session(guild_id).volume)
+    if filter_graph:
+        ffmpeg_options["options"] += f" -af \"{filter_graph}\""
 
     return ffmpeg_options
 
+# Gapless transitions. A few seconds before the current track ends, the next
+# track's ffmpeg process is started and its first frames are read ahead, so
+# play_next_song can hand the voice client a source that is already flowing.
+PREWARM_LEAD = int(os.getenv("PREWARM_LEAD", "5"))
+PREWARM_MAX_AGE = 120
+PREBUFFER_FRAMES = 50  # 20 ms frames, so one second of audio
+
+TRANSITION_GAPS = deque(maxlen=500)
+TRANSITION_STATS = {"transitions": 0, "prewarmed": 0, "cold": 0, "max_gap": 0.0}
+
+
+class PrebufferedSource(discord.AudioSource):
+    """Audio source whose first frames can be read ahead before playback"""
+
+    FRAME_LENGTH = 0.02
+    open_count = 0  # live ffmpeg processes behind these sources
+    _count_lock = threading.Lock()
+
+    def __init__(self, original, on_first_frame=None, start_offset=0.0, speed=1.0):
+        with self._count_lock:
+            PrebufferedSource.open_count += 1
+        self.closed = False
+        self.original = original
+        self.buffer = deque()
+        self.on_first_frame = on_first_frame
+        self.started = False
+        self.start_offset = start_offset
+        self.speed = speed
+        self.frames_played = 0
+        self.replaced = None  # (source, loop) this one took over from
+
+    @property
+    def position(self):
+        """Position in the track in seconds, counted from frames actually sent"""
+        return self.start_offset + self.frames_played * self.FRAME_LENGTH * self.speed
+
+    def advance_to(self, position):
+        """Drop frames until this source lines up with the given position"""
+        while self.position < position:
+            data = self.buffer.popleft() if self.buffer else self.original.read()
+            if not data:
+                break
+            self.frames_played += 1
+
+    def prebuffer(self, frames=PREBUFFER_FRAMES):
+        while len(self.buffer) < frames:
+            data = self.original.read()
+            if not data:
+                break
+            self.buffer.append(data)
+        return len(self.buffer)
+
+    def take_over(self, old, loop):
+        """Close old on the loop once the player has read a frame from this source
+
+        The player thread may still be inside old.read() when the voice
+        client's source is swapped, and killing its ffmpeg then would end
+        the track early.
+        """
+        self.replaced = (old, loop)
+
+    def read(self):
+        data = self.buffer.popleft() if self.buffer else self.original.read()
+        if data:
+            self.frames_played += 1
+            if not self.started:
+                self.started = True
+                if self.on_first_frame:
+                    self.on_first_frame()
+            if self.replaced is not None:
+                with self._count_lock:
+                    replaced, self.replaced = self.replaced, None
+                if replaced is not None:
+                    old, loop = replaced
+                    loop.call_soon_threadsafe(old.cleanup)
+        return data
+
+    def is_opus(self):
+        return self.original.is_opus()
+
+    def cleanup(self):
+        with self._count_lock:
+            if self.closed:
+                return
+            self.closed = True
+            PrebufferedSource.open_count -= 1
+            replaced, self.replaced = self.replaced, None
+        if replaced is not None:
+            # Stopped before the player got to this source
+            replaced[0].cleanup()
+        self.original.cleanup()
+
+
+def record_transition_gap(guild_id):
+    """Called from the voice thread when a track produces its first frame"""
+    session = find_session(guild_id)
+    if session is None:
+        return
+    now = time.perf_counter()
+    requested_at, session.play_requested_at = session.play_requested_at, None
+    if requested_at is not None:
+        PLAY_START_SECONDS.observe(now - requested_at)
+    if session.track_ended_at is None:
+        return
+    ended_at, session.track_ended_at = session.track_ended_at, None
+    gap = now - ended_at
+    TRACK_GAP_SECONDS.observe(gap)
+    TRANSITION_GAPS.append(gap)
+    TRANSITION_STATS["transitions"] += 1
+    TRANSITION_STATS["max_gap"] = max(TRANSITION_STATS["max_gap"], gap)
+
+
+def get_transition_stats():
+    gaps = sorted(TRANSITION_GAPS)
+    if not gaps:
+        return dict(TRANSITION_STATS, avg_gap=None, p95_gap=None)
+    return dict(TRANSITION_STATS,
+                avg_gap=sum(gaps) / len(gaps),
+                p95_gap=gaps[min(len(gaps) - 1, int(len(gaps) * 0.95))])
+
+
+def open_audio_source(guild_id, audio_url, pipeline, offset=0.0):
+    """Start ffmpeg for a track; Python only ever forwards Opus packets
+
+    Passthrough copies the source's Opus stream. Otherwise ffmpeg decodes,
+    runs the filter chain and gain, and encodes to Opus itself.
+    """
+    ffmpeg_options = dict(pipeline["ffmpeg_options"])
+    if offset:
+        ffmpeg_options["before_options"] = f"-ss {offset:.2f} " + ffmpeg_options["before_options"]
+    executable = FFMPEG_INFO["path"]
+    if pipeline["passthrough"]:
+        source = discord.FFmpegOpusAudio(audio_url, codec="opus",
+                                         **ffmpeg_options, executable=executable)
+    elif "libopus" in FFMPEG_INFO["encoders"]:
+        source = discord.FFmpegOpusAudio(audio_url, **ffmpeg_options,
+                                         executable=executable)
+    else:
+        # This ffmpeg can't encode Opus, so discord.py has to
+        source = discord.FFmpegPCMAudio(audio_url, **ffmpeg_options,
+                                        executable=executable)
+    return PrebufferedSource(source,
+                             on_first_frame=lambda: record_transition_gap(guild_id),
+                             start_offset=offset,
+                             speed=pipeline["speed"])
+
+
+def _open_prebuffered_source(guild_id, audio_url, pipeline, offset=0.0):
+    source = open_audio_source(guild_id, audio_url, pipeline, offset)
+    source.prebuffer()
+    return source
+
+
+def _cleanup_source_future(future):
+    if not future.cancelled() and future.exception() is None:
+        future.result().cleanup()
+
+
+async def open_prebuffered_source(guild_id, audio_url, pipeline, offset=0.0):
+    loop = asyncio.get_running_loop()
+    future = loop.run_in_executor(None, _open_prebuffered_source,
+                                  guild_id, audio_url, pipeline, offset)
+    try:
+        return await asyncio.shield(future)
+    except asyncio.CancelledError:
+        # Don't leak the ffmpeg process if we're cancelled mid-open
+        future.add_done_callback(_cleanup_source_future)
+        raise
+
+
+async def prewarm_next_track(session, delay):
+    await asyncio.sleep(delay)
+    if not session.queue:
+        return
+
+    ref = session.queue[0].ref
+    guild_id = session.guild_id
+    try:
+        audio_url, codec, local = await resolve_audio_input(ref)
+        if not audio_url:
+            return
+        pipeline = get_playback_pipeline(guild_id, codec, local)
+        if AUDIO_POOL is not None and AUDIO_POOL.serves(guild_id):
+            AUDIO_POOL.prepare(guild_id, ref, audio_url, pipeline)
+            return
+        source = await open_prebuffered_source(guild_id, audio_url, pipeline)
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        print(f"Prewarm error for {ref}: {e}")
+        return
+
+    if not session.queue or session.queue[0].ref != ref:
+        source.cleanup()
+        return
+
+    discard_prewarmed_source(session)
+    session.prewarmed = {
+        "ref": ref,
+        "source": source,
+        "pipeline": pipeline,
+        "created_at": time.monotonic()
+    }
+
+
+def take_prewarmed_source(session, ref, pipeline):
+    """Return the prewarmed source for ref if it is still usable"""
+    entry, session.prewarmed = session.prewarmed, None
+    if entry is None:
+        return None
+    if (entry["ref"] != ref or entry["pipeline"] != pipeline
+            or time.monotonic() - entry["created_at"] > PREWARM_MAX_AGE):
+        entry["source"].cleanup()
+        return None
+    return entry["source"]
+
+
+def discard_prewarmed_source(session):
+    entry, session.prewarmed = session.prewarmed, None
+    if entry is not None:
+        entry["source"].cleanup()
+
+
+def schedule_transition(guild_id, duration):
+    """Prewarm the next track shortly before the current one ends"""
+    session = get_session(guild_id)
+    cancel_transition(guild_id)
+    if not duration:
+        return
+    delay = max(0, duration - PREWARM_LEAD)
+    session.transition_task = bot.loop.create_task(prewarm_next_track(session, delay))
+
+
+def cancel_transition(guild_id):
+    session = find_session(guild_id)
+    if session is None:
+        return
+    task, session.transition_task = session.transition_task, None
+    if task is not None and not task.done():
+        task.cancel()
+    discard_prewarmed_source(session)
+
+
+def can_passthrough(guild_id, acodec):
+    """Whether a track can be sent as-is, skipping decode and re-encode
+
+    Only possible for Opus sources with no filters and unity gain; anything
+    else is decoded, processed and re-encoded by ffmpeg.
+    """
+    return (acodec == "opus" and not get_active_filters(guild_id)
+            and get_session(guild_id).volume == 1.0)
+
+
+def get_playback_speed(guild_id):
+    """How many seconds of the track one second of output covers"""
+    speed = 1.0
+    for name in get_active_filters(guild_id):
+        speed *= FILTER_SPEEDS.get(name, 1.0)
+    return speed
+
+
+def get_playback_pipeline(guild_id, acodec, local=False):
+    ffmpeg_options = get_ffmpeg_options(guild_id)
+    if local:
+        # The reconnect options only apply to network inputs
+        ffmpeg_options["before_options"] = "-nostdin"
+    if can_passthrough(guild_id, acodec):
+        ffmpeg_options["options"] = "-vn"
+        return {"passthrough": True, "ffmpeg_options": ffmpeg_options, "speed": 1.0}
+    return {
+        "passthrough": False,
+        "ffmpeg_options": ffmpeg_options,
+        "speed": get_playback_speed(guild_id)
+    }
+
+
+# Local audio cache. Tracks played AUDIO_CACHE_MIN_PLAYS times are transcoded
+# to Ogg/Opus on disk by a background downloader (see audio_cache.py); later
+# plays open the file instead of resolving and streaming from YouTube. Cluster
+# workers keep separate caches so each index has a single writer.
+AUDIO_CACHE_DIR = os.getenv("AUDIO_CACHE_DIR", "audio_cache")
+AUDIO_CACHE_MAX_BYTES = int(os.getenv("AUDIO_CACHE_MAX_BYTES", str(2 * 1024 ** 3)))
+AUDIO_CACHE_MIN_PLAYS = int(os.getenv("AUDIO_CACHE_MIN_PLAYS", "3"))
+AUDIO_CACHE_MAX_DURATION = int(os.getenv("AUDIO_CACHE_MAX_DURATION", "900"))
+AUDIO_CACHE_FLUSH_INTERVAL = 60
+
+AUDIO_CACHE = None
+if AUDIO_CACHE_MAX_BYTES > 0:
+    AUDIO_CACHE = AudioCache(
+        os.path.join(AUDIO_CACHE_DIR, f"cluster-{CLUSTER_ID}") if CLUSTER_WORKERS > 1
+        else AUDIO_CACHE_DIR,
+        AUDIO_CACHE_MAX_BYTES, min_plays=AUDIO_CACHE_MIN_PLAYS,
+        max_duration=AUDIO_CACHE_MAX_DURATION)
+AUDIO_CACHE_EXECUTOR = CountingExecutor(max_workers=1, thread_name_prefix="audio-cache")
+AUDIO_CACHE_DOWNLOADS = asyncio.Queue()
+AUDIO_CACHE_TASK = None
+
+
+def is_cached_locally(ref):
+    return AUDIO_CACHE is not None and ref in AUDIO_CACHE
+
+
+async def resolve_audio_input(ref):
+    """(ffmpeg input, codec, whether it is a local file) for a queued track"""
+    path = AUDIO_CACHE.path_for(ref) if AUDIO_CACHE is not None else None
+    if path is not None:
+        return path, "opus", True
+    return await resolve_stream_url(ref), stream_codec(ref), False
+
+
+def note_track_played(ref, duration):
+    """Count a play towards caching the track locally"""
+    if AUDIO_CACHE is None or ref.startswith("ytsearch"):
+        return
+    if AUDIO_CACHE.record_play(ref, duration):
+        AUDIO_CACHE_DOWNLOADS.put_nowait((ref, duration))
+
+
+async def audio_cache_downloader():
+    loop = asyncio.get_running_loop()
+    try:
+        files = await loop.run_in_executor(AUDIO_CACHE_EXECUTOR, AUDIO_CACHE.load)
+        print(f"Audio cache ready with {files} files ({AUDIO_CACHE.get_stats()['bytes']} bytes)")
+    except (OSError, sqlite3.Error) as e:
+        print(f"Audio cache unavailable: {e}")
+        return
+
+    while True:
+        try:
+            ref, duration = await asyncio.wait_for(AUDIO_CACHE_DOWNLOADS.get(),
+                                                   AUDIO_CACHE_FLUSH_INTERVAL)
+        except asyncio.TimeoutError:
+            try:
+                await loop.run_in_executor(AUDIO_CACHE_EXECUTOR, AUDIO_CACHE.flush)
+            except sqlite3.Error as e:
+                print(f"Audio cache index write error: {e}")
+            continue
+
+        try:
+            audio_url = await resolve_stream_url(ref)
+            codec = stream_codec(ref)
+            if not audio_url or (codec != "opus" and "libopus" not in FFMPEG_INFO["encoders"]):
+                AUDIO_CACHE.abandon(ref)
+                continue
+            size = await loop.run_in_executor(
+                AUDIO_CACHE_EXECUTOR, AUDIO_CACHE.download, ref, audio_url,
+                FFMPEG_INFO["path"], codec == "opus", duration)
+            if size:
+                print(f"Cached {ref} locally ({size} bytes)")
+        except Exception as e:
+            AUDIO_CACHE.abandon(ref)
+            print(f"Audio cache error for {ref}: {e}")
+
+
+def get_audio_cache_stats():
+    if AUDIO_CACHE is None:
+        return None
+    stats = AUDIO_CACHE.get_stats()
+    lookups = stats["hits"] + stats["misses"]
+    return dict(stats, hit_ratio=stats["hits"] / lookups if lookups else None)
+
+
+# Live pipeline changes. The current track's ffmpeg is restarted at the exact
+# playback position with the guild's new settings; the old process keeps
+# playing until the new one has buffered, then the voice client switches over.
+
+
+async def respawn_current_track(session, voice_client):
+    current = session.current
+    guild_id = session.guild_id
+    if current and AUDIO_POOL is not None and AUDIO_POOL.is_active(guild_id):
+        # The worker restarts and swaps the pipeline at its own exact position
+        audio_url, codec, local = await resolve_audio_input(current.ref)
+        if not audio_url or not AUDIO_POOL.is_active(guild_id):
+            return False
+        pipeline = get_playback_pipeline(guild_id, codec, local)
+        AUDIO_POOL.respawn(guild_id, audio_url, pipeline)
+        if current.duration:
+            schedule_transition(guild_id, (current.duration - AUDIO_POOL.position(
+                guild_id)) / pipeline["speed"])
+        return True
+
+    old_source = voice_client.source if voice_client else None
+    if not current or not isinstance(old_source, PrebufferedSource):
+        return False
+
+    audio_url, codec, local = await resolve_audio_input(current.ref)
+    if not audio_url:
+        return False
+
+    pipeline = get_playback_pipeline(guild_id, codec, local)
+    new_source = await open_prebuffered_source(guild_id, audio_url, pipeline,
+                                               old_source.position)
+    # The old source kept playing while the new one buffered; catch up to it
+    loop = asyncio.get_running_loop()
+    try:
+        await loop.run_in_executor(None, new_source.advance_to, old_source.position)
+    except asyncio.CancelledError:
+        new_source.cleanup()
+        raise
+
+    if voice_client.source is not old_source or not (
+            voice_client.is_playing() or voice_client.is_paused()):
+        new_source.cleanup()
+        return False
+
+    new_source.take_over(old_source, loop)
+    voice_client.source = new_source
+
+    # A speed change moves the end of the track, and any prewarmed next
+    # track was opened with the old settings
+    if current.duration:
+        schedule_transition(guild_id,
+                            (current.duration - new_source.position) / pipeline["speed"])
+    return True
+
+
+def schedule_respawn(guild_id, voice_client):
+    """Apply changed playback settings to the current track"""
+    session = get_session(guild_id)
+    task = session.respawn_task
+    if task is not None and not task.done():
+        task.cancel()
+    session.respawn_task = bot.loop.create_task(
+        respawn_current_track(session, voice_client))
+
+
+# Out-of-process audio. With AUDIO_WORKERS set, guilds' ffmpeg pipelines,
+# packet pacing and RTP encryption run in a pool of worker processes
+# (audio_worker.py) that send straight to Discord on the voice client's UDP
+# socket. The bot keeps the gateway and voice websockets, drives the workers
+# with play/prepare/respawn/stop/release commands and treats their "finished"
+# events like discord.py's after callback. Guilds whose voice connection
+# uses an encryption mode the workers don't implement, or DAVE end-to-end
+# encryption, play in-process.
+AUDIO_WORKERS = int(os.getenv("AUDIO_WORKERS", "0"))
+AUDIO_WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                   "audio_worker.py")
+AUDIO_POOL = None
+
+
+def build_ffmpeg_args(audio_url, pipeline):
+    """The command line discord.py's FFmpegOpusAudio would run for a pipeline"""
+    ffmpeg_options = pipeline["ffmpeg_options"]
+    codec = "copy" if pipeline["passthrough"] else "libopus"
+    return [FFMPEG_INFO["path"], *shlex.split(ffmpeg_options["before_options"]),
+            "-i", audio_url, "-map_metadata", "-1", "-f", "opus", "-c:a", codec,
+            "-ar", "48000", "-ac", "2", "-b:a", "128k", "-loglevel", "warning",
+            *shlex.split(ffmpeg_options["options"]), "pipe:1"]
+
+
+def voice_connection_params(voice_client):
+    # Private discord.py state; requirements.txt pins the version this matches
+    state = voice_client._connection
+    return {
+        "socket": state.socket,
+        "addr": (state.endpoint_ip, state.voice_port),
+        "ssrc": state.ssrc,
+        "key": bytes(state.secret_key),
+        "mode": state.mode,
+        # The workers only do transport encryption; DAVE end-to-end
+        # encryption of the Opus frames stays with discord.py
+        "e2ee": state.dave_session is not None
+    }
+
+
+class AudioWorkerPool:
+    """Worker processes owning guilds' audio pipelines, picked by guild id"""
+
+    def __init__(self, size, loop):
+        self.loop = loop
+        self.workers = [self._start_worker(index) for index in range(size)]
+        self.voice_sent = {}  # guild -> voice params the worker has
+        self.playback = {}  # guild -> {"id", "voice_client", "after", "position", ...}
+        self.prepared = {}  # guild -> ref the worker is prewarming
+        self.play_ids = 0
+
+    def _start_worker(self, index):
+        parent, child = socket.socketpair()
+        process = subprocess.Popen([sys.executable, AUDIO_WORKER_SCRIPT, str(child.fileno())],
+                                   pass_fds=(child.fileno(),))
+        child.close()
+        worker = {"index": index, "process": process, "conn": Connection(parent.detach()),
+                  "lock": threading.Lock()}
+        threading.Thread(target=self._read_events, args=(worker,),
+                         name=f"audio-worker-{index}", daemon=True).start()
+        print(f"Audio worker {index} started (pid {process.pid})")
+        return worker
+
+    def _read_events(self, worker):
+        while True:
+            try:
+                event = worker["conn"].recv()
+            except (EOFError, OSError):
+                break
+            self.loop.call_soon_threadsafe(self._handle_event, event)
+        self.loop.call_soon_threadsafe(self._worker_lost, worker)
+
+    def _worker_lost(self, worker):
+        if self.workers[worker["index"]] is not worker:
+            return
+        code = worker["process"].wait()
+        print(f"Audio worker {worker['index']} exited with {code}; restarting")
+        self.workers[worker["index"]] = self._start_worker(worker["index"])
+        for guild_id in [g for g in self.voice_sent if self._worker_for(g) is worker]:
+            del self.voice_sent[guild_id]
+            self.prepared.pop(guild_id, None)
+            playback = self.playback.pop(guild_id, None)
+            if playback is not None:
+                playback["after"](RuntimeError("audio worker exited"))
+
+    def _worker_for(self, guild_id):
+        return self.workers[guild_id % len(self.workers)]
+
+    def _send(self, guild_id, message, handle=None):
+        worker = self._worker_for(guild_id)
+        message["guild"] = guild_id
+        with worker["lock"]:
+            worker["conn"].send(message)
+            if handle is not None:
+                send_handle(worker["conn"], handle, worker["process"].pid)
+
+    def attach(self, voice_client):
+        """Hand the guild's voice connection to its worker; False if unsupported"""
+        guild_id = voice_client.guild.id
+        if not voice_client.is_connected():
+            return False
+        params = voice_connection_params(voice_client)
+        if params.pop("e2ee") or params["mode"] not in AUDIO_WORKER_MODES:
+            return False
+        sock = params.pop("socket")
+        signature = (sock.fileno(), params["addr"], params["ssrc"], params["key"])
+        if self.voice_sent.get(guild_id) != signature:
+            self._send(guild_id, dict(params, op="voice"), handle=sock.fileno())
+            self.voice_sent[guild_id] = signature
+        return True
+
+    def serves(self, guild_id):
+        return guild_id in self.voice_sent
+
+    def is_active(self, guild_id):
+        return guild_id in self.playback
+
+    def position(self, guild_id):
+        playback = self.playback.get(guild_id)
+        return playback["position"] if playback else 0
+
+    def play(self, voice_client, ref, audio_url, pipeline, offset, after):
+        """Start a track; returns whether the prewarmed pipeline will be used"""
+        guild_id = voice_client.guild.id
+        self.play_ids += 1
+        self.playback[guild_id] = {"id": self.play_ids, "voice_client": voice_client,
+                                       "after": after, "position": offset}
+        self._send(guild_id, {
+            "op": "play",
+            "id": self.play_ids,
+            "ref": ref,
+            "args": build_ffmpeg_args(audio_url, pipeline),
+            "offset": offset,
+            "speed": pipeline["speed"],
+            "sequence": voice_client.sequence,
+            "timestamp": voice_client.timestamp,
+            "nonce": voice_client._incr_nonce
+        })
+        self._speak(voice_client, discord.SpeakingState.voice)
+        return self.prepared.pop(guild_id, None) == ref and not offset
+
+    def prepare(self, guild_id, ref, audio_url, pipeline):
+        self.prepared[guild_id] = ref
+        self._send(guild_id, {"op": "prepare", "ref": ref, "speed": pipeline["speed"],
+                                  "args": build_ffmpeg_args(audio_url, pipeline)})
+
+    def respawn(self, guild_id, audio_url, pipeline):
+        self.prepared.pop(guild_id, None)
+        self._send(guild_id, {"op": "respawn", "speed": pipeline["speed"],
+                                  "args": build_ffmpeg_args(audio_url, pipeline)})
+
+    def stop(self, guild_id):
+        self._send(guild_id, {"op": "stop"})
+
+    def release(self, guild_id):
+        self.playback.pop(guild_id, None)
+        if self.voice_sent.pop(guild_id, None) is not None:
+            self.prepared.pop(guild_id, None)
+            self._send(guild_id, {"op": "release"})
+
+    def _speak(self, voice_client, state):
+        if voice_client.ws:
+            self.loop.create_task(voice_client.ws.speak(state))
+
+    def _handle_event(self, event):
+        guild_id = event["guild"]
+        playback = self.playback.get(guild_id)
+        if playback is None or playback["id"] != event["id"]:
+            return
+        if event["event"] == "started":
+            record_transition_gap(guild_id)
+        elif event["event"] == "position":
+            playback["position"] = event["position"]
+            # Follow voice reconnects (new server or key) mid-track; once the
+            # call turns on end-to-end encryption the track moves in-process
+            if not self.attach(playback["voice_client"]) and not playback.get("handover"):
+                playback["handover"] = True
+                self.stop(guild_id)
+        elif event["event"] == "finished":
+            del self.playback[guild_id]
+            voice_client = playback["voice_client"]
+            # Keep RTP numbering continuous if the guild falls back in-process
+            voice_client.sequence = event["sequence"]
+            voice_client.timestamp = event["timestamp"]
+            voice_client._incr_nonce = event["nonce"]
+            error = event["error"]
+            if playback.get("handover") and not error and voice_client.is_connected():
+                self.release(guild_id)
+                resume_in_process(voice_client, event["position"])
+                return
+            if voice_client.is_connected():
+                self._speak(voice_client, discord.SpeakingState.none)
+            playback["after"](RuntimeError(error) if error else None)
+
+
+def resume_in_process(voice_client, position):
+    """Continue the current track in-process from where a worker stopped it"""
+    session = find_session(voice_client.guild.id)
+    channel = bot.get_channel(session.text_channel_id) if session else None
+    if session is None or session.current is None or channel is None:
+        return
+    session.queue.appendleft(session.current)
+    session.resume_offset = position
+    bot.loop.create_task(play_next_song(voice_client, session.guild_id, channel))
+
+
+def start_audio_workers():
+    global AUDIO_POOL
+    if AUDIO_POOL is not None or AUDIO_WORKERS <= 0:
+        return
+    if not FFMPEG_INFO["available"] or "libopus" not in FFMPEG_INFO["encoders"]:
+        print("Audio workers need ffmpeg with libopus; playing in-process")
+        return
+    AUDIO_POOL = AudioWorkerPool(AUDIO_WORKERS, bot.loop)
+
+
+def is_voice_active(voice_client):
+    """Whether the guild has a track playing or paused, in either backend"""
+    if AUDIO_POOL is not None and AUDIO_POOL.is_active(voice_client.guild.id):
+        return True
+    return voice_client.is_playing() or voice_client.is_paused()
+
+
+def stop_voice(voice_client):
+    """Stop the current track; its after callback starts the next one"""
+    guild_id = voice_client.guild.id
+    if AUDIO_POOL is not None and AUDIO_POOL.is_active(guild_id):
+        AUDIO_POOL.stop(guild_id)
+    else:
+        voice_client.stop()
+
+
+def playback_position(voice_client):
+    guild_id = voice_client.guild.id
+    if AUDIO_POOL is not None and AUDIO_POOL.is_active(guild_id):
+        return AUDIO_POOL.position(guild_id)
+    source = voice_client.source
+    return source.position if isinstance(source, PrebufferedSource) else 0
+
+
 def get_track_info(track):
     """Extract and validate track information from yt-dlp results"""
     if not track:
@@ -175,11 +1808,17 @@ def get_track_info(track):
         }
 
     direct_url = None
+    acodec = None
+    if track.get("url") and track.get("acodec") not in (None, "none"):
+        # The format yt-dlp selected from ydl_opts["format"]
+        direct_url = track["url"]
+        acodec = track["acodec"]
     try:
-        if "formats" in track and isinstance(track["formats"], list):
+        if not direct_url and "formats" in track and isinstance(track["formats"], list):
             for fmt in track["formats"]:
                 if fmt.get("url") and fmt.get("acodec") != "none":
                     direct_url = fmt["url"]
+                    acodec = fmt.get("acodec")
                     break
     except Exception as e:
         print(f"[ERROR] Exception while parsing formats: {e}")
@@ -196,6 +1835,7 @@ def get_track_info(track):
     return {
         "title": track.get("title", "Unknown"),
         "url": direct_url,
+        "acodec": acodec,
         "webpage_url": track.get("webpage_url", track.get("original_url", "")),
         "thumbnail": track.get("thumbnail", ""),
         "duration": track.get("duration", 0),
@@ -219,98 +1859,301 @@ def format_duration(seconds):
 
 
 def calculate_queue_time(guild_id):
-    queue = SONG_QUEUES.get(str(guild_id), deque())
-    total_time = 0
-    for _, _, duration in queue:
-        total_time += duration or 0
-    return total_time
+    session = find_session(guild_id)
+    return session.queue.total_duration if session is not None else 0
+
+
+# Write-behind persistence. Each top-level entry of the persisted dicts (one
+# song's ratings, one guild's settings, ...) is a row in a WAL-mode SQLite
+# store. Commands only mark the entry dirty; dirty rows are written in one
+# transaction on a background thread shortly afterwards. Saved playlists have
+# and song ratings have their own indexed tables in the same file (see
+# playlist_store.py and rating_store.py), used directly on the same thread.
+DATA_DB_PATH = os.getenv("DATA_DB_PATH", "music_bot_data.db")
+LEGACY_DATA_PATH = "music_bot_data.json"
+SAVE_DEBOUNCE = 2.0
+
+PERSISTED_NAMESPACES = {
+    "voice_channel_locks": "VOICE_CHANNEL_LOCKS",
+    "sessions": "SESSION_SNAPSHOTS",
+    "session_queues": "QUEUE_SNAPSHOTS",
+}
 
+# Per-user settings can be changed through any guild, so in cluster mode from
+# any worker. They aren't kept in memory: reads go to the kv table and each
+# change is a read-modify-write in one transaction on the data-store thread.
+USER_NAMESPACES = ("auto_join_channels", "equalizer_settings", "language_preferences")
+
+DIRTY_KEYS = set()  # (namespace, key)
+DATA_EXECUTOR = CountingExecutor(max_workers=1, thread_name_prefix="data-store")
+DATA_FLUSH_TASK = None
+DATA_LOADED = False
+_data_local = threading.local()
+
+
+def _data_connection():
+    conn = getattr(_data_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(DATA_DB_PATH, timeout=30)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS kv (
+                namespace TEXT NOT NULL,
+                key TEXT NOT NULL,
+                value TEXT NOT NULL,
+                PRIMARY KEY (namespace, key))""")
+        playlist_store.create_schema(conn)
+        rating_store.create_schema(conn)
+        conn.commit()
+        _data_local.conn = conn
+    return conn
+
+
+def _write_data_batch(upserts, deletes):
+    conn = _data_connection()
+    with conn:
+        conn.executemany(
+            "INSERT INTO kv (namespace, key, value) VALUES (?, ?, ?) "
+            "ON CONFLICT(namespace, key) DO UPDATE SET value=excluded.value",
+            upserts)
+        conn.executemany("DELETE FROM kv WHERE namespace = ? AND key = ?", deletes)
+
+
+def _read_all_data():
+    return _data_connection().execute("SELECT namespace, key, value FROM kv").fetchall()
+
+
+def _read_user_setting(conn, namespace, key):
+    row = conn.execute("SELECT value FROM kv WHERE namespace = ? AND key = ?",
+                       (namespace, key)).fetchone()
+    return json.loads(row[0]) if row else None
+
+
+def _update_user_setting(conn, namespace, key, update):
+    """Replace a setting with update(current value); None removes it"""
+    with conn:
+        # Lock first so another worker's change can't land in between
+        conn.execute("BEGIN IMMEDIATE")
+        value = update(_read_user_setting(conn, namespace, key))
+        if value is None:
+            conn.execute("DELETE FROM kv WHERE namespace = ? AND key = ?", (namespace, key))
+        else:
+            conn.execute(
+                "INSERT INTO kv (namespace, key, value) VALUES (?, ?, ?) "
+                "ON CONFLICT(namespace, key) DO UPDATE SET value=excluded.value",
+                (namespace, key, json.dumps(value)))
+    return value
+
+
+def saved_track_row(ref, title, duration):
+    """(track key, title, duration, page URL) row for the playlist store"""
+    page_url = track_key_query(ref)
+    return ref, title, duration, page_url if page_url.startswith("http") else None
+
+
+def _migrate_playlists(playlists):
+    """Move playlists from the old per-user JSON rows into the playlist store"""
+    conn = _data_connection()
+    for user_id_str, user_playlists in playlists.items():
+        for name, songs in user_playlists.items():
+            if playlist_store.size(conn, user_id_str, name) is not None:
+                continue
+            # Entries saved before track keys existed are found again by title
+            rows = [saved_track_row(song.get("ref") or "ytsearch1:" + song["title"],
+                                    song["title"], song.get("duration"))
+                    for song in songs]
+            playlist_store.append(conn, user_id_str, name, rows, create_missing=True)
+    with conn:
+        conn.execute("DELETE FROM kv WHERE namespace = 'custom_playlists'")
+
+
+async def run_data_store(func, *args):
+    """Run a data-store operation (playlist_store, rating_store, user settings) on its thread"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(DATA_EXECUTOR,
+                                      lambda: func(_data_connection(), *args))
 
-def save_data():
-    data = {
-        "song_ratings": SONG_RATINGS,
-        "custom_playlists": CUSTOM_PLAYLISTS,
-        "voice_channel_locks": VOICE_CHANNEL_LOCKS,
-        "auto_join_channels": AUTO_JOIN_CHANNELS,
-        "equalizer_settings": EQUALIZER_SETTINGS,
-        "language_preferences": LANGUAGE_PREFERENCES,
-    }
 
-    with open("music_bot_data.json", "w") as f:
-        json.dump(data, f)
+def _collect_dirty():
+    """Serialize the dirty entries on the loop thread, where they're mutated"""
+    upserts, deletes = [], []
+    for namespace, key in DIRTY_KEYS:
+        data = globals()[PERSISTED_NAMESPACES[namespace]]
+        if key in data:
+            upserts.append((namespace, key, json.dumps(data[key])))
+        else:
+            deletes.append((namespace, key))
+    dirty = set(DIRTY_KEYS)
+    DIRTY_KEYS.clear()
+    return dirty, upserts, deletes
 
 
-def load_data():
-    global SONG_RATINGS, CUSTOM_PLAYLISTS, VOICE_CHANNEL_LOCKS, AUTO_JOIN_CHANNELS, EQUALIZER_SETTINGS, LANGUAGE_PREFERENCES
+def mark_dirty(namespace, key):
+    DIRTY_KEYS.add((namespace, str(key)))
+    global DATA_FLUSH_TASK
+    if DATA_FLUSH_TASK is None or DATA_FLUSH_TASK.done():
+        DATA_FLUSH_TASK = bot.loop.create_task(_debounced_flush())
 
+
+async def _debounced_flush():
+    await asyncio.sleep(SAVE_DEBOUNCE)
+    await flush_data()
+
+
+async def flush_data():
+    """Write all dirty entries off the event loop; returns how many"""
+    if not DIRTY_KEYS:
+        return 0
+    dirty, upserts, deletes = _collect_dirty()
+    loop = asyncio.get_running_loop()
+    started = time.perf_counter()
     try:
-        with open("music_bot_data.json", "r") as f:
-            data = json.load(f)
+        await loop.run_in_executor(DATA_EXECUTOR, _write_data_batch, upserts, deletes)
+    except sqlite3.Error as e:
+        print(f"Data save error (will retry): {e}")
+        DIRTY_KEYS.update(dirty)
+        return 0
+    DATA_SAVE_SECONDS.observe(time.perf_counter() - started)
+    return len(dirty)
+
+
+def save_data():
+    """Synchronously write anything still pending; used once the bot has shut down"""
+    if DIRTY_KEYS:
+        _, upserts, deletes = _collect_dirty()
+        DATA_EXECUTOR.submit(_write_data_batch, upserts, deletes).result()
+
+
+def load_data():
+    global VOICE_CHANNEL_LOCKS, SESSION_SNAPSHOTS, QUEUE_SNAPSHOTS, DATA_LOADED
+
+    if DATA_LOADED:
+        # on_ready fires again after reconnects; memory is already authoritative
+        return
+
+    data = {namespace: {} for namespace in PERSISTED_NAMESPACES}
+    legacy_playlists = {}
+    legacy_ratings = {}
+    legacy_settings = []
+    rows = DATA_EXECUTOR.submit(_read_all_data).result()
+    for namespace, key, value in rows:
+        if namespace in data:
+            data[namespace][key] = json.loads(value)
+        elif namespace == "custom_playlists":
+            legacy_playlists[key] = json.loads(value)
+        elif namespace == "song_ratings":
+            legacy_ratings[key] = json.loads(value)
+
+    migrated = False
+    if not rows:
+        # One-time import from the old single-file JSON store
+        try:
+            with open(LEGACY_DATA_PATH, "r") as f:
+                legacy = json.load(f)
+            for namespace in PERSISTED_NAMESPACES:
+                data[namespace] = legacy.get(namespace, {})
+            legacy_playlists = legacy.get("custom_playlists", {})
+            legacy_ratings = legacy.get("song_ratings", {})
+            legacy_settings = [(namespace, str(key), json.dumps(value))
+                               for namespace in USER_NAMESPACES
+                               for key, value in legacy.get(namespace, {}).items()]
+            migrated = True
+        except (FileNotFoundError, json.JSONDecodeError):
+            pass
+
+    VOICE_CHANNEL_LOCKS = data["voice_channel_locks"]
+    SESSION_SNAPSHOTS = data["sessions"]
+    QUEUE_SNAPSHOTS = data["session_queues"]
+    DATA_LOADED = True
+
+    if migrated:
+        for namespace, entries in data.items():
+            for key in entries:
+                DIRTY_KEYS.add((namespace, str(key)))
+        migrated_count = len(DIRTY_KEYS) + len(legacy_settings)
+        save_data()
+        DATA_EXECUTOR.submit(_write_data_batch, legacy_settings, []).result()
+        print(f"Migrated {migrated_count} entries from {LEGACY_DATA_PATH}")
 
-        SONG_RATINGS = data.get("song_ratings", {})
-        CUSTOM_PLAYLISTS = data.get("custom_playlists", {})
-        VOICE_CHANNEL_LOCKS = data.get("voice_channel_locks", {})
-        AUTO_JOIN_CHANNELS = data.get("auto_join_channels", {})
-        EQUALIZER_SETTINGS = data.get("equalizer_settings", {})
-        LANGUAGE_PREFERENCES = data.get("language_preferences", {})
-    except (FileNotFoundError, json.JSONDecodeError):
-        pass
+    if legacy_playlists:
+        DATA_EXECUTOR.submit(_migrate_playlists, legacy_playlists).result()
+        print(f"Moved saved playlists of {len(legacy_playlists)} users to the playlist store")
+
+    if legacy_ratings:
+        songs = migrate_legacy_ratings(legacy_ratings)
+        print(f"Moved ratings of {songs} songs to the rating store")
 
 
 async def play_next_song(voice_client, guild_id, channel):
-    guild_id_str = str(guild_id)
+    session = get_session(guild_id)
     
     if not voice_client or not voice_client.is_connected():
-        SONG_QUEUES[guild_id_str] = deque()
+        session.queue.clear()
+        cancel_prefetch(guild_id)
+        cancel_transition(guild_id)
+        cancel_import(guild_id)
         return
     
-    if SONG_QUEUES[guild_id_str]:
-        audio_url, title, duration = SONG_QUEUES[guild_id_str].popleft()
-        
-        CURRENT_TRACKS[guild_id_str] = {
-            "title": title,
-            "url": audio_url,
-            "started_at": time.time(),
-            "duration": duration
-        }
-        
-        SONG_TIMESTAMPS[guild_id_str] = 0
-        ffmpeg_options = get_ffmpeg_options(guild_id)
+    if session.queue:
+        track = session.queue.popleft()
+        ref, title, duration = track.ref, track.title, track.duration
+        offset, session.resume_offset = session.resume_offset, 0
+        session.text_channel_id = channel.id
+        if is_stream_ready(ref) or is_cached_locally(ref):
+            PREFETCH_STATS["ready"] += 1
+        else:
+            PREFETCH_STATS["late"] += 1
+            print(f"Next track not prefetched in time: {title} ({get_prefetch_stats()})")
         
         try:
+            # Stream URLs are resolved just in time; the lookahead has
+            # usually cached this one already, and popular tracks are on disk
+            audio_url, codec, local = await resolve_audio_input(ref)
+
+            session.current = track
+            session.current_url = audio_url
+            session.started_at = time.time() - offset
+
+            pipeline = get_playback_pipeline(guild_id, codec, local)
+
             # Verify audio URL is valid and accessible
             if not audio_url or not isinstance(audio_url, str):
                 raise ValueError(f"Invalid audio URL: {audio_url}")
             
-            # Check if ffmpeg is installed and accessible
-            import subprocess
-            try:
-                subprocess.run(["ffmpeg", "-version"], capture_output=True, check=True)
-            except (FileNotFoundError, subprocess.SubprocessError):
-                raise RuntimeError("FFmpeg is not installed or not found in PATH. Please install FFmpeg.")
-            
-            source = discord.FFmpegPCMAudio(audio_url, **ffmpeg_options, executable="ffmpeg")
-            volume = VOLUME_LEVELS.get(guild_id_str, 0.5)
-            source = discord.PCMVolumeTransformer(source, volume=volume)
-            
+            use_worker = AUDIO_POOL is not None and AUDIO_POOL.attach(voice_client)
+            source = None
+            if not use_worker:
+                source = take_prewarmed_source(session, ref, pipeline) if not offset else None
+                if source is not None:
+                    TRANSITION_STATS["prewarmed"] += 1
+                else:
+                    TRANSITION_STATS["cold"] += 1
+
+                    if not FFMPEG_INFO["available"]:
+                        raise RuntimeError("FFmpeg is not installed or not found in PATH. Please install FFmpeg.")
+
+                    source = open_audio_source(guild_id, audio_url, pipeline, offset)
+
             def after_play(error):
+                session.track_ended_at = time.perf_counter()
                 if error:
                     asyncio.run_coroutine_threadsafe(
                         channel.send(f"⚠️ Error during playback: {error}"), bot.loop)
                     print(f"Playback error for {title}: {error}")
                 
-                if guild_id_str not in SONG_HISTORY:
-                    SONG_HISTORY[guild_id_str] = []
-                if len(SONG_HISTORY[guild_id_str]) >= 50:
-                    SONG_HISTORY[guild_id_str].pop(0)
-                SONG_HISTORY[guild_id_str].append((audio_url, title, duration))
-                
-                # Prefetch next track while current one is ending
-                asyncio.create_task(prefetch_next_track(guild_id, voice_client))
+                session.add_history(track)
                 
                 asyncio.run_coroutine_threadsafe(play_next_song(voice_client, guild_id, channel), bot.loop)
             
-            voice_client.play(source, after=after_play)
+            if use_worker:
+                prewarmed = AUDIO_POOL.play(voice_client, ref, audio_url, pipeline, offset, after_play)
+                TRANSITION_STATS["prewarmed" if prewarmed else "cold"] += 1
+            else:
+                voice_client.play(source, after=after_play)
+            schedule_prefetch(guild_id, restart=True)
+            schedule_transition(guild_id, (duration - offset) / pipeline["speed"] if duration else duration)
+            note_track_played(ref, duration)
             
             embed = discord.Embed(
                 title="🎵 Now Playing",
@@ -331,14 +2174,273 @@ async def play_next_song(voice_client, guild_id, channel):
             await asyncio.sleep(1)
             asyncio.create_task(play_next_song(voice_client, guild_id, channel))
     else:
-        if guild_id_str in CURRENT_TRACKS:
-            del CURRENT_TRACKS[guild_id_str]
+        session.track_ended_at = None
+        session.play_requested_at = None
+        session.current = None
+        session.current_url = None
+
+
+# Crash-safe session snapshots. Every few seconds each connected guild's
+# playback state is compared with its last snapshot and only changed rows are
+# handed to the write-behind store. The (possibly long) queue is stored in its
+# own row and only rewritten when it changes.
+SNAPSHOT_INTERVAL = int(os.getenv("SNAPSHOT_INTERVAL", "15"))
+RESTORE_CONCURRENCY = 5
+SNAPSHOT_TASK = None
+SESSIONS_RESTORED = False
+
+
+def build_session_snapshot(session, voice_client):
+    current = session.current
+    offset = playback_position(voice_client)
+    return {
+        "voice_channel_id": voice_client.channel.id,
+        "text_channel_id": session.text_channel_id,
+        "current": current.to_list() if current else None,
+        "offset": round(offset),
+        "listeners": sum(1 for member in voice_client.channel.members if not member.bot),
+        "filters": list(session.filters),
+        "nightcore": session.nightcore,
+        "volume": session.volume
+    }
+
+
+def snapshot_sessions():
+    connected = set()
+    for voice_client in bot.voice_clients:
+        if not voice_client.is_connected():
+            continue
+        guild_id_str = str(voice_client.guild.id)
+        connected.add(guild_id_str)
+        session = get_session(voice_client.guild.id)
+
+        snapshot = build_session_snapshot(session, voice_client)
+        if SESSION_SNAPSHOTS.get(guild_id_str) != snapshot:
+            SESSION_SNAPSHOTS[guild_id_str] = snapshot
+            mark_dirty("sessions", guild_id_str)
+
+        queue = session.queue
+        fingerprint = (session.generation, queue.version)
+        if session.queue_fingerprint != fingerprint:
+            session.queue_fingerprint = fingerprint
+            QUEUE_SNAPSHOTS[guild_id_str] = [track.to_list() for track in queue]
+            mark_dirty("session_queues", guild_id_str)
+
+    for guild_id_str in list(SESSION_SNAPSHOTS):
+        # Other cluster workers' guilds are theirs to keep or drop
+        if guild_id_str not in connected and owns_guild(guild_id_str):
+            del SESSION_SNAPSHOTS[guild_id_str]
+            QUEUE_SNAPSHOTS.pop(guild_id_str, None)
+            session = find_session(guild_id_str)
+            if session is not None:
+                session.queue_fingerprint = None
+            mark_dirty("sessions", guild_id_str)
+            mark_dirty("session_queues", guild_id_str)
+
+
+async def session_snapshot_loop():
+    while True:
+        await asyncio.sleep(SNAPSHOT_INTERVAL)
+        try:
+            snapshot_sessions()
+        except Exception as e:
+            print(f"Session snapshot error: {e}")
+
+
+async def restore_session(guild_id_str, snapshot, resolving):
+    guild = bot.get_guild(int(guild_id_str))
+    voice_channel = guild.get_channel(snapshot["voice_channel_id"]) if guild else None
+    if voice_channel is None:
+        return False
+    text_channel = guild.get_channel(snapshot["text_channel_id"] or 0) or voice_channel
+
+    session = get_session(guild.id)
+    session.filters = list(snapshot["filters"])
+    session.nightcore = snapshot["nightcore"]
+    session.volume = snapshot["volume"]
+
+    queue = TrackQueue(Track.from_list(entry) for entry in QUEUE_SNAPSHOTS.get(guild_id_str, []))
+    if snapshot["current"]:
+        queue.appendleft(Track.from_list(snapshot["current"]))
+        session.resume_offset = snapshot["offset"]
+    session.queue = queue
+
+    voice_client = guild.voice_client
+    if voice_client is None:
+        voice_client = await voice_channel.connect(timeout=10.0, reconnect=True, self_deaf=True)
+
+    if queue:
+        if resolving is not None:
+            await asyncio.gather(resolving, return_exceptions=True)
+        await play_next_song(voice_client, guild.id, text_channel)
+    return True
+
+
+async def restore_sessions():
+    """Reconnect and resume every guild that was playing before a restart"""
+    global SESSIONS_RESTORED
+    started = time.perf_counter()
+    # Guilds that were actively playing to the most listeners come back first
+    snapshots = sorted(
+        ((guild_id_str, snapshot) for guild_id_str, snapshot in SESSION_SNAPSHOTS.items()
+         if owns_guild(guild_id_str)),
+        key=lambda item: (item[1]["current"] is not None,
+                          item[1].get("listeners", 0)),
+        reverse=True)
+
+    # Start resolving every current track at once, in priority order
+    resolving = {
+        guild_id_str: asyncio.ensure_future(resolve_stream_url(snapshot["current"][0]))
+        for guild_id_str, snapshot in snapshots if snapshot["current"]
+    }
+
+    semaphore = asyncio.Semaphore(RESTORE_CONCURRENCY)
+
+    async def restore_one(guild_id_str, snapshot):
+        async with semaphore:
+            try:
+                return await restore_session(guild_id_str, snapshot,
+                                             resolving.get(guild_id_str))
+            except Exception as e:
+                print(f"Could not restore session for guild {guild_id_str}: {e}")
+                return False
+
+    results = await asyncio.gather(*(restore_one(guild_id_str, snapshot)
+                                     for guild_id_str, snapshot in snapshots))
+    await asyncio.gather(*resolving.values(), return_exceptions=True)
+    SESSIONS_RESTORED = True
+    if snapshots:
+        print(f"Restored {sum(results)}/{len(snapshots)} sessions in "
+              f"{time.perf_counter() - started:.1f}s")
+
+
+# Metrics. Prometheus text format on a tiny HTTP server running on the bot's
+# own event loop (see metrics.py), one port per cluster worker. Latencies are
+# observed where they happen; everything the bot already counts elsewhere is
+# read from its stats at scrape time.
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9100"))
+LOOP_LAG_INTERVAL = 0.5
+METRICS_SERVER = None
+LOOP_LAG_TASK = None
+
+SEARCH_SECONDS = metrics.Histogram(
+    "musicbot_search_seconds", "Time to resolve a query to a playable track",
+    ("source",), buckets=(0.001, 0.01, 0.1, 0.25, 0.5, 1, 2, 4, 8, 16, 32))
+SEARCH_FAILURES = metrics.Counter(
+    "musicbot_search_failures_total", "Query resolutions that raised", ("source",))
+PLAY_START_SECONDS = metrics.Histogram(
+    "musicbot_play_start_seconds", "Time from /play or /playlist to the first audio frame",
+    buckets=(0.25, 0.5, 1, 2, 3, 5, 8, 13, 21, 34))
+TRACK_GAP_SECONDS = metrics.Histogram(
+    "musicbot_track_gap_seconds", "Silence between the end of a track and the next one's first frame")
+DATA_SAVE_SECONDS = metrics.Histogram(
+    "musicbot_data_save_seconds", "Time to write a batch of dirty entries to the data store")
+EVENT_LOOP_LAG_SECONDS = metrics.Histogram(
+    "musicbot_event_loop_lag_seconds", "How late the event loop ran a timer",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5))
+
+EXECUTORS = {
+    "ytdl": YTDL_EXECUTOR,
+    "resolution_index": INDEX_EXECUTOR,
+    "data_store": DATA_EXECUTOR,
+    "audio_cache": AUDIO_CACHE_EXECUTOR,
+}
+
+
+def _cache_lookups():
+    stats = get_cache_stats()
+    values = {}
+    for cache in ("queries", "metadata", "stream_urls"):
+        values[(cache, "hit")] = stats[cache]["hits"]
+        values[(cache, "miss")] = stats[cache]["misses"]
+    audio = get_audio_cache_stats()
+    if audio is not None:
+        values[("audio_files", "hit")] = audio["hits"]
+        values[("audio_files", "miss")] = audio["misses"]
+    return values
+
+
+def _cache_entries():
+    stats = get_cache_stats()
+    values = {(cache,): stats[cache]["size"] for cache in ("queries", "metadata", "stream_urls")}
+    audio = get_audio_cache_stats()
+    if audio is not None:
+        values[("audio_files",)] = audio["files"]
+    return values
+
+
+def _ffmpeg_processes():
+    values = {("in_process",): PrebufferedSource.open_count}
+    if AUDIO_POOL is not None:
+        values[("worker",)] = len(AUDIO_POOL.playback) + len(AUDIO_POOL.prepared)
+    return values
+
+
+metrics.Counter("musicbot_cache_lookups_total", "Resolution and audio cache lookups",
+                ("cache", "result"), callback=_cache_lookups)
+metrics.Gauge("musicbot_cache_entries", "Entries held by each cache", ("cache",),
+              callback=_cache_entries)
+metrics.Counter("musicbot_search_coalesced_total",
+                "Lookups that joined an extraction already in flight",
+                callback=lambda: INFLIGHT_STATS["coalesced"])
+metrics.Counter("musicbot_prefetch_total", "Tracks whose stream was or wasn't ready in time",
+                ("result",), callback=lambda: {("ready",): PREFETCH_STATS["ready"],
+                                               ("late",): PREFETCH_STATS["late"]})
+metrics.Counter("musicbot_transitions_total", "Track starts by whether they were prewarmed",
+                ("kind",), callback=lambda: {("prewarmed",): TRANSITION_STATS["prewarmed"],
+                                             ("cold",): TRANSITION_STATS["cold"]})
+metrics.Gauge("musicbot_ffmpeg_processes", "Running ffmpeg playback processes", ("backend",),
+              callback=_ffmpeg_processes)
+metrics.Gauge("musicbot_queued_tracks", "Tracks queued across all guilds",
+              callback=lambda: sum(len(session.queue) for session in SESSIONS.values()))
+metrics.Gauge("musicbot_queue_length_max", "Longest guild queue",
+              callback=lambda: max((len(session.queue) for session in SESSIONS.values()),
+                                   default=0))
+metrics.Gauge("musicbot_sessions", "Guild sessions in memory", callback=lambda: len(SESSIONS))
+metrics.Gauge("musicbot_session_bytes", "Approximate memory held by guild sessions",
+              callback=lambda: sum(session.memory_size() for session in SESSIONS.values()))
+metrics.Gauge("musicbot_voice_connections", "Connected voice clients",
+              callback=lambda: len(bot.voice_clients))
+metrics.Gauge("musicbot_executor_queue_depth", "Jobs waiting for a thread in each executor",
+              ("executor",), callback=lambda: {(name,): executor.waiting
+                                               for name, executor in EXECUTORS.items()})
+metrics.Gauge("musicbot_data_dirty_entries", "Entries waiting for the next data store write",
+              callback=lambda: len(DIRTY_KEYS))
+
+
+async def monitor_event_loop_lag():
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        lag = time.perf_counter() - started - LOOP_LAG_INTERVAL
+        EVENT_LOOP_LAG_SECONDS.observe(max(lag, 0.0))
+
+
+async def start_metrics_server():
+    global METRICS_SERVER
+    if METRICS_SERVER is not None or METRICS_PORT <= 0:
+        return
+    port = METRICS_PORT + CLUSTER_ID
+    try:
+        METRICS_SERVER = await metrics.start_http_server(METRICS_HOST, port)
+    except OSError as e:
+        print(f"Metrics server could not listen on {METRICS_HOST}:{port}: {e}")
+        return
+    print(f"Serving metrics on http://{METRICS_HOST}:{port}/metrics")
+
+
+async def run_session_snapshots():
+    if not SESSIONS_RESTORED:
+        await restore_sessions()
+    await session_snapshot_loop()
 
 
 @bot.event
 async def on_ready():
     print(f"{bot.user} is online!")
     load_data()
+    start_audio_workers()
 
     async def sync_commands():
         retries = 3
@@ -360,27 +2462,60 @@ async def on_ready():
                 await asyncio.sleep(wait_time)
         return False
 
-    if not await sync_commands():
+    # Commands are global, so only the first cluster worker syncs them
+    if CLUSTER_ID == 0 and not await sync_commands():
         print("Failed to sync commands after retries")
 
     async def auto_save_data():
+        # Safety net behind the debounced writes
         while True:
             await asyncio.sleep(300)
-            save_data()
-            print("Data auto-saved")
+            saved = await flush_data()
+            if saved:
+                print(f"Data auto-saved ({saved} entries)")
 
     bot.loop.create_task(auto_save_data())
 
+    await start_metrics_server()
+    global LOOP_LAG_TASK
+    if LOOP_LAG_TASK is None or LOOP_LAG_TASK.done():
+        LOOP_LAG_TASK = bot.loop.create_task(monitor_event_loop_lag())
+
+    global AUDIO_CACHE_TASK
+    if AUDIO_CACHE is not None and (AUDIO_CACHE_TASK is None or AUDIO_CACHE_TASK.done()):
+        AUDIO_CACHE_TASK = bot.loop.create_task(audio_cache_downloader())
+
+    global STREAM_REFRESH_TASK
+    if STREAM_REFRESH_TASK is None or STREAM_REFRESH_TASK.done():
+        STREAM_REFRESH_TASK = bot.loop.create_task(refresh_stream_urls())
+
+    global RESOLUTION_INDEX_TASK
+    if RESOLUTION_INDEX_TASK is None or RESOLUTION_INDEX_TASK.done():
+        RESOLUTION_INDEX_TASK = bot.loop.create_task(resolution_index_writer())
+
+    global SNAPSHOT_TASK
+    if SNAPSHOT_TASK is None or SNAPSHOT_TASK.done():
+        SNAPSHOT_TASK = bot.loop.create_task(run_session_snapshots())
+
+    global SESSION_EVICT_TASK
+    if SESSION_EVICT_TASK is None or SESSION_EVICT_TASK.done():
+        SESSION_EVICT_TASK = bot.loop.create_task(session_eviction_loop())
+
 
 @bot.event
 async def on_voice_state_update(member, before, after):
     if member.id == bot.user.id and after.channel is None:
         # Bot was disconnected from voice
-        guild_id_str = str(before.channel.guild.id)
-        if guild_id_str in SONG_QUEUES:
-            SONG_QUEUES[guild_id_str].clear()
-        if guild_id_str in CURRENT_TRACKS:
-            del CURRENT_TRACKS[guild_id_str]
+        guild_id = before.channel.guild.id
+        session = find_session(guild_id)
+        if session is not None:
+            session.queue.clear()
+            session.current = None
+            cancel_prefetch(guild_id)
+            cancel_transition(guild_id)
+            cancel_import(guild_id)
+        if AUDIO_POOL is not None:
+            AUDIO_POOL.release(guild_id)
         print(f"Bot was disconnected from voice in {before.channel.guild.name}")
         return
         
@@ -391,24 +2526,364 @@ async def on_voice_state_update(member, before, after):
         user_id_str = str(member.id)
         guild_id_str = str(member.guild.id)
         
-        if user_id_str in AUTO_JOIN_CHANNELS and guild_id_str in AUTO_JOIN_CHANNELS[user_id_str]:
-            if str(after.channel.id) == AUTO_JOIN_CHANNELS[user_id_str][guild_id_str]:
-                if not member.guild.voice_client or not member.guild.voice_client.is_connected():
-                    try:
-                        await after.channel.connect()
-                    except Exception as e:
-                        print(f"Auto-join error: {e}")
+        if not member.guild.voice_client or not member.guild.voice_client.is_connected():
+            channels = await run_data_store(_read_user_setting, "auto_join_channels",
+                                            user_id_str)
+            if channels and channels.get(guild_id_str) == str(after.channel.id):
+                try:
+                    await after.channel.connect()
+                except Exception as e:
+                    print(f"Auto-join error: {e}")
     
     if before.channel is not None and len(before.channel.members) == 1:
         if before.channel.members[0].id == bot.user.id:
             voice_client = before.channel.guild.voice_client
             if voice_client and voice_client.is_connected():
                 await voice_client.disconnect()
-                guild_id_str = str(before.channel.guild.id)
-                if guild_id_str in SONG_QUEUES:
-                    SONG_QUEUES[guild_id_str].clear()
-                if guild_id_str in CURRENT_TRACKS:
-                    del CURRENT_TRACKS[guild_id_str]
+                guild_id = before.channel.guild.id
+                session = find_session(guild_id)
+                if session is not None:
+                    session.queue.clear()
+                    session.current = None
+                    cancel_prefetch(guild_id)
+                    cancel_transition(guild_id)
+
+
+# Bulk playlist import. Playlist and mix URLs are listed with flat extraction,
+# which returns ids, titles and durations page by page without resolving any
+# formats. Entries go into the queue in batches as pages arrive, the first one
+# on its own so playback starts right away, and each track's stream URL is
+# resolved just in time like any other queued track.
+IMPORT_MAX_ENTRIES = int(os.getenv("IMPORT_MAX_ENTRIES", "1000"))
+IMPORT_BATCH_SIZE = 50
+IMPORT_PROGRESS_INTERVAL = 2.0
+UNAVAILABLE_TITLES = {"[Private video]", "[Deleted video]", "[Unavailable video]"}
+
+ydl_opts_flat = dict(ydl_opts_base, noplaylist=False, extract_flat="in_playlist")
+
+
+def playlist_url_id(query):
+    """The YouTube playlist or mix a URL points at, if any"""
+    if not query.startswith("http"):
+        return None
+    parsed = urlparse(query.strip())
+    if (parsed.hostname or "").lower() not in YOUTUBE_HOSTS:
+        return None
+    return parse_qs(parsed.query).get("list", [None])[0]
+
+
+def _flat_entry_info(item):
+    video_id = item.get("id") or ""
+    if _VIDEO_ID_PATTERN.match(video_id) and item.get("ie_key", "Youtube") == "Youtube":
+        webpage_url = "https://www.youtube.com/watch?v=" + video_id
+    else:
+        webpage_url = item.get("webpage_url") or item.get("url") or ""
+    thumbnails = item.get("thumbnails") or []
+    return {
+        "id": video_id,
+        "title": item.get("title") or "Unknown",
+        "duration": item.get("duration") or 0,
+        "uploader": item.get("uploader") or item.get("channel") or "Unknown",
+        "thumbnail": thumbnails[-1].get("url", "") if thumbnails else "",
+        "webpage_url": webpage_url
+    }
+
+
+def _stream_playlist(url, limit, cancelled, deliver):
+    """List a playlist's entries on the extractor pool, handing them over in batches
+
+    Returns the number of entries listed, or None if the URL isn't a playlist.
+    """
+    _, entry = _acquire_ydl(ydl_opts_flat)
+    ydl = entry["ydl"]
+    try:
+        # process=False keeps the entries a lazy, page-by-page generator
+        info = ydl.extract_info(url, download=False, process=False)
+        for _ in range(3):
+            if info is None or info.get("_type") not in ("url", "url_transparent"):
+                break
+            info = ydl.extract_info(info["url"], download=False, process=False)
+        if not info or info.get("entries") is None:
+            return None
+
+        entries = info["entries"]
+        if hasattr(entries, "getslice"):
+            entries = entries.getslice(0, limit)
+        title = info.get("title") or "playlist"
+        batch = []
+        listed = 0
+        for item in itertools.islice(entries, limit):
+            if cancelled.is_set():
+                break
+            if not item:
+                continue
+            batch.append(item)
+            listed += 1
+            # The first entry goes out alone so playback can start immediately
+            if listed == 1 or len(batch) >= IMPORT_BATCH_SIZE:
+                deliver((title, batch))
+                batch = []
+        if batch:
+            deliver((title, batch))
+        return listed
+    except yt_dlp.utils.DownloadError as e:
+        print(f"Playlist extraction error: {str(e)}")
+        raise
+    except Exception as e:
+        entry["healthy"] = False
+        print(f"Playlist extraction error: {str(e)}")
+        raise
+
+
+def cancel_import(guild_id):
+    session = find_session(guild_id)
+    if session is not None and session.import_cancel is not None:
+        session.import_cancel.set()
+
+
+class ImportView(discord.ui.View):
+    """Cancel button on a running playlist import's progress message"""
+
+    def __init__(self, cancelled):
+        super().__init__(timeout=None)
+        self.cancelled = cancelled
+
+    @discord.ui.button(label="Cancel import", style=discord.ButtonStyle.danger)
+    async def cancel(self, interaction: discord.Interaction, button: discord.ui.Button):
+        self.cancelled.set()
+        button.disabled = True
+        await interaction.response.edit_message(view=self)
+
+
+async def import_playlist(interaction, session, voice_client, url):
+    """Stream a playlist into the queue; False if the URL isn't a playlist"""
+    if session.import_cancel is not None:
+        await interaction.edit_original_response(
+            content="❌ A playlist import is already running in this server.")
+        return True
+
+    loop = asyncio.get_running_loop()
+    batches = asyncio.Queue()
+    cancelled = threading.Event()
+    session.import_cancel = cancelled
+    view = ImportView(cancelled)
+
+    future = loop.run_in_executor(
+        YTDL_EXECUTOR, _stream_playlist, url, IMPORT_MAX_ENTRIES, cancelled,
+        lambda batch: loop.call_soon_threadsafe(batches.put_nowait, batch))
+    future.add_done_callback(lambda _: batches.put_nowait(None))
+
+    title = "playlist"
+    added = skipped = 0
+    last_progress = 0.0
+    try:
+        while True:
+            item = await batches.get()
+            if item is None:
+                break
+            if cancelled.is_set() or not voice_client.is_connected():
+                cancelled.set()
+                continue
+            title, batch = item
+
+            tracks = []
+            for entry in batch:
+                info = _flat_entry_info(entry)
+                if info["title"] in UNAVAILABLE_TITLES or not info["webpage_url"]:
+                    skipped += 1
+                    continue
+                cache_track(info["webpage_url"], info)
+                tracks.append(Track(track_cache_key(info), info["title"], info["duration"]))
+            session.queue.extend(tracks)
+            added += len(tracks)
+            schedule_prefetch(session.guild_id)
+
+            if added and added == len(tracks) and not is_voice_active(voice_client):
+                bot.loop.create_task(play_next_song(voice_client, session.guild_id,
+                                                    interaction.channel))
+
+            if time.monotonic() - last_progress >= IMPORT_PROGRESS_INTERVAL:
+                last_progress = time.monotonic()
+                await interaction.edit_original_response(
+                    content=f"📥 Importing **{title}**: {added} tracks queued...", view=view)
+
+        listed = await future
+    except Exception as e:
+        await interaction.edit_original_response(
+            content=f"❌ Playlist import failed after {added} tracks: {str(e)}", view=None)
+        return True
+    finally:
+        view.stop()
+        if session.import_cancel is cancelled:
+            session.import_cancel = None
+
+    if listed is None:
+        return False
+
+    summary = f"**{added}** tracks from **{title}**"
+    if skipped:
+        summary += f" ({skipped} unavailable skipped)"
+    if cancelled.is_set():
+        content = f"🛑 Import cancelled after {summary}."
+    else:
+        content = f"✅ Queued {summary}."
+        if listed >= IMPORT_MAX_ENTRIES:
+            content += f" Stopped at the {IMPORT_MAX_ENTRIES}-entry import limit."
+    await interaction.edit_original_response(content=content, view=None)
+    return True
+
+
+# Saved playlists are re-resolved when loaded: older entries only hold a
+# stream URL that expired long ago, and saved videos get taken down. Entries
+# resolve concurrently, bounded overall and per guild so one long playlist
+# can't starve other guilds' lookups, and join the queue in playlist order as
+# soon as everything before them has resolved.
+PLAYLIST_RESOLVE_CONCURRENCY = int(os.getenv("PLAYLIST_RESOLVE_CONCURRENCY", "8"))
+PLAYLIST_GUILD_CONCURRENCY = int(os.getenv("PLAYLIST_GUILD_CONCURRENCY", "3"))
+PLAYLIST_RESOLVE_SEMAPHORE = asyncio.Semaphore(PLAYLIST_RESOLVE_CONCURRENCY)
+DEAD_ENTRIES_SHOWN = 10
+PLAYLIST_PAGE_SIZE = 10
+PLAYLIST_IMPORT_MAX_BYTES = 2 * 1024 * 1024
+
+
+async def resolve_saved_entry(song, guild_limit):
+    """Track for a saved playlist entry, or None if it can't be played"""
+    async with guild_limit, PLAYLIST_RESOLVE_SEMAPHORE:
+        try:
+            info = await search_ytdlp_async(track_key_query(song["ref"]), ydl_opts_base)
+        except Exception as e:
+            print(f"Could not resolve playlist entry {song['title']}: {e}")
+            return None
+    if not info or not info.get("url"):
+        return None
+    return Track(info["key"], info.get("title") or song["title"],
+                 info.get("duration") or song.get("duration"))
+
+
+async def load_saved_playlist(interaction, session, voice_client, name, playlist):
+    """Resolve a saved playlist's entries into the queue
+
+    Returns (added, dead titles, playlist_store.update_entries rows).
+    """
+    if session.resolve_limit is None:
+        session.resolve_limit = asyncio.Semaphore(PLAYLIST_GUILD_CONCURRENCY)
+    cancelled = threading.Event()
+    session.import_cancel = cancelled
+    entries = playlist
+    tasks = [asyncio.ensure_future(resolve_saved_entry(song, session.resolve_limit))
+             for song in entries]
+
+    added = 0
+    dead = []
+    updates = []
+    last_progress = time.monotonic()
+    try:
+        for done, (song, task) in enumerate(zip(entries, tasks), start=1):
+            track = await task
+            if cancelled.is_set() or not voice_client.is_connected():
+                cancelled.set()
+                break
+
+            if track is None:
+                dead.append(song["title"])
+                if not song["dead"]:
+                    updates.append((song["entry"], song["ref"], song["ref"], song["title"],
+                                    song["duration"], song["url"], True))
+                continue
+            if (track.ref, track.title) != (song["ref"], song["title"]) or song["dead"]:
+                updates.append((song["entry"], song["ref"],
+                                *saved_track_row(track.ref, track.title, track.duration), False))
+
+            session.queue.append(track)
+            added += 1
+            schedule_prefetch(session.guild_id)
+            if added == 1 and not is_voice_active(voice_client):
+                bot.loop.create_task(play_next_song(voice_client, session.guild_id,
+                                                    interaction.channel))
+
+            if time.monotonic() - last_progress >= IMPORT_PROGRESS_INTERVAL:
+                last_progress = time.monotonic()
+                await interaction.edit_original_response(
+                    content=f"⏳ Loading playlist '{name}': {done}/{len(entries)} checked, "
+                            f"{added} queued...")
+    finally:
+        for task in tasks:
+            task.cancel()
+        if session.import_cancel is cancelled:
+            session.import_cancel = None
+    return added, dead, updates
+
+
+# Song ratings, keyed by track key (the video id for YouTube). Every vote is a
+# row in rating_store.py's tables, with per-song and per-guild aggregates kept
+# in step by SQL, so cluster workers sharing the data file all see the same
+# ratings and leaderboards are read from the database.
+TOPRATED_MIN_RATINGS = int(os.getenv("TOPRATED_MIN_RATINGS", "3"))
+TOPRATED_SIZE = 10
+
+
+def _index_titles(keys):
+    """Titles the resolution index knows for a set of track keys"""
+    conn = _index_connection()
+    keys = list(keys)
+    titles = {}
+    for start in range(0, len(keys), RESOLUTION_INDEX_BATCH_SIZE):
+        batch = keys[start:start + RESOLUTION_INDEX_BATCH_SIZE]
+        titles.update(conn.execute(
+            "SELECT track_key, title FROM tracks WHERE track_key IN "
+            f"({','.join('?' * len(batch))})", batch).fetchall())
+    return titles
+
+
+def _migrate_ratings(songs):
+    conn = _data_connection()
+    for key, (title, ratings) in songs.items():
+        rating_store.import_ratings(conn, key, title, ratings)
+    with conn:
+        conn.execute("DELETE FROM kv WHERE namespace = 'song_ratings'")
+
+
+def migrate_legacy_ratings(legacy):
+    """Move ratings from the old per-song JSON rows into the rating store
+
+    Rows written since ratings were keyed by track key carry a title and the
+    guild of each rating. Older rows were {user: rating} under the song's
+    URL; only those whose URL is a YouTube page can be traced to a song, and
+    their titles come from the resolution index. Returns how many songs had
+    ratings moved.
+    """
+    songs = {}  # track key -> (title, [(user, guild, rating)])
+    # Newer rows first, so their rating wins for a user found in both
+    for old_key, value in sorted(legacy.items(), key=lambda item: "ratings" not in item[1]):
+        if "ratings" in value:
+            key, title = old_key, value.get("title")
+            ratings = [(user_id_str, guild, rating)
+                       for user_id_str, (rating, guild) in value["ratings"].items()]
+        else:
+            alias = canonicalize_query(old_key)
+            if not alias.startswith("youtube:"):
+                continue
+            key, title = alias[len("youtube:"):], None
+            # The guild a legacy rating was made in isn't known
+            ratings = [(user_id_str, None, rating) for user_id_str, rating in value.items()]
+        previous = songs.get(key)
+        if previous is not None:
+            title = title or previous[0]
+            ratings = previous[1] + ratings
+        songs[key] = (title, ratings)
+
+    untitled = [key for key, (title, _) in songs.items() if not title]
+    if untitled:
+        try:
+            titles = INDEX_EXECUTOR.submit(_index_titles, untitled).result()
+        except sqlite3.Error as e:
+            print(f"Resolution index lookup error: {e}")
+            titles = {}
+        for key in untitled:
+            songs[key] = (titles.get(key), songs[key][1])
+
+    DATA_EXECUTOR.submit(_migrate_ratings, songs).result()
+    return len(songs)
 
 
 @bot.tree.command(name="play", description="Play a song or add it to the queue.")
@@ -439,29 +2914,29 @@ async def play(interaction: discord.Interaction, song_query: str):
         except Exception as e:
             return await interaction.edit_original_response(content=f"❌ Failed to move to your voice channel: {str(e)}")
     
-    if guild_id_str not in SONG_QUEUES:
-        SONG_QUEUES[guild_id_str] = deque()
+    session = get_session(interaction.guild_id)
+    if not is_voice_active(voice_client):
+        session.play_requested_at = time.perf_counter()
     
-    if guild_id_str not in VOLUME_LEVELS:
-        VOLUME_LEVELS[guild_id_str] = 0.5
+    if playlist_url_id(song_query):
+        await interaction.edit_original_response(content="📥 Listing playlist...")
+        try:
+            if await import_playlist(interaction, session, voice_client, song_query):
+                return
+        except Exception as e:
+            return await interaction.edit_original_response(content=f"❌ Error: {str(e)}")
     
     query = song_query
     if not query.startswith("http"):
         query = "ytsearch1:" + song_query
     
     try:
-        results = await search_ytdlp_async(query, ydl_opts_base)
+        info = await resolve_track_metadata(query)
+        if not info:
+            return await interaction.edit_original_response(content="❌ No results found.")
         
-        if "entries" in results:
-            tracks = results["entries"]
-            if not tracks:
-                return await interaction.edit_original_response(content="❌ No results found.")
-            first_track = tracks[0]
-        else:
-            first_track = results
-        
-        info = get_track_info(first_track)
-        SONG_QUEUES[guild_id_str].append((info["url"], info["title"], info["duration"]))
+        session.queue.append(Track(info["key"], info["title"], info["duration"]))
+        schedule_prefetch(interaction.guild_id)
         
         embed = discord.Embed(
             title="🎵 Track Added",
@@ -478,8 +2953,8 @@ async def play(interaction: discord.Interaction, song_query: str):
         if info["thumbnail"]:
             embed.set_thumbnail(url=info["thumbnail"])
         
-        if voice_client.is_playing() or voice_client.is_paused():
-            queue_position = len(SONG_QUEUES[guild_id_str])
+        if is_voice_active(voice_client):
+            queue_position = len(session.queue)
             embed.description = f"Added to queue at position {queue_position}"
             await interaction.edit_original_response(embed=embed)
         else:
@@ -498,51 +2973,51 @@ async def play(interaction: discord.Interaction, song_query: str):
                   description="Skip to a specific song in the queue")
 @app_commands.describe(position="Position in the queue (1-based)")
 async def skip_to(interaction: discord.Interaction, position: int):
-    guild_id_str = str(interaction.guild_id)
+    session = find_session(interaction.guild_id)
 
-    if guild_id_str not in SONG_QUEUES or not SONG_QUEUES[guild_id_str]:
+    if session is None or not session.queue:
         return await interaction.response.send_message("❌ Queue is empty.")
 
-    if position < 1 or position > len(SONG_QUEUES[guild_id_str]):
+    if position < 1 or position > len(session.queue):
         return await interaction.response.send_message(
-            f"❌ Invalid position. Queue has {len(SONG_QUEUES[guild_id_str])} songs."
+            f"❌ Invalid position. Queue has {len(session.queue)} songs."
         )
 
-    queue_list = list(SONG_QUEUES[guild_id_str])
-    requested_song = queue_list[position - 1]
-    SONG_QUEUES[guild_id_str] = deque(queue_list[position - 1:])
+    session.queue.drop_front(position - 1)
+    requested_song = session.queue[0]
+    schedule_prefetch(interaction.guild_id, restart=True)
+    cancel_transition(interaction.guild_id)
 
     voice_client = interaction.guild.voice_client
-    if voice_client and (voice_client.is_playing()
-                         or voice_client.is_paused()):
-        voice_client.stop()
+    if voice_client and is_voice_active(voice_client):
+        stop_voice(voice_client)
 
     await interaction.response.send_message(
-        f"⏭️ Skipping to **{requested_song[1]}**")
+        f"⏭️ Skipping to **{requested_song.title}**")
 
 
 @bot.tree.command(
     name="nowplaying",
     description="Show information about the currently playing song")
 async def now_playing(interaction: discord.Interaction):
-    guild_id_str = str(interaction.guild_id)
+    session = find_session(interaction.guild_id)
 
-    if guild_id_str not in CURRENT_TRACKS:
+    if session is None or session.current is None:
         return await interaction.response.send_message(
             "❌ Nothing is currently playing.")
 
-    current = CURRENT_TRACKS[guild_id_str]
-    elapsed = time.time() - current["started_at"]
+    current = session.current
+    elapsed = time.time() - session.started_at
     elapsed_str = format_duration(elapsed)
     duration_str = format_duration(
-        current["duration"]) if current["duration"] else "Unknown"
+        current.duration) if current.duration else "Unknown"
 
     embed = discord.Embed(title="🎵 Now Playing",
-                          description=f"**{current['title']}**",
+                          description=f"**{current.title}**",
                           color=discord.Color.green())
 
-    if current["duration"]:
-        progress_percent = min(100, int((elapsed / current["duration"]) * 100))
+    if current.duration:
+        progress_percent = min(100, int((elapsed / current.duration) * 100))
         bar_length = 20
         filled_length = int(bar_length * progress_percent / 100)
         progress_bar = "▓" * filled_length + "░" * (bar_length - filled_length)
@@ -557,64 +3032,193 @@ async def now_playing(interaction: discord.Interaction):
     await interaction.response.send_message(embed=embed)
 
 
-@bot.tree.command(name="queue", description="Show the current queue")
-async def queue(interaction: discord.Interaction):
-    guild_id_str = str(interaction.guild_id)
+# Paginated queue view. Pages are rendered from the indexed queue on demand
+# and cached per queue version, so paging through a long queue, or several
+# people looking at the same one, costs one slice per distinct page.
+QUEUE_PAGE_SIZE = 10
+QUEUE_VIEW_TIMEOUT = 300
+QUEUE_PAGE_CACHE = LRUCache(int(os.getenv("QUEUE_PAGE_CACHE_SIZE", "1000")))
 
-    if guild_id_str not in SONG_QUEUES or not SONG_QUEUES[guild_id_str]:
-        return await interaction.response.send_message("❌ Queue is empty.")
+
+def render_queue_page(session, page):
+    """Return (embed, page, page count) for one page of the guild's queue"""
+    queue = session.queue
+    page_count = max(1, -(-len(queue) // QUEUE_PAGE_SIZE))
+    page = min(max(page, 0), page_count - 1)
+    current = session.current
+    cache_key = (session.guild_id, session.generation, queue.version, page)
+    embed = QUEUE_PAGE_CACHE.get(cache_key)
+    if embed is not None:
+        return embed, page, page_count
 
     embed = discord.Embed(title="🎵 Current Queue", color=discord.Color.blue())
 
-    if guild_id_str in CURRENT_TRACKS:
-        current = CURRENT_TRACKS[guild_id_str]
+    if current is not None:
         embed.add_field(
             name="▶️ Now Playing",
             value=
-            f"**{current['title']}** ({format_duration(current['duration'])})",
+            f"**{current.title}** ({format_duration(current.duration)})",
             inline=False)
 
-    queue_list = list(SONG_QUEUES[guild_id_str])
+    start = page * QUEUE_PAGE_SIZE
     queue_text = ""
+    for i, track in enumerate(queue.slice(start, start + QUEUE_PAGE_SIZE), start + 1):
+        duration_str = format_duration(track.duration) if track.duration else "Unknown"
+        # Keep a full page inside Discord's 1024-character field limit
+        title = track.title if len(track.title) <= 80 else track.title[:79] + "…"
+        queue_text += f"{i}. **{title}** ({duration_str})\n"
+
+    embed.add_field(name="📋 Queue", value=queue_text or "Empty", inline=False)
+    embed.add_field(name="⏱️ Total Queue Duration",
+                    value=format_duration(queue.total_duration),
+                    inline=True)
+    embed.add_field(name="🔢 Total Songs",
+                    value=str(len(queue)),
+                    inline=True)
+    embed.set_footer(text=f"Page {page + 1}/{page_count}")
+
+    QUEUE_PAGE_CACHE.set(cache_key, embed)
+    return embed, page, page_count
+
+
+class QueueView(discord.ui.View):
+    """Page buttons for /queue; every press edits the same message"""
+
+    def __init__(self, guild_id, page=0):
+        super().__init__(timeout=QUEUE_VIEW_TIMEOUT)
+        self.guild_id = guild_id
+        self.page = page
+        self.page_count = 1
+        self.message = None
+
+    def render(self):
+        session = find_session(self.guild_id)
+        if session is None or not session.queue:
+            return None
+        embed, self.page, self.page_count = render_queue_page(session, self.page)
+        self.first_page.disabled = self.previous_page.disabled = self.page == 0
+        self.next_page.disabled = self.last_page.disabled = self.page >= self.page_count - 1
+        return embed
+
+    async def show(self, interaction, page):
+        self.page = page
+        embed = self.render()
+        if embed is None:
+            self.stop()
+            return await interaction.response.edit_message(
+                content="❌ Queue is empty.", embed=None, view=None)
+        await interaction.response.edit_message(embed=embed, view=self)
+
+    @discord.ui.button(emoji="⏮️", style=discord.ButtonStyle.secondary)
+    async def first_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self.show(interaction, 0)
+
+    @discord.ui.button(emoji="◀️", style=discord.ButtonStyle.secondary)
+    async def previous_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self.show(interaction, self.page - 1)
+
+    @discord.ui.button(emoji="🔄", style=discord.ButtonStyle.secondary)
+    async def refresh(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self.show(interaction, self.page)
+
+    @discord.ui.button(emoji="▶️", style=discord.ButtonStyle.secondary)
+    async def next_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self.show(interaction, self.page + 1)
+
+    @discord.ui.button(emoji="⏭️", style=discord.ButtonStyle.secondary)
+    async def last_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self.show(interaction, self.page_count - 1)
+
+    async def on_timeout(self):
+        if self.message is not None:
+            try:
+                await self.message.edit(view=None)
+            except discord.HTTPException:
+                pass
 
-    for i, (_, title, duration) in enumerate(queue_list[:10]):
-        duration_str = format_duration(duration) if duration else "Unknown"
-        queue_text += f"{i+1}. **{title}** ({duration_str})\n"
 
-    if queue_list:
-        if len(queue_list) > 10:
-            queue_text += f"... and {len(queue_list) - 10} more songs"
+@bot.tree.command(name="queue", description="Show the current queue")
+@app_commands.describe(page="Page to open at (1-based)")
+async def queue(interaction: discord.Interaction, page: int = 1):
+    session = find_session(interaction.guild_id)
 
-        embed.add_field(name="📋 Queue", value=queue_text, inline=False)
-        total_duration = calculate_queue_time(interaction.guild_id)
-        embed.add_field(name="⏱️ Total Queue Duration",
-                        value=format_duration(total_duration),
-                        inline=True)
-        embed.add_field(name="🔢 Total Songs",
-                        value=str(len(queue_list)),
-                        inline=True)
+    if session is None or not session.queue:
+        return await interaction.response.send_message("❌ Queue is empty.")
 
-    await interaction.response.send_message(embed=embed)
+    view = QueueView(interaction.guild_id, page - 1)
+    embed = view.render()
+    if view.page_count == 1:
+        return await interaction.response.send_message(embed=embed)
+
+    await interaction.response.send_message(embed=embed, view=view)
+    view.message = await interaction.original_response()
 
 
 @bot.tree.command(name="clearqueue", description="Clear the current queue")
 async def clear_queue(interaction: discord.Interaction):
-    guild_id_str = str(interaction.guild_id)
+    session = find_session(interaction.guild_id)
 
-    if guild_id_str not in SONG_QUEUES or not SONG_QUEUES[guild_id_str]:
+    if session is None or not session.queue:
         return await interaction.response.send_message(
             "❌ Queue is already empty.")
 
-    SONG_QUEUES[guild_id_str].clear()
+    session.queue.clear()
+    cancel_prefetch(interaction.guild_id)
+    cancel_transition(interaction.guild_id)
+    cancel_import(interaction.guild_id)
     await interaction.response.send_message("🧹 Queue has been cleared.")
 
 
+@bot.tree.command(name="remove", description="Remove a song from the queue")
+@app_commands.describe(position="Position in the queue (1-based)")
+async def remove(interaction: discord.Interaction, position: int):
+    session = find_session(interaction.guild_id)
+
+    if session is None or not session.queue:
+        return await interaction.response.send_message("❌ Queue is empty.")
+
+    if position < 1 or position > len(session.queue):
+        return await interaction.response.send_message(
+            f"❌ Invalid position. Queue has {len(session.queue)} songs.")
+
+    track = session.queue.pop(position - 1)
+    if position <= PREFETCH_DEPTH:
+        schedule_prefetch(interaction.guild_id, restart=True)
+    if position == 1:
+        cancel_transition(interaction.guild_id)
+    await interaction.response.send_message(
+        f"🗑️ Removed **{track.title}** from the queue.")
+
+
+@bot.tree.command(name="move", description="Move a song to another queue position")
+@app_commands.describe(source="Current position (1-based)",
+                       destination="New position (1-based)")
+async def move(interaction: discord.Interaction, source: int, destination: int):
+    session = find_session(interaction.guild_id)
+
+    if session is None or not session.queue:
+        return await interaction.response.send_message("❌ Queue is empty.")
+
+    queue_size = len(session.queue)
+    if not (1 <= source <= queue_size and 1 <= destination <= queue_size):
+        return await interaction.response.send_message(
+            f"❌ Invalid position. Queue has {queue_size} songs.")
+
+    track = session.queue.move(source - 1, destination - 1)
+    if min(source, destination) <= PREFETCH_DEPTH:
+        schedule_prefetch(interaction.guild_id, restart=True)
+    if min(source, destination) == 1:
+        cancel_transition(interaction.guild_id)
+    await interaction.response.send_message(
+        f"↕️ Moved **{track.title}** to position {destination}.")
+
+
 @bot.tree.command(name="queuetime",
                   description="Estimate total time for the current queue")
 async def queue_time_estimator(interaction: discord.Interaction):
-    guild_id_str = str(interaction.guild_id)
+    session = find_session(interaction.guild_id)
 
-    if guild_id_str not in SONG_QUEUES or not SONG_QUEUES[guild_id_str]:
+    if session is None or not session.queue:
         return await interaction.response.send_message("❌ Queue is empty.")
 
     total_duration = calculate_queue_time(interaction.guild_id)
@@ -631,7 +3235,7 @@ async def queue_time_estimator(interaction: discord.Interaction):
                     value=f"~{completion_str}",
                     inline=True)
     embed.add_field(name="Queue Size",
-                    value=f"{len(SONG_QUEUES[guild_id_str])} songs",
+                    value=f"{len(session.queue)} songs",
                     inline=True)
 
     await interaction.response.send_message(embed=embed)
@@ -661,26 +3265,19 @@ async def song_request(interaction: discord.Interaction, song_query: str):
                     "❌ Voice channel is locked. Cannot join your channel.")
         await voice_client.move_to(voice_channel)
 
-    if guild_id_str not in SONG_QUEUES:
-        SONG_QUEUES[guild_id_str] = deque()
+    session = get_session(interaction.guild_id)
 
     query = "ytsearch1:" + song_query
 
     try:
-        results = await search_ytdlp_async(query, ydl_opts_base)
-
-        if "entries" in results:
-            tracks = results["entries"]
-            if not tracks:
-                return await interaction.followup.send(
-                    "❌ No results found for your request.")
-            first_track = tracks[0]
-        else:
-            first_track = results
+        info = await resolve_track_metadata(query)
+        if not info:
+            return await interaction.followup.send(
+                "❌ No results found for your request.")
 
-        info = get_track_info(first_track)
-        SONG_QUEUES[guild_id_str].append(
-            (info["url"], info["title"], info["duration"]))
+        session.queue.append(
+            Track(info["key"], info["title"], info["duration"]))
+        schedule_prefetch(interaction.guild_id)
 
         embed = discord.Embed(
             title="🎵 Song Request Added",
@@ -693,8 +3290,8 @@ async def song_request(interaction: discord.Interaction, song_query: str):
                             value=format_duration(info["duration"]),
                             inline=True)
 
-        queue_position = len(SONG_QUEUES[guild_id_str])
-        if voice_client.is_playing() or voice_client.is_paused():
+        queue_position = len(session.queue)
+        if is_voice_active(voice_client):
             embed.add_field(name="Queue Position",
                             value=str(queue_position),
                             inline=True)
@@ -708,7 +3305,7 @@ async def song_request(interaction: discord.Interaction, song_query: str):
 
         await interaction.followup.send(embed=embed)
 
-        if not voice_client.is_playing() and not voice_client.is_paused():
+        if not is_voice_active(voice_client):
             await play_next_song(voice_client, interaction.guild_id,
                                  interaction.channel)
 
@@ -735,13 +3332,11 @@ async def volume(interaction: discord.Interaction, level: int):
         return await interaction.response.send_message(
             "❌ Volume must be between 1 and 100.")
 
-    guild_id_str = str(interaction.guild_id)
-    VOLUME_LEVELS[guild_id_str] = level / 100.0
+    get_session(interaction.guild_id).volume = level / 100.0
 
     voice_client = interaction.guild.voice_client
-    if voice_client and voice_client.source and isinstance(
-            voice_client.source, discord.PCMVolumeTransformer):
-        voice_client.source.volume = VOLUME_LEVELS[guild_id_str]
+    if voice_client and is_voice_active(voice_client):
+        schedule_respawn(interaction.guild_id, voice_client)
 
     volume_bars = "▓" * (level // 5) + "░" * ((100 - level) // 5)
     await interaction.response.send_message(
@@ -768,8 +3363,7 @@ async def volume_balance(interaction: discord.Interaction, left: int,
         return await interaction.response.send_message(
             "❌ Channel volumes must be between 0 and 100.")
 
-    guild_id_str = str(interaction.guild_id)
-    AUDIO_BALANCE[guild_id_str] = (left / 100.0, right / 100.0)
+    get_session(interaction.guild_id).balance = (left / 100.0, right / 100.0)
 
     await interaction.response.send_message(
         f"⚖️ Audio balance set to L: {left}% | R: {right}%\n" +
@@ -789,23 +3383,24 @@ async def equalizer(interaction: discord.Interaction):
 
 @bot.tree.command(name="bassboost", description="Toggle bass boost effect")
 async def bass_boost(interaction: discord.Interaction):
-    guild_id_str = str(interaction.guild_id)
-
-    if guild_id_str not in FILTERS:
-        FILTERS[guild_id_str] = []
+    if "bassboost" not in SUPPORTED_FILTERS:
+        return await interaction.response.send_message(
+            "❌ Bass boost isn't supported by this bot's FFmpeg.")
 
-    if "bassboost" in FILTERS[guild_id_str]:
-        FILTERS[guild_id_str].remove("bassboost")
+    session = get_session(interaction.guild_id)
+    if "bassboost" in session.filters:
+        session.filters.remove("bassboost")
         status = "disabled"
     else:
-        FILTERS[guild_id_str].append("bassboost")
+        session.filters.append("bassboost")
         status = "enabled"
 
     voice_client = interaction.guild.voice_client
 
-    if voice_client and voice_client.is_playing():
+    if voice_client and is_voice_active(voice_client):
+        schedule_respawn(interaction.guild_id, voice_client)
         await interaction.response.send_message(
-            f"🔊 Bass boost {status}. Effect will apply to the next song.")
+            f"🔊 Bass boost {status}. Applying to the current song...")
     else:
         await interaction.response.send_message(f"🔊 Bass boost {status}.")
 
@@ -814,12 +3409,21 @@ async def bass_boost(interaction: discord.Interaction):
     name="nightcore",
     description="Toggle nightcore effect (increases speed and pitch)")
 async def nightcore(interaction: discord.Interaction):
-    guild_id_str = str(interaction.guild_id)
-    NIGHTCORE_ENABLED[guild_id_str] = not NIGHTCORE_ENABLED.get(
-        guild_id_str, False)
-    status = "enabled" if NIGHTCORE_ENABLED[guild_id_str] else "disabled"
-    await interaction.response.send_message(
-        f"🎛️ Nightcore effect {status}. Effect will apply to the next song.")
+    if "nightcore" not in SUPPORTED_FILTERS:
+        return await interaction.response.send_message(
+            "❌ Nightcore isn't supported by this bot's FFmpeg.")
+    session = get_session(interaction.guild_id)
+    session.nightcore = not session.nightcore
+    status = "enabled" if session.nightcore else "disabled"
+
+    voice_client = interaction.guild.voice_client
+    if voice_client and is_voice_active(voice_client):
+        schedule_respawn(interaction.guild_id, voice_client)
+        await interaction.response.send_message(
+            f"🎛️ Nightcore effect {status}. Applying to the current song...")
+    else:
+        await interaction.response.send_message(
+            f"🎛️ Nightcore effect {status}.")
 
 
 @bot.tree.command(name="crossfade",
@@ -839,10 +3443,9 @@ async def crossfade(interaction: discord.Interaction, duration: int):
 
 @bot.tree.command(name="visualize", description="Toggle audio visualization")
 async def audio_visualization(interaction: discord.Interaction):
-    guild_id_str = str(interaction.guild_id)
-    VISUALIZER_ACTIVE[guild_id_str] = not VISUALIZER_ACTIVE.get(
-        guild_id_str, False)
-    status = "enabled" if VISUALIZER_ACTIVE[guild_id_str] else "disabled"
+    session = get_session(interaction.guild_id)
+    session.visualizer = not session.visualizer
+    status = "enabled" if session.visualizer else "disabled"
     await interaction.response.send_message(
         f"📊 Audio visualization {status}.\n" +
         "This would display a visual representation of the audio in a full implementation."
@@ -855,51 +3458,327 @@ async def audio_visualization(interaction: discord.Interaction):
 async def create_playlist(interaction: discord.Interaction, name: str):
     user_id_str = str(interaction.user.id)
 
-    if user_id_str not in CUSTOM_PLAYLISTS:
-        CUSTOM_PLAYLISTS[user_id_str] = {}
-
-    if name in CUSTOM_PLAYLISTS[user_id_str]:
+    if not await run_data_store(playlist_store.create, user_id_str, name):
         return await interaction.response.send_message(
             f"❌ You already have a playlist named '{name}'.")
 
-    CUSTOM_PLAYLISTS[user_id_str][name] = []
-    save_data()
     await interaction.response.send_message(
         f"📝 Created new playlist: **{name}**")
 
 
+@bot.tree.command(name="deleteplaylist",
+                  description="Delete one of your playlists")
+@app_commands.describe(playlist_name="Name of the playlist to delete")
+async def delete_playlist(interaction: discord.Interaction, playlist_name: str):
+    user_id_str = str(interaction.user.id)
+
+    deleted = await run_data_store(playlist_store.delete, user_id_str, playlist_name)
+    if deleted is None:
+        return await interaction.response.send_message(
+            f"❌ You don't have a playlist named '{playlist_name}'.")
+
+    await interaction.response.send_message(
+        f"🗑️ Deleted playlist '{playlist_name}' ({deleted} songs).")
+
+
 @bot.tree.command(name="addtoplaylist",
                   description="Add current song to a playlist")
 @app_commands.describe(playlist_name="Name of your playlist")
 async def add_to_playlist(interaction: discord.Interaction,
                           playlist_name: str):
     user_id_str = str(interaction.user.id)
-    guild_id_str = str(interaction.guild_id)
 
-    if user_id_str not in CUSTOM_PLAYLISTS:
+    session = find_session(interaction.guild_id)
+    if session is None or session.current is None:
         return await interaction.response.send_message(
-            "❌ You don't have any playlists. Create one first with `/createplaylist`."
-        )
+            "❌ Nothing is currently playing to add to playlist.")
+
+    current = session.current
+    added = await run_data_store(
+        playlist_store.append, user_id_str, playlist_name,
+        [saved_track_row(current.ref, current.title, current.duration)])
+    if added is None:
+        return await interaction.response.send_message(
+            f"❌ You don't have a playlist named '{playlist_name}'. "
+            "Create one first with `/createplaylist`.")
+
+    await interaction.response.send_message(
+        f"✅ Added **{current.title}** to playlist '{playlist_name}'.")
+
+
+class PlaylistView(discord.ui.View):
+    """Page buttons for /viewplaylist; pages are read by position cursor"""
+
+    def __init__(self, user_id_str, name):
+        super().__init__(timeout=QUEUE_VIEW_TIMEOUT)
+        self.user_id_str = user_id_str
+        self.name = name
+        self.start = 0  # number of entries before this page
+        self.size = 0
+        self.entries = []
+        self.message = None
+
+    async def load(self, after=None, before=None):
+        """Read a page; False if the playlist is gone"""
+        result = await run_data_store(playlist_store.page, self.user_id_str, self.name,
+                                      PLAYLIST_PAGE_SIZE, after, before)
+        if result is None:
+            return False
+        self.size, self.entries = result
+        return True
+
+    def render(self):
+        lines = []
+        for i, (entry_id, _, _, title, duration, dead) in enumerate(self.entries,
+                                                                     self.start + 1):
+            title = title or "Unknown"
+            title = title if len(title) <= 80 else title[:79] + "…"
+            duration_str = format_duration(duration) if duration else "Unknown"
+            mark = "~~" if dead else "**"
+            lines.append(f"{i}. {mark}{title}{mark} ({duration_str}) `#{entry_id}`")
+
+        self.first_page.disabled = self.previous_page.disabled = self.start == 0
+        self.next_page.disabled = self.last_page.disabled = (
+            self.start + len(self.entries) >= self.size)
+        embed = discord.Embed(title=f"🎼 {self.name}",
+                              description="\n".join(lines) or "Empty",
+                              color=discord.Color.blue())
+        page_count = max(1, -(-self.size // PLAYLIST_PAGE_SIZE))
+        page = min(self.start // PLAYLIST_PAGE_SIZE + 1, page_count)
+        embed.set_footer(text=f"Page {page}/{page_count} • {self.size} songs • "
+                              "#numbers are for /removefromplaylist and /moveinplaylist")
+        return embed
+
+    async def show(self, interaction, after=None, before=None, start=0):
+        if not await self.load(after, before):
+            self.stop()
+            return await interaction.response.edit_message(
+                content=f"❌ Playlist '{self.name}' no longer exists.", embed=None, view=None)
+        self.start = max(0, min(start, self.size - len(self.entries)))
+        await interaction.response.edit_message(embed=self.render(), view=self)
+
+    @discord.ui.button(emoji="⏮️", style=discord.ButtonStyle.secondary)
+    async def first_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self.show(interaction)
+
+    @discord.ui.button(emoji="◀️", style=discord.ButtonStyle.secondary)
+    async def previous_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        if not self.entries:
+            return await self.show(interaction)
+        await self.show(interaction, before=self.entries[0][1],
+                        start=self.start - PLAYLIST_PAGE_SIZE)
+
+    @discord.ui.button(emoji="▶️", style=discord.ButtonStyle.secondary)
+    async def next_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        if not self.entries:
+            return await self.show(interaction)
+        await self.show(interaction, after=self.entries[-1][1],
+                        start=self.start + len(self.entries))
+
+    @discord.ui.button(emoji="⏭️", style=discord.ButtonStyle.secondary)
+    async def last_page(self, interaction: discord.Interaction, button: discord.ui.Button):
+        await self.show(interaction, before=float("inf"), start=self.size)
+
+    async def on_timeout(self):
+        if self.message is not None:
+            try:
+                await self.message.edit(view=None)
+            except discord.HTTPException:
+                pass
+
+
+@bot.tree.command(name="viewplaylist",
+                  description="List your playlists or browse one page by page")
+@app_commands.describe(playlist_name="Playlist to show (leave empty to list all)")
+async def view_playlist(interaction: discord.Interaction,
+                        playlist_name: Optional[str] = None):
+    user_id_str = str(interaction.user.id)
 
-    if playlist_name not in CUSTOM_PLAYLISTS[user_id_str]:
+    if playlist_name is None:
+        playlists = await run_data_store(playlist_store.list_playlists, user_id_str)
+        if not playlists:
+            return await interaction.response.send_message(
+                "❌ You don't have any playlists. Create one first with `/createplaylist`.")
+        lines = [f"• **{name}** ({size} songs)" for name, size in playlists]
+        embed = discord.Embed(title="🎼 Your Playlists", description="\n".join(lines)[:4000],
+                              color=discord.Color.blue())
+        return await interaction.response.send_message(embed=embed)
+
+    view = PlaylistView(user_id_str, playlist_name)
+    if not await view.load():
         return await interaction.response.send_message(
             f"❌ You don't have a playlist named '{playlist_name}'.")
 
-    if guild_id_str not in CURRENT_TRACKS:
+    embed = view.render()
+    if view.size <= PLAYLIST_PAGE_SIZE:
+        return await interaction.response.send_message(embed=embed)
+
+    await interaction.response.send_message(embed=embed, view=view)
+    view.message = await interaction.original_response()
+
+
+@bot.tree.command(name="removefromplaylist",
+                  description="Remove a song from one of your playlists")
+@app_commands.describe(playlist_name="Name of your playlist",
+                       entry="The song's #number from /viewplaylist")
+async def remove_from_playlist(interaction: discord.Interaction,
+                               playlist_name: str, entry: int):
+    user_id_str = str(interaction.user.id)
+
+    try:
+        title = await run_data_store(playlist_store.remove, user_id_str,
+                                     playlist_name, entry)
+    except IndexError:
         return await interaction.response.send_message(
-            "❌ Nothing is currently playing to add to playlist.")
+            f"❌ There is no song #{entry} in '{playlist_name}'.")
+    if title is None:
+        return await interaction.response.send_message(
+            f"❌ You don't have a playlist named '{playlist_name}'.")
 
-    current = CURRENT_TRACKS[guild_id_str]
-    song_info = {
-        "url": current["url"],
-        "title": current["title"],
-        "duration": current["duration"]
-    }
+    await interaction.response.send_message(
+        f"🗑️ Removed **{title}** from playlist '{playlist_name}'.")
 
-    CUSTOM_PLAYLISTS[user_id_str][playlist_name].append(song_info)
-    save_data()
+
+@bot.tree.command(name="moveinplaylist",
+                  description="Move a song to another place in a playlist")
+@app_commands.describe(playlist_name="Name of your playlist",
+                       entry="The song's #number from /viewplaylist",
+                       before="#number of the song to put it in front of (leave empty for the end)")
+async def move_in_playlist(interaction: discord.Interaction, playlist_name: str,
+                           entry: int, before: Optional[int] = None):
+    user_id_str = str(interaction.user.id)
+
+    try:
+        title = await run_data_store(playlist_store.move, user_id_str, playlist_name,
+                                     entry, before)
+    except IndexError:
+        return await interaction.response.send_message(
+            f"❌ '{playlist_name}' has no song with that #number.")
+    if title is None:
+        return await interaction.response.send_message(
+            f"❌ You don't have a playlist named '{playlist_name}'.")
+
+    where = f"in front of #{before}" if before is not None else "to the end"
+    await interaction.response.send_message(
+        f"↕️ Moved **{title}** {where} in '{playlist_name}'.")
+
+
+@bot.tree.command(name="exportplaylist",
+                  description="Download one of your playlists as a file")
+@app_commands.describe(playlist_name="Name of the playlist to export")
+async def export_playlist(interaction: discord.Interaction, playlist_name: str):
+    user_id_str = str(interaction.user.id)
+
+    entries = await run_data_store(playlist_store.entries, user_id_str, playlist_name)
+    if entries is None:
+        return await interaction.response.send_message(
+            f"❌ You don't have a playlist named '{playlist_name}'.")
+
+    data = {
+        "name": playlist_name,
+        "tracks": [{"ref": entry["ref"], "title": entry["title"],
+                    "duration": entry["duration"], "url": entry["url"]}
+                   for entry in entries]
+    }
+    file = discord.File(io.BytesIO(json.dumps(data, indent=1).encode()),
+                        filename=f"{playlist_name}.json")
     await interaction.response.send_message(
-        f"✅ Added **{current['title']}** to playlist '{playlist_name}'.")
+        f"📤 Playlist '{playlist_name}' ({len(entries)} songs):", file=file)
+
+
+def parse_playlist_file(content):
+    """Saved-track rows from an /exportplaylist file or a list of links, one per line
+
+    None for a JSON object that isn't a playlist export.
+    """
+    text = content.decode("utf-8", errors="replace")
+    try:
+        data = json.loads(text)
+    except json.JSONDecodeError:
+        data = None
+
+    if isinstance(data, dict):
+        tracks = data.get("tracks")
+        if not isinstance(tracks, list) or not all(isinstance(track, dict) for track in tracks):
+            return None
+        rows = []
+        for track in tracks:
+            ref, title, duration = track.get("ref"), track.get("title"), track.get("duration")
+            ref = ref if isinstance(ref, str) and ref else None
+            title = title if isinstance(title, str) and title else None
+            if ref is None and title is None:
+                continue
+            if not isinstance(duration, (int, float)) or isinstance(duration, bool):
+                duration = None
+            rows.append(saved_track_row(ref or "ytsearch1:" + title, title or ref, duration))
+        return rows
+
+    rows = []
+    for line in text.splitlines():
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        alias = canonicalize_query(line)
+        if alias.startswith("youtube:"):
+            ref = alias[len("youtube:"):]
+        elif line.startswith("http"):
+            ref = line
+        else:
+            ref = "ytsearch1:" + line
+        # Real titles are filled in the first time the playlist is played
+        rows.append(saved_track_row(ref, line, None))
+    return rows
+
+
+@bot.tree.command(name="importplaylist",
+                  description="Add songs to a playlist from a file or a YouTube playlist")
+@app_commands.describe(playlist_name="Playlist to add to (created if missing)",
+                       file="A file from /exportplaylist, or one link per line",
+                       url="A YouTube playlist or mix URL")
+async def import_saved_playlist(interaction: discord.Interaction, playlist_name: str,
+                                file: Optional[discord.Attachment] = None,
+                                url: Optional[str] = None):
+    user_id_str = str(interaction.user.id)
+
+    if (file is None) == (url is None):
+        return await interaction.response.send_message(
+            "❌ Give either a file or a playlist URL.")
+    await interaction.response.defer()
+
+    if file is not None:
+        if file.size > PLAYLIST_IMPORT_MAX_BYTES:
+            return await interaction.followup.send("❌ That file is too large to import.")
+        rows = parse_playlist_file(await file.read())
+        if rows is None:
+            return await interaction.followup.send("❌ That file isn't a playlist export.")
+    else:
+        if not playlist_url_id(url):
+            return await interaction.followup.send("❌ That isn't a YouTube playlist URL.")
+        items = []
+        loop = asyncio.get_running_loop()
+        try:
+            listed = await loop.run_in_executor(
+                YTDL_EXECUTOR, _stream_playlist, url, IMPORT_MAX_ENTRIES, threading.Event(),
+                lambda batch: items.extend(batch[1]))
+        except Exception as e:
+            return await interaction.followup.send(f"❌ Error: {str(e)}")
+        if listed is None:
+            return await interaction.followup.send("❌ That isn't a YouTube playlist URL.")
+        rows = []
+        for item in items:
+            info = _flat_entry_info(item)
+            if info["title"] in UNAVAILABLE_TITLES or not info["webpage_url"]:
+                continue
+            rows.append(saved_track_row(track_cache_key(info), info["title"], info["duration"]))
+
+    rows = rows[:IMPORT_MAX_ENTRIES]
+    if not rows:
+        return await interaction.followup.send("❌ No songs found to import.")
+
+    size = await run_data_store(playlist_store.append, user_id_str, playlist_name,
+                                rows, True)
+    await interaction.followup.send(
+        f"📥 Imported {len(rows)} songs into '{playlist_name}' (now {size} songs).")
 
 
 @bot.tree.command(name="playlist",
@@ -911,15 +3790,12 @@ async def play_playlist(interaction: discord.Interaction, playlist_name: str):
     user_id_str = str(interaction.user.id)
     guild_id_str = str(interaction.guild_id)
 
-    if user_id_str not in CUSTOM_PLAYLISTS:
-        return await interaction.followup.send(
-            "❌ You don't have any playlists.")
-
-    if playlist_name not in CUSTOM_PLAYLISTS[user_id_str]:
+    playlist = await run_data_store(playlist_store.entries, user_id_str, playlist_name)
+    if playlist is None:
         return await interaction.followup.send(
             f"❌ You don't have a playlist named '{playlist_name}'.")
 
-    if not CUSTOM_PLAYLISTS[user_id_str][playlist_name]:
+    if not playlist:
         return await interaction.followup.send(
             f"❌ Playlist '{playlist_name}' is empty.")
 
@@ -939,44 +3815,48 @@ async def play_playlist(interaction: discord.Interaction, playlist_name: str):
                     "❌ Voice channel is locked.")
         await voice_client.move_to(voice_channel)
 
-    if guild_id_str not in SONG_QUEUES:
-        SONG_QUEUES[guild_id_str] = deque()
-
-    playlist = CUSTOM_PLAYLISTS[user_id_str][playlist_name]
-    added_count = 0
-
-    for song in playlist:
-        SONG_QUEUES[guild_id_str].append(
-            (song["url"], song["title"], song["duration"]))
-        added_count += 1
-
-    if not voice_client.is_playing() and not voice_client.is_paused():
-        await play_next_song(voice_client, interaction.guild_id,
-                             interaction.channel)
-
-    await interaction.followup.send(
-        f"🎵 Added {added_count} songs from playlist '{playlist_name}' to the queue."
-    )
+    session = get_session(interaction.guild_id)
+    if session.import_cancel is not None:
+        return await interaction.followup.send(
+            "❌ A playlist is already being loaded in this server.")
+
+    if not is_voice_active(voice_client):
+        session.play_requested_at = time.perf_counter()
+    await interaction.edit_original_response(
+        content=f"⏳ Loading playlist '{playlist_name}'...")
+    added_count, dead, updates = await load_saved_playlist(
+        interaction, session, voice_client, playlist_name, playlist)
+    if updates:
+        await run_data_store(playlist_store.update_entries, user_id_str,
+                             playlist_name, updates)
+
+    message = f"🎵 Added {added_count} songs from playlist '{playlist_name}' to the queue."
+    if dead:
+        shown = ", ".join(f"**{title}**" for title in dead[:DEAD_ENTRIES_SHOWN])
+        if len(dead) > DEAD_ENTRIES_SHOWN:
+            shown += f" and {len(dead) - DEAD_ENTRIES_SHOWN} more"
+        message += f"\n⚠️ {len(dead)} unavailable and marked dead: {shown}"
+    await interaction.edit_original_response(content=message)
 
 
 @bot.tree.command(
     name="trackinfo",
     description="Show detailed information about the current track")
 async def track_info(interaction: discord.Interaction):
-    guild_id_str = str(interaction.guild_id)
+    session = find_session(interaction.guild_id)
 
-    if guild_id_str not in CURRENT_TRACKS:
+    if session is None or session.current is None:
         return await interaction.response.send_message(
             "❌ Nothing is currently playing.")
 
-    current = CURRENT_TRACKS[guild_id_str]
-    elapsed = time.time() - current["started_at"]
+    current = session.current
+    elapsed = time.time() - session.started_at
     elapsed_str = format_duration(elapsed)
     duration_str = format_duration(
-        current["duration"]) if current["duration"] else "Unknown"
+        current.duration) if current.duration else "Unknown"
 
     embed = discord.Embed(title="🎵 Track Information",
-                          description=f"**{current['title']}**",
+                          description=f"**{current.title}**",
                           color=discord.Color.blue())
     embed.add_field(name="Time",
                     value=f"{elapsed_str} / {duration_str}",
@@ -987,15 +3867,15 @@ async def track_info(interaction: discord.Interaction):
 @bot.tree.command(name="lyrics",
                   description="Show lyrics for the current song (placeholder)")
 async def lyrics(interaction: discord.Interaction):
-    guild_id_str = str(interaction.guild_id)
+    session = find_session(interaction.guild_id)
 
-    if guild_id_str not in CURRENT_TRACKS:
+    if session is None or session.current is None:
         return await interaction.response.send_message(
             "❌ Nothing is currently playing.")
 
-    current = CURRENT_TRACKS[guild_id_str]
+    current = session.current
     await interaction.response.send_message(
-        f"🎵 Lyrics for **{current['title']}**\n\n" +
+        f"🎵 Lyrics for **{current.title}**\n\n" +
         "In a full implementation, this would fetch lyrics from a lyrics API or database."
     )
 
@@ -1017,34 +3897,58 @@ async def rate_song(interaction: discord.Interaction, rating: int):
         return await interaction.response.send_message(
             "❌ Rating must be between 1 and 5 stars.")
 
-    guild_id_str = str(interaction.guild_id)
     user_id_str = str(interaction.user.id)
 
-    if guild_id_str not in CURRENT_TRACKS:
+    session = find_session(interaction.guild_id)
+    if session is None or session.current is None:
         return await interaction.response.send_message(
             "❌ Nothing is currently playing to rate.")
 
-    current = CURRENT_TRACKS[guild_id_str]
-    song_id = current.get("url", "")
+    current = session.current
+    key = QUERY_CACHE.peek(canonicalize_query(track_key_query(current.ref))) or current.ref
+    count, total = await run_data_store(rating_store.rate, key, current.title, user_id_str,
+                                        str(interaction.guild_id), rating)
 
-    if song_id:
-        if song_id not in SONG_RATINGS:
-            SONG_RATINGS[song_id] = {}
+    avg_rating = total / count
+    stars = "⭐" * rating
 
-        SONG_RATINGS[song_id][user_id_str] = rating
-        save_data()
+    await interaction.response.send_message(
+        f"Thank you for rating **{current.title}**!\n" +
+        f"Your rating: {stars} ({rating}/5)\n" +
+        f"Average rating: {avg_rating:.1f}/5 from {count} ratings")
 
-        ratings = SONG_RATINGS[song_id].values()
-        avg_rating = sum(ratings) / len(ratings)
-        stars = "⭐" * rating
 
-        await interaction.response.send_message(
-            f"Thank you for rating **{current['title']}**!\n" +
-            f"Your rating: {stars} ({rating}/5)\n" +
-            f"Average rating: {avg_rating:.1f}/5 from {len(ratings)} ratings")
+@bot.tree.command(name="toprated",
+                  description="Show the best-rated songs in this server or everywhere")
+@app_commands.describe(scope="Leaderboard to show")
+@app_commands.choices(scope=[
+    app_commands.Choice(name="This server", value="server"),
+    app_commands.Choice(name="Global", value="global")
+])
+async def top_rated(interaction: discord.Interaction, scope: str = "server"):
+    if scope == "global":
+        guild_id_str = None
+        title = "🏆 Top Rated Songs"
     else:
-        await interaction.response.send_message(
-            "❌ Could not identify the current song to rate.")
+        guild_id_str = str(interaction.guild_id)
+        title = f"🏆 Top Rated Songs in {interaction.guild.name}"
+
+    leaderboard = await run_data_store(rating_store.top, TOPRATED_SIZE,
+                                       TOPRATED_MIN_RATINGS, guild_id_str)
+    if not leaderboard:
+        return await interaction.response.send_message(
+            f"❌ No songs have {TOPRATED_MIN_RATINGS} or more ratings yet.")
+
+    lines = []
+    for i, (key, song_title, average, count) in enumerate(leaderboard, 1):
+        song_title = song_title or key
+        song_title = song_title if len(song_title) <= 80 else song_title[:79] + "…"
+        lines.append(f"{i}. **{song_title}** ⭐ {average:.2f} ({count} ratings)")
+
+    embed = discord.Embed(title=title, description="\n".join(lines),
+                          color=discord.Color.gold())
+    embed.set_footer(text=f"Songs with at least {TOPRATED_MIN_RATINGS} ratings")
+    await interaction.response.send_message(embed=embed)
 
 
 @bot.tree.command(
@@ -1060,9 +3964,9 @@ async def dj_mode(interaction: discord.Interaction, enabled: bool):
 
 @bot.tree.command(name="game", description="Start a music guessing game")
 async def music_game(interaction: discord.Interaction):
-    guild_id_str = str(interaction.guild_id)
+    session = get_session(interaction.guild_id)
 
-    if guild_id_str in ACTIVE_GAME_SESSIONS:
+    if session.game is not None:
         return await interaction.response.send_message(
             "❌ A music game is already in progress.")
 
@@ -1071,7 +3975,7 @@ async def music_game(interaction: discord.Interaction):
         "In a full implementation, this would play short clips of songs and users would guess the title/artist."
     )
 
-    ACTIVE_GAME_SESSIONS[guild_id_str] = {
+    session.game = {
         "active": True,
         "started_by": interaction.user.id
     }
@@ -1112,12 +4016,15 @@ async def leave(interaction: discord.Interaction):
         return await interaction.response.send_message(
             "❌ I'm not in a voice channel.")
 
-    guild_id_str = str(interaction.guild_id)
-    if guild_id_str in SONG_QUEUES:
-        SONG_QUEUES[guild_id_str].clear()
+    session = find_session(interaction.guild_id)
+    if session is not None:
+        session.queue.clear()
+        cancel_prefetch(interaction.guild_id)
+        cancel_transition(interaction.guild_id)
+        cancel_import(interaction.guild_id)
 
-    if voice_client.is_playing() or voice_client.is_paused():
-        voice_client.stop()
+    if is_voice_active(voice_client):
+        stop_voice(voice_client)
 
     await voice_client.disconnect()
     await interaction.response.send_message("👋 Left the voice channel.")
@@ -1135,7 +4042,7 @@ async def lock_channel(interaction: discord.Interaction, enabled: bool):
             "❌ I'm not in a voice channel to lock.")
 
     VOICE_CHANNEL_LOCKS[guild_id_str] = enabled
-    save_data()
+    mark_dirty("voice_channel_locks", guild_id_str)
 
     if enabled:
         channel_name = voice_client.channel.name
@@ -1161,63 +4068,54 @@ async def auto_join(interaction: discord.Interaction, enabled: bool):
 
         voice_channel_id = str(interaction.user.voice.channel.id)
 
-        if user_id_str not in AUTO_JOIN_CHANNELS:
-            AUTO_JOIN_CHANNELS[user_id_str] = {}
-
-        AUTO_JOIN_CHANNELS[user_id_str][guild_id_str] = voice_channel_id
+        await run_data_store(_update_user_setting, "auto_join_channels", user_id_str,
+                             lambda channels: dict(channels or {},
+                                                   **{guild_id_str: voice_channel_id}))
         channel_name = interaction.user.voice.channel.name
 
         await interaction.response.send_message(
             f"🔄 Auto-join enabled for channel '{channel_name}'.")
     else:
-        if user_id_str in AUTO_JOIN_CHANNELS and guild_id_str in AUTO_JOIN_CHANNELS[
-                user_id_str]:
-            del AUTO_JOIN_CHANNELS[user_id_str][guild_id_str]
+        removed = []
 
-            if not AUTO_JOIN_CHANNELS[user_id_str]:
-                del AUTO_JOIN_CHANNELS[user_id_str]
+        def disable(channels):
+            channels = dict(channels or {})
+            if guild_id_str in channels:
+                removed.append(channels.pop(guild_id_str))
+            return channels or None
 
+        await run_data_store(_update_user_setting, "auto_join_channels", user_id_str,
+                             disable)
+        if removed:
             await interaction.response.send_message("🛑 Auto-join disabled.")
         else:
             await interaction.response.send_message(
                 "❌ You don't have auto-join enabled.")
 
-    save_data()
-
 
 @bot.tree.command(
     name="filters",
     description="Apply audio filters to enhance your music experience")
 @app_commands.describe(filter_name="The audio filter to toggle")
 @app_commands.choices(filter_name=[
-    app_commands.Choice(name="Bass Boost", value="bassboost"),
-    app_commands.Choice(name="Nightcore", value="nightcore"),
-    app_commands.Choice(name="8D Audio", value="8d"),
-    app_commands.Choice(name="Vaporwave", value="vaporwave"),
-    app_commands.Choice(name="Tremolo", value="tremolo"),
-    app_commands.Choice(name="Vibrato", value="vibrato"),
-    app_commands.Choice(name="Reverse", value="reverse"),
-    app_commands.Choice(name="Normalizer", value="normalizer"),
-    app_commands.Choice(name="Echo", value="echo")
+    app_commands.Choice(name=FILTER_DISPLAY_NAMES[name], value=name)
+    for name in SUPPORTED_FILTERS
 ])
 async def filters(interaction: discord.Interaction, filter_name: str):
-    guild_id_str = str(interaction.guild_id)
+    session = get_session(interaction.guild_id)
 
-    if guild_id_str not in FILTERS:
-        FILTERS[guild_id_str] = []
-
-    if filter_name in FILTERS[guild_id_str]:
-        FILTERS[guild_id_str].remove(filter_name)
+    if filter_name in session.filters:
+        session.filters.remove(filter_name)
         status = "disabled"
     else:
-        FILTERS[guild_id_str].append(filter_name)
+        session.filters.append(filter_name)
         status = "enabled"
 
     embed = discord.Embed(title="🎛️ Audio Filters",
                           description=f"**{filter_name}** filter {status}",
                           color=discord.Color.blue())
 
-    active_filters = FILTERS[guild_id_str]
+    active_filters = session.filters
     if active_filters:
         embed.add_field(name="Active Filters",
                         value=", ".join(active_filters),
@@ -1225,9 +4123,13 @@ async def filters(interaction: discord.Interaction, filter_name: str):
     else:
         embed.add_field(name="Active Filters", value="None", inline=False)
 
+    voice_client = interaction.guild.voice_client
+    if voice_client and is_voice_active(voice_client):
+        schedule_respawn(interaction.guild_id, voice_client)
+
     embed.set_footer(
         text=
-        "Filters will apply to new songs. Some filters may increase CPU usage."
+        "Filters apply to the current song within a second. Some filters may increase CPU usage."
     )
     await interaction.response.send_message(embed=embed)
 
@@ -1249,8 +4151,8 @@ async def filters(interaction: discord.Interaction, filter_name: str):
 ])
 async def set_language(interaction: discord.Interaction, language_code: str):
     user_id_str = str(interaction.user.id)
-    LANGUAGE_PREFERENCES[user_id_str] = language_code
-    save_data()
+    await run_data_store(_update_user_setting, "language_preferences", user_id_str,
+                         lambda _: language_code)
     language_name = SUPPORTED_LANGUAGES.get(language_code, "Unknown")
     await interaction.response.send_message(
         f"🌐 Language preference set to {language_name}.")
@@ -1282,7 +4184,7 @@ async def help_command(interaction: discord.Interaction):
                           color=discord.Color.blue())
 
     playback_commands = """
-    ▶️ **/play** `<song_query>` - Play a song or add to queue
+    ▶️ **/play** `<song_query>` - Play a song or add to queue (playlist and mix URLs queue every track)
     ⏸️ **/pause** - Pause current song
     ▶️ **/resume** - Resume playback
     ⏹️ **/stop** - Stop playback and clear queue
@@ -1299,8 +4201,10 @@ async def help_command(interaction: discord.Interaction):
                     inline=False)
 
     queue_commands = """
-    📋 **/queue** - Show current queue
+    📋 **/queue** `[page]` - Browse the queue page by page
     🧹 **/clearqueue** - Clear the queue
+    🗑️ **/remove** `<position>` - Remove a song from the queue
+    ↕️ **/move** `<from>` `<to>` - Move a song within the queue
     ⏱️ **/queuetime** - Show estimated queue duration
     🎵 **/nowplaying** - Show current track info
     ℹ️ **/trackinfo** - Detailed track information
@@ -1327,6 +4231,12 @@ async def help_command(interaction: discord.Interaction):
     📝 **/createplaylist** `<name>` - Create new playlist
     ➕ **/addtoplaylist** `<playlist>` - Add current song
     🎼 **/playlist** `<name>` - Play a saved playlist
+    📜 **/viewplaylist** `[name]` - List or browse your playlists
+    🗑️ **/removefromplaylist** `<name>` `<#song>` - Remove a song
+    ↕️ **/moveinplaylist** `<name>` `<#song>` `[before #song]` - Reorder a playlist
+    ❌ **/deleteplaylist** `<name>` - Delete a playlist
+    📤 **/exportplaylist** `<name>` - Download a playlist as a file
+    📥 **/importplaylist** `<name>` `[file]` `[url]` - Import from a file or YouTube playlist
     """
     embed.add_field(name="🎼 Playlists", value=playlist_commands, inline=False)
 
@@ -1341,6 +4251,7 @@ async def help_command(interaction: discord.Interaction):
     fun_commands = """
     📜 **/lyrics** - Show lyrics for current song
     ⭐ **/rate** `<1-5>` - Rate current song
+    🏆 **/toprated** `[scope]` - Best-rated songs in this server or globally
     🎮 **/game** - Start music guessing game
     """
     embed.add_field(name="🎮 Fun & Games", value=fun_commands, inline=False)
@@ -1356,4 +4267,11 @@ async def help_command(interaction: discord.Interaction):
 
 
 if __name__ == "__main__":
+    # Stop on SIGTERM (from the cluster supervisor or a process manager) the
+    # way Ctrl-C does: the bot closes and the flushes below still run
+    signal.signal(signal.SIGTERM, signal.default_int_handler)
     bot.run(TOKEN)
+    save_data()
+    flush_resolution_index_sync()
+    if AUDIO_CACHE is not None:
+        AUDIO_CACHE_EXECUTOR.submit(AUDIO_CACHE.flush).result()
@@ -0,0 +1,171 @@
+"""Prometheus-style metrics for the music bot.
+
+Counters, gauges and histograms rendered in the Prometheus text exposition
+format, and a tiny asyncio HTTP server that answers ``GET /metrics`` on the
+bot's own event loop. Updates take no locks: each is a single small change
+to a dict, and a scrape racing one from the voice thread at worst reports it
+a scrape late. Values the bot already keeps elsewhere are exported through
+gauge callbacks read at scrape time.
+
+Only the standard library is imported, so this can be reused without
+loading the bot.
+"""
+import asyncio
+import bisect
+import math
+
+REGISTRY = []
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+               for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"'
+                          for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+def _format_value(value):
+    if value is None:
+        return "NaN"
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        REGISTRY.append(self)
+
+    def _key(self, labels):
+        if len(labels) != len(self.labelnames):
+            raise ValueError(f"{self.name} takes labels {self.labelnames}")
+        return tuple(str(value) for value in labels)
+
+    def samples(self):
+        return []
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}",
+                 f"# TYPE {self.name} {self.kind}"]
+        for suffix, labels, extra, value in self.samples():
+            lines.append(f"{self.name}{suffix}"
+                         f"{_format_labels(self.labelnames, labels, extra)} "
+                         f"{_format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    """A count that only goes up, kept here or read from a callback at scrape time
+
+    The callback returns a number, or a dict of label tuple -> number.
+    """
+    kind = "counter"
+
+    def __init__(self, name, documentation, labelnames=(), callback=None):
+        super().__init__(name, documentation, labelnames)
+        self.values = {}
+        self.callback = callback
+
+    def inc(self, *labels, amount=1):
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        values = self.values
+        if self.callback is not None:
+            values = self.callback()
+            if not isinstance(values, dict):
+                values = {(): values}
+        return [("", self._key(key), (), value) for key, value in sorted(values.items())]
+
+
+class Gauge(Counter):
+    """A value that can go up and down; set directly or read from a callback"""
+    kind = "gauge"
+
+    def set(self, value, *labels):
+        self.values[self._key(labels)] = value
+
+    def dec(self, *labels, amount=1):
+        self.inc(*labels, amount=-amount)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        self.series = {}  # labels -> [bucket counts..., sum, count]
+
+    def observe(self, value, *labels):
+        key = self._key(labels)
+        series = self.series.get(key)
+        if series is None:
+            series = self.series[key] = [0] * (len(self.buckets) + 2)
+        index = bisect.bisect_left(self.buckets, value)
+        if index < len(self.buckets):
+            series[index] += 1
+        series[-2] += value
+        series[-1] += 1
+
+    def samples(self):
+        samples = []
+        for key, series in sorted(self.series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, series):
+                cumulative += count
+                samples.append(("_bucket", key, (("le", _format_value(float(bound))),),
+                                cumulative))
+            samples.append(("_bucket", key, (("le", "+Inf"),), series[-1]))
+            samples.append(("_sum", key, (), series[-2]))
+            samples.append(("_count", key, (), series[-1]))
+        return samples
+
+
+def render():
+    """Every registered metric in the Prometheus text format"""
+    blocks = []
+    for metric in REGISTRY:
+        try:
+            blocks.append(metric.render())
+        except Exception as e:
+            blocks.append(f"# {metric.name} unavailable: {type(e).__name__}: {e}")
+    return "\n".join(blocks) + "\n"
+
+
+async def _handle_request(reader, writer):
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), 10)
+        # Headers aren't needed; read them off so the client sees a clean close
+        while (await asyncio.wait_for(reader.readline(), 10)).strip():
+            pass
+        parts = request_line.decode("latin-1").split()
+        if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?")[0] == "/metrics":
+            status, body = "200 OK", render().encode()
+            content_type = "text/plain; version=0.0.4; charset=utf-8"
+        else:
+            status, body, content_type = "404 Not Found", b"Not found\n", "text/plain"
+        writer.write(f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+                     f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode()
+                     + body)
+        await writer.drain()
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def start_http_server(host, port):
+    """Serve /metrics on the running event loop"""
+    return await asyncio.start_server(_handle_request, host, port)
@@ -0,0 +1,276 @@
+"""Saved playlist storage for the music bot.
+
+Playlists live in SQLite as ordered rows of track keys, with titles and
+durations kept once per track in a shared table however many playlists
+include it. A playlist's size is stored on its row, so it never needs
+counting.
+
+Entries are addressed by a stable ``entry_id`` rather than by their place in
+the list, and order comes from a REAL ``position`` with an index on
+(playlist, position). Removing an entry or moving it in front of another is
+a few primary-key and index lookups, O(log n). Appends go after the current
+maximum. A moved entry takes the midpoint between its new neighbours, so no
+other rows move. Only when repeated moves use up the gap between two
+neighbours is the playlist renumbered, which is O(n) and rare.
+
+Pages are read by keyset: from a position cursor onwards (or backwards)
+through the same index, so any page costs O(log n + page size). Reaching
+the ordinal n-th entry would need an O(n) scan, so nothing here does that.
+
+Functions take an open connection and commit their own transactions; ones
+that read before they write take the write lock first, so several processes
+can share the database. They return None when the playlist doesn't exist and raise IndexError for an
+entry that isn't in it. Only the standard library is used, so the store can
+be inspected or migrated without loading the bot.
+"""
+
+MIN_GAP = 1e-9
+
+
+def create_schema(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS playlists (
+            playlist_id INTEGER PRIMARY KEY,
+            owner TEXT NOT NULL,
+            name TEXT NOT NULL,
+            size INTEGER NOT NULL DEFAULT 0,
+            UNIQUE (owner, name))""")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS playlist_entries (
+            entry_id INTEGER PRIMARY KEY,
+            playlist_id INTEGER NOT NULL,
+            position REAL NOT NULL,
+            track_key TEXT NOT NULL,
+            dead INTEGER NOT NULL DEFAULT 0,
+            UNIQUE (playlist_id, position))""")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS saved_tracks (
+            track_key TEXT PRIMARY KEY,
+            title TEXT, duration INTEGER, webpage_url TEXT)""")
+    conn.execute("CREATE INDEX IF NOT EXISTS playlist_entries_track_key "
+                 "ON playlist_entries(track_key)")
+
+
+def _playlist(conn, owner, name):
+    return conn.execute("SELECT playlist_id, size FROM playlists WHERE owner = ? AND name = ?",
+                        (owner, name)).fetchone()
+
+
+def _entry(conn, playlist_id, entry_id):
+    row = conn.execute(
+        "SELECT position, track_key FROM playlist_entries WHERE entry_id = ? AND playlist_id = ?",
+        (entry_id, playlist_id)).fetchone()
+    if row is None:
+        raise IndexError("no such entry in the playlist")
+    return row
+
+
+def _save_tracks(conn, tracks):
+    conn.executemany(
+        "INSERT INTO saved_tracks (track_key, title, duration, webpage_url) "
+        "VALUES (?, ?, ?, ?) ON CONFLICT(track_key) DO UPDATE SET "
+        "title=excluded.title, duration=excluded.duration, webpage_url=excluded.webpage_url",
+        tracks)
+
+
+def _drop_orphans(conn, keys):
+    conn.executemany(
+        "DELETE FROM saved_tracks WHERE track_key = ? AND NOT EXISTS "
+        "(SELECT 1 FROM playlist_entries WHERE track_key = ?)",
+        [(key, key) for key in set(keys)])
+
+
+def _title(conn, key):
+    row = conn.execute("SELECT title FROM saved_tracks WHERE track_key = ?", (key,)).fetchone()
+    return row[0] if row else key
+
+
+def list_playlists(conn, owner):
+    """(name, size) of every playlist a user owns"""
+    return conn.execute("SELECT name, size FROM playlists WHERE owner = ? ORDER BY name",
+                        (owner,)).fetchall()
+
+
+def size(conn, owner, name):
+    row = _playlist(conn, owner, name)
+    return row[1] if row else None
+
+
+def create(conn, owner, name):
+    """Create an empty playlist; False if the user already has one by that name"""
+    with conn:
+        cursor = conn.execute("INSERT OR IGNORE INTO playlists (owner, name) VALUES (?, ?)",
+                              (owner, name))
+    return cursor.rowcount == 1
+
+
+def delete(conn, owner, name):
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        row = _playlist(conn, owner, name)
+        if row is None:
+            return None
+        keys = [key for key, in conn.execute(
+            "SELECT track_key FROM playlist_entries WHERE playlist_id = ?", (row[0],))]
+        conn.execute("DELETE FROM playlist_entries WHERE playlist_id = ?", (row[0],))
+        conn.execute("DELETE FROM playlists WHERE playlist_id = ?", (row[0],))
+        _drop_orphans(conn, keys)
+    return row[1]
+
+
+def append(conn, owner, name, tracks, create_missing=False):
+    """Add (track key, title, duration, webpage URL) tuples to the end
+
+    Returns the playlist's new size.
+    """
+    tracks = list(tracks)
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        row = _playlist(conn, owner, name)
+        if row is None:
+            if not create_missing:
+                return None
+            conn.execute("INSERT INTO playlists (owner, name) VALUES (?, ?)", (owner, name))
+            row = _playlist(conn, owner, name)
+        playlist_id = row[0]
+        last = conn.execute("SELECT MAX(position) FROM playlist_entries WHERE playlist_id = ?",
+                            (playlist_id,)).fetchone()[0] or 0.0
+        _save_tracks(conn, tracks)
+        conn.executemany(
+            "INSERT INTO playlist_entries (playlist_id, position, track_key) VALUES (?, ?, ?)",
+            [(playlist_id, last + offset, track[0])
+             for offset, track in enumerate(tracks, start=1)])
+        conn.execute("UPDATE playlists SET size = size + ? WHERE playlist_id = ?",
+                     (len(tracks), playlist_id))
+        return _playlist(conn, owner, name)[1]
+
+
+def remove(conn, owner, name, entry_id):
+    """Remove an entry; returns its title"""
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        row = _playlist(conn, owner, name)
+        if row is None:
+            return None
+        playlist_id = row[0]
+        _, key = _entry(conn, playlist_id, entry_id)
+        title = _title(conn, key)
+        conn.execute("DELETE FROM playlist_entries WHERE entry_id = ?", (entry_id,))
+        conn.execute("UPDATE playlists SET size = size - 1 WHERE playlist_id = ?",
+                     (playlist_id,))
+        _drop_orphans(conn, [key])
+    return title
+
+
+def _renumber(conn, playlist_id):
+    # Shift every entry clear of both the old positions and 1..n first, so no
+    # single-row update collides with another row's position
+    low, high, count = conn.execute(
+        "SELECT MIN(position), MAX(position), COUNT(*) FROM playlist_entries "
+        "WHERE playlist_id = ?", (playlist_id,)).fetchone()
+    conn.execute("UPDATE playlist_entries SET position = position + ? WHERE playlist_id = ?",
+                 (max(high, count) + 1 - low, playlist_id))
+    entry_ids = conn.execute(
+        "SELECT entry_id FROM playlist_entries WHERE playlist_id = ? ORDER BY position",
+        (playlist_id,)).fetchall()
+    conn.executemany(
+        "UPDATE playlist_entries SET position = ? WHERE entry_id = ?",
+        [(float(number), entry_id) for number, (entry_id,) in enumerate(entry_ids, start=1)])
+
+
+def _new_position(conn, playlist_id, moving, before):
+    """Position just in front of the entry at before, or at the end if None
+
+    None when the gap in front of before is used up.
+    """
+    if before is None:
+        last = conn.execute("SELECT MAX(position) FROM playlist_entries WHERE playlist_id = ?",
+                            (playlist_id,)).fetchone()[0]
+        return last + 1.0
+    previous = conn.execute(
+        "SELECT MAX(position) FROM playlist_entries "
+        "WHERE playlist_id = ? AND position < ? AND entry_id != ?",
+        (playlist_id, before, moving)).fetchone()[0]
+    if previous is None:
+        return before - 1.0
+    return (previous + before) / 2 if before - previous > MIN_GAP else None
+
+
+def move(conn, owner, name, entry_id, before_id=None):
+    """Move an entry in front of another one, or to the end; returns its title"""
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        row = _playlist(conn, owner, name)
+        if row is None:
+            return None
+        playlist_id = row[0]
+        _, key = _entry(conn, playlist_id, entry_id)
+        if before_id != entry_id:
+            before = _entry(conn, playlist_id, before_id)[0] if before_id is not None else None
+            new = _new_position(conn, playlist_id, entry_id, before)
+            if new is None:
+                _renumber(conn, playlist_id)
+                before = _entry(conn, playlist_id, before_id)[0]
+                new = _new_position(conn, playlist_id, entry_id, before)
+            conn.execute("UPDATE playlist_entries SET position = ? WHERE entry_id = ?",
+                         (new, entry_id))
+        return _title(conn, key)
+
+
+def page(conn, owner, name, limit, after=None, before=None):
+    """(size, entries) for one page; entries are (entry id, position, key, title,
+    duration, dead)
+
+    The page starts after the position ``after``, or ends before the position
+    ``before`` (float("inf") for the last page); with neither it is the first.
+    """
+    row = _playlist(conn, owner, name)
+    if row is None:
+        return None
+    query = ("SELECT e.entry_id, e.position, e.track_key, t.title, t.duration, e.dead "
+             "FROM playlist_entries e LEFT JOIN saved_tracks t ON t.track_key = e.track_key "
+             "WHERE e.playlist_id = ? ")
+    if before is not None:
+        entries = conn.execute(query + "AND e.position < ? ORDER BY e.position DESC LIMIT ?",
+                               (row[0], before, limit)).fetchall()
+        entries.reverse()
+    else:
+        entries = conn.execute(query + "AND e.position > ? ORDER BY e.position LIMIT ?",
+                               (row[0], float("-inf") if after is None else after,
+                                limit)).fetchall()
+    return row[1], entries
+
+
+def entries(conn, owner, name):
+    """Every entry in order, as dicts with entry, ref, title, duration, url and dead"""
+    row = _playlist(conn, owner, name)
+    if row is None:
+        return None
+    return [
+        {"entry": entry_id, "ref": key, "title": title or key, "duration": duration,
+         "url": url, "dead": bool(dead)}
+        for entry_id, key, title, duration, url, dead in conn.execute(
+            "SELECT e.entry_id, e.track_key, t.title, t.duration, t.webpage_url, e.dead "
+            "FROM playlist_entries e LEFT JOIN saved_tracks t ON t.track_key = e.track_key "
+            "WHERE e.playlist_id = ? ORDER BY e.position", (row[0],))
+    ]
+
+
+def update_entries(conn, owner, name, updates):
+    """Write back entries re-resolved on load
+
+    updates are (entry id, old key, new key, title, duration, webpage URL,
+    dead) tuples; an entry removed or changed since it was read is left alone.
+    """
+    row = _playlist(conn, owner, name)
+    if row is None:
+        return None
+    with conn:
+        _save_tracks(conn, [update[2:6] for update in updates if not update[6]])
+        conn.executemany(
+            "UPDATE playlist_entries SET track_key = ?, dead = ? "
+            "WHERE entry_id = ? AND playlist_id = ? AND track_key = ?",
+            [(new_key, int(dead), entry_id, row[0], old_key)
+             for entry_id, old_key, new_key, _, _, _, dead in updates])
+        _drop_orphans(conn, [update[1] for update in updates if update[1] != update[2]])
+    return len(updates)
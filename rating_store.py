@@ -0,0 +1,148 @@
+"""Song rating storage for the music bot.
+
+Each user's rating of a song is its own row, keyed by (track key, user) and
+tagged with the guild it was given in. Per-song aggregates (count, total,
+average and a 1-5 histogram) and per-guild ones (count, total, average) sit
+in their own tables and are adjusted by SQL in the same transaction as the
+vote, so a vote touches O(1) rows however many ratings a song has. Every
+process sharing the database writes votes into the same rows, and
+leaderboards are read straight from indexes on the aggregates.
+
+Functions take an open connection and commit their own transactions. Only
+the standard library is used, so ratings can be inspected or migrated
+without loading the bot.
+"""
+
+RATINGS = range(1, 6)
+
+
+def create_schema(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS ratings (
+            track_key TEXT NOT NULL,
+            user_id TEXT NOT NULL,
+            guild_id TEXT,
+            rating INTEGER NOT NULL,
+            PRIMARY KEY (track_key, user_id)) WITHOUT ROWID""")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS rated_songs (
+            track_key TEXT PRIMARY KEY,
+            title TEXT,
+            count INTEGER NOT NULL,
+            total INTEGER NOT NULL,
+            average REAL NOT NULL,
+            r1 INTEGER NOT NULL, r2 INTEGER NOT NULL, r3 INTEGER NOT NULL,
+            r4 INTEGER NOT NULL, r5 INTEGER NOT NULL)""")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS guild_song_ratings (
+            guild_id TEXT NOT NULL,
+            track_key TEXT NOT NULL,
+            count INTEGER NOT NULL,
+            total INTEGER NOT NULL,
+            average REAL NOT NULL,
+            PRIMARY KEY (guild_id, track_key)) WITHOUT ROWID""")
+    conn.execute("CREATE INDEX IF NOT EXISTS rated_songs_rank "
+                 "ON rated_songs(average DESC, count DESC)")
+    conn.execute("CREATE INDEX IF NOT EXISTS guild_song_ratings_rank "
+                 "ON guild_song_ratings(guild_id, average DESC, count DESC)")
+
+
+def _adjust(conn, key, title, guild_id, rating, sign):
+    """Add (sign=1) or take back (sign=-1) one rating in the aggregates"""
+    histogram = [sign if value == rating else 0 for value in RATINGS]
+    conn.execute(
+        "INSERT INTO rated_songs (track_key, title, count, total, average, r1, r2, r3, r4, r5) "
+        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT(track_key) DO UPDATE SET "
+        "title = COALESCE(excluded.title, title), "
+        "count = count + excluded.count, total = total + excluded.total, "
+        "average = CAST(total + excluded.total AS REAL) / MAX(count + excluded.count, 1), "
+        "r1 = r1 + excluded.r1, r2 = r2 + excluded.r2, r3 = r3 + excluded.r3, "
+        "r4 = r4 + excluded.r4, r5 = r5 + excluded.r5",
+        (key, title, sign, sign * rating, float(rating), *histogram))
+    if guild_id is None:
+        return
+    conn.execute(
+        "INSERT INTO guild_song_ratings (guild_id, track_key, count, total, average) "
+        "VALUES (?, ?, ?, ?, ?) ON CONFLICT(guild_id, track_key) DO UPDATE SET "
+        "count = count + excluded.count, total = total + excluded.total, "
+        "average = CAST(total + excluded.total AS REAL) / MAX(count + excluded.count, 1)",
+        (guild_id, key, sign, sign * rating, float(rating)))
+    if sign < 0:
+        conn.execute("DELETE FROM guild_song_ratings "
+                     "WHERE guild_id = ? AND track_key = ? AND count <= 0", (guild_id, key))
+
+
+def rate(conn, key, title, user_id, guild_id, rating):
+    """Set a user's rating for a song; returns the song's (count, total)"""
+    if rating not in RATINGS:
+        raise ValueError("rating must be between 1 and 5")
+    with conn:
+        # Take the write lock before reading the old rating, so two processes
+        # can't both count the same user's first vote
+        conn.execute("BEGIN IMMEDIATE")
+        previous = conn.execute(
+            "SELECT rating, guild_id FROM ratings WHERE track_key = ? AND user_id = ?",
+            (key, user_id)).fetchone()
+        if previous is not None:
+            _adjust(conn, key, None, previous[1], previous[0], -1)
+        conn.execute(
+            "INSERT INTO ratings (track_key, user_id, guild_id, rating) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT(track_key, user_id) DO UPDATE SET "
+            "guild_id = excluded.guild_id, rating = excluded.rating",
+            (key, user_id, guild_id, rating))
+        _adjust(conn, key, title, guild_id, rating, 1)
+        return conn.execute("SELECT count, total FROM rated_songs WHERE track_key = ?",
+                            (key,)).fetchone()
+
+
+def song(conn, key):
+    """(title, count, total, histogram) for a song, or None if it has no ratings"""
+    row = conn.execute(
+        "SELECT title, count, total, r1, r2, r3, r4, r5 FROM rated_songs WHERE track_key = ?",
+        (key,)).fetchone()
+    return (row[0], row[1], row[2], list(row[3:])) if row else None
+
+
+def top(conn, limit, min_count, guild_id=None):
+    """(key, title, average, count) of the best-rated songs, everywhere or in one guild"""
+    if guild_id is None:
+        return conn.execute(
+            "SELECT track_key, title, average, count FROM rated_songs WHERE count >= ? "
+            "ORDER BY average DESC, count DESC, track_key LIMIT ?",
+            (min_count, limit)).fetchall()
+    return conn.execute(
+        "SELECT g.track_key, s.title, g.average, g.count FROM guild_song_ratings g "
+        "JOIN rated_songs s ON s.track_key = g.track_key "
+        "WHERE g.guild_id = ? AND g.count >= ? "
+        "ORDER BY g.average DESC, g.count DESC, g.track_key LIMIT ?",
+        (guild_id, min_count, limit)).fetchall()
+
+
+def import_ratings(conn, key, title, ratings):
+    """Add (user, guild, rating) tuples, keeping any rating a user already has
+
+    Used for migrating old data; the song's aggregates are recomputed from
+    its rows afterwards. Returns how many ratings were added.
+    """
+    with conn:
+        cursor = conn.executemany(
+            "INSERT OR IGNORE INTO ratings (track_key, user_id, guild_id, rating) "
+            "VALUES (?, ?, ?, ?)",
+            [(key, user_id, guild_id, rating) for user_id, guild_id, rating in ratings
+             if rating in RATINGS])
+        added = cursor.rowcount
+        conn.execute(
+            "INSERT INTO rated_songs (track_key, title, count, total, average, r1, r2, r3, r4, r5) "
+            "SELECT track_key, ?, COUNT(*), SUM(rating), AVG(rating), SUM(rating = 1), "
+            "SUM(rating = 2), SUM(rating = 3), SUM(rating = 4), SUM(rating = 5) "
+            "FROM ratings WHERE track_key = ? GROUP BY track_key "
+            "ON CONFLICT(track_key) DO UPDATE SET title = COALESCE(excluded.title, title), "
+            "count = excluded.count, total = excluded.total, average = excluded.average, "
+            "r1 = excluded.r1, r2 = excluded.r2, r3 = excluded.r3, r4 = excluded.r4, "
+            "r5 = excluded.r5", (title, key))
+        conn.execute("DELETE FROM guild_song_ratings WHERE track_key = ?", (key,))
+        conn.execute(
+            "INSERT INTO guild_song_ratings (guild_id, track_key, count, total, average) "
+            "SELECT guild_id, track_key, COUNT(*), SUM(rating), AVG(rating) FROM ratings "
+            "WHERE track_key = ? AND guild_id IS NOT NULL GROUP BY guild_id", (key,))
+    return added
@@ -0,0 +1,87 @@
+import asyncio
+
+import pytest
+
+import metrics
+
+
+@pytest.fixture(autouse=True)
+def registry():
+    saved = metrics.REGISTRY[:]
+    metrics.REGISTRY.clear()
+    yield metrics.REGISTRY
+    metrics.REGISTRY[:] = saved
+
+
+def test_counter_and_gauge_rendering():
+    plays = metrics.Counter("plays_total", "Tracks played", ("backend",))
+    plays.inc("worker")
+    plays.inc("worker", amount=2)
+    plays.inc('in "process"\n')
+    sessions = metrics.Gauge("sessions", "Guild sessions")
+    sessions.set(4)
+    sessions.dec()
+    metrics.Gauge("ratio", "A ratio", callback=lambda: 0.5)
+    metrics.Gauge("depth", "Queue depth", ("executor",),
+                  callback=lambda: {("ytdl",): 2, ("data",): 0})
+
+    assert metrics.render() == (
+        "# HELP plays_total Tracks played\n"
+        "# TYPE plays_total counter\n"
+        'plays_total{backend="in \\"process\\"\\n"} 1\n'
+        'plays_total{backend="worker"} 3\n'
+        "# HELP sessions Guild sessions\n"
+        "# TYPE sessions gauge\n"
+        "sessions 3\n"
+        "# HELP ratio A ratio\n"
+        "# TYPE ratio gauge\n"
+        "ratio 0.5\n"
+        "# HELP depth Queue depth\n"
+        "# TYPE depth gauge\n"
+        'depth{executor="data"} 0\n'
+        'depth{executor="ytdl"} 2\n')
+
+
+def test_histogram_buckets_are_cumulative():
+    latency = metrics.Histogram("latency_seconds", "Latency", ("op",), buckets=(1, 0.1))
+    for value in (0.05, 0.1, 0.5, 3):
+        latency.observe(value, "play")
+    assert latency.render().splitlines() == [
+        "# HELP latency_seconds Latency",
+        "# TYPE latency_seconds histogram",
+        'latency_seconds_bucket{op="play",le="0.1"} 2',
+        'latency_seconds_bucket{op="play",le="1.0"} 3',
+        'latency_seconds_bucket{op="play",le="+Inf"} 4',
+        'latency_seconds_sum{op="play"} 3.65',
+        'latency_seconds_count{op="play"} 4',
+    ]
+
+
+def test_wrong_labels_and_failing_callbacks():
+    counter = metrics.Counter("errors_total", "Errors", ("kind",))
+    with pytest.raises(ValueError):
+        counter.inc()
+    metrics.Gauge("broken", "Broken", callback=lambda: 1 / 0)
+    assert "# broken unavailable: ZeroDivisionError" in metrics.render()
+
+
+def test_http_server():
+    metrics.Gauge("up", "Up", callback=lambda: 1)
+
+    async def fetch(path):
+        server = await metrics.start_http_server("127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        try:
+            reader, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.write(f"GET {path} HTTP/1.1\r\nHost: localhost\r\n\r\n".encode())
+            response = await reader.read()
+            writer.close()
+            return response.decode()
+        finally:
+            server.close()
+            await server.wait_closed()
+
+    response = asyncio.run(fetch("/metrics?name=up"))
+    assert response.startswith("HTTP/1.1 200 OK\r\n")
+    assert response.endswith("\r\n\r\n# HELP up Up\n# TYPE up gauge\nup 1\n")
+    assert asyncio.run(fetch("/")).startswith("HTTP/1.1 404 Not Found\r\n")
@@ -0,0 +1,140 @@
+import random
+import sqlite3
+import threading
+
+import pytest
+
+import playlist_store
+
+
+@pytest.fixture
+def conn():
+    conn = sqlite3.connect(":memory:")
+    playlist_store.create_schema(conn)
+    yield conn
+    conn.close()
+
+
+def track(number):
+    return (f"key{number}", f"Title {number}", number, f"https://example.com/{number}")
+
+
+def keys(conn, name="mix"):
+    return [entry["ref"] for entry in playlist_store.entries(conn, "owner", name)]
+
+
+def entry_ids(conn, name="mix"):
+    return [entry["entry"] for entry in playlist_store.entries(conn, "owner", name)]
+
+
+def test_append_remove_and_size(conn):
+    assert playlist_store.append(conn, "owner", "mix", [track(1)]) is None
+    assert playlist_store.append(conn, "owner", "mix", [track(1), track(2)],
+                                 create_missing=True) == 2
+    assert playlist_store.append(conn, "owner", "mix", [track(3)]) == 3
+    assert keys(conn) == ["key1", "key2", "key3"]
+
+    first, second, _ = entry_ids(conn)
+    assert playlist_store.remove(conn, "owner", "mix", second) == "Title 2"
+    assert playlist_store.size(conn, "owner", "mix") == 2
+    assert keys(conn) == ["key1", "key3"]
+    # The removed track was only in this playlist
+    assert conn.execute("SELECT COUNT(*) FROM saved_tracks").fetchone()[0] == 2
+    with pytest.raises(IndexError):
+        playlist_store.remove(conn, "owner", "mix", second)
+    assert playlist_store.remove(conn, "owner", "other", first) is None
+
+
+def test_entries_of_another_playlist_are_rejected(conn):
+    playlist_store.append(conn, "owner", "mix", [track(1)], create_missing=True)
+    playlist_store.append(conn, "owner", "other", [track(2)], create_missing=True)
+    other_entry, = entry_ids(conn, "other")
+    with pytest.raises(IndexError):
+        playlist_store.remove(conn, "owner", "mix", other_entry)
+    with pytest.raises(IndexError):
+        playlist_store.move(conn, "owner", "mix", entry_ids(conn)[0], other_entry)
+
+
+def test_moves_match_a_list_and_renumber_when_gaps_run_out(conn, monkeypatch):
+    renumbered = []
+    renumber = playlist_store._renumber
+    monkeypatch.setattr(playlist_store, "_renumber",
+                        lambda conn, playlist_id: (renumbered.append(playlist_id),
+                                                   renumber(conn, playlist_id)))
+    playlist_store.append(conn, "owner", "mix", [track(i) for i in range(20)],
+                          create_missing=True)
+    model = entry_ids(conn)
+    rng = random.Random(2)
+    for step in range(400):
+        moving = rng.choice(model)
+        # Squeeze entries into the front gap over and over to use it up
+        before = model[1] if step % 2 else rng.choice(model + [None])
+        playlist_store.move(conn, "owner", "mix", moving, before)
+        if before != moving:
+            model.remove(moving)
+            model.insert(model.index(before) if before is not None else len(model), moving)
+        assert entry_ids(conn) == model
+    assert renumbered
+    assert playlist_store.size(conn, "owner", "mix") == 20
+
+
+def test_keyset_pages_forwards_and_backwards(conn):
+    playlist_store.append(conn, "owner", "mix", [track(i) for i in range(25)],
+                          create_missing=True)
+    playlist_store.remove(conn, "owner", "mix", entry_ids(conn)[4])
+    expected = keys(conn)
+
+    pages, after = [], None
+    while True:
+        size, entries = playlist_store.page(conn, "owner", "mix", 10, after=after)
+        if not entries:
+            break
+        pages.append([entry[2] for entry in entries])
+        after = entries[-1][1]
+    assert size == 24
+    assert pages == [expected[:10], expected[10:20], expected[20:]]
+
+    _, last = playlist_store.page(conn, "owner", "mix", 10, before=float("inf"))
+    assert [entry[2] for entry in last] == expected[-10:]
+    _, previous = playlist_store.page(conn, "owner", "mix", 10, before=last[0][1])
+    assert [entry[2] for entry in previous] == expected[-20:-10]
+    assert previous[0][3] == "Title 5"
+
+
+def test_two_connections_keep_the_size_right(tmp_path):
+    path = str(tmp_path / "playlists.db")
+    conns = [sqlite3.connect(path, timeout=30, check_same_thread=False) for _ in range(2)]
+    playlist_store.create_schema(conns[0])
+    playlist_store.append(conns[0], "owner", "mix", [track(0)], create_missing=True)
+
+    def churn(conn, offset):
+        for number in range(offset, offset + 100):
+            playlist_store.append(conn, "owner", "mix", [track(number), track(number)])
+            entry = next(entry for entry in playlist_store.entries(conn, "owner", "mix")
+                         if entry["ref"] == f"key{number}")
+            playlist_store.remove(conn, "owner", "mix", entry["entry"])
+
+    threads = [threading.Thread(target=churn, args=(conn, offset))
+               for conn, offset in zip(conns, (1000, 2000))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    count = conns[0].execute("SELECT COUNT(*) FROM playlist_entries").fetchone()[0]
+    assert count == 201
+    for conn in conns:
+        assert playlist_store.size(conn, "owner", "mix") == count
+        conn.close()
+
+
+def test_update_entries_skips_changed_rows(conn):
+    playlist_store.append(conn, "owner", "mix", [track(1), track(2)], create_missing=True)
+    first, second = entry_ids(conn)
+    playlist_store.update_entries(conn, "owner", "mix", [
+        (first, "key1", "new1", "New 1", 10, "https://example.com/new1", False),
+        (second, "stale", "new2", "New 2", 10, "https://example.com/new2", False),
+    ])
+    assert keys(conn) == ["new1", "key2"]
+    assert conn.execute("SELECT COUNT(*) FROM saved_tracks WHERE track_key = 'key1'"
+                        ).fetchone()[0] == 0
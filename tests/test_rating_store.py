@@ -0,0 +1,62 @@
+import random
+import sqlite3
+
+import pytest
+
+import rating_store
+
+
+@pytest.fixture
+def conn():
+    conn = sqlite3.connect(":memory:")
+    rating_store.create_schema(conn)
+    yield conn
+    conn.close()
+
+
+def test_votes_replace_a_users_earlier_vote(conn):
+    assert tuple(rating_store.rate(conn, "song", "Song", "alice", "g1", 5)) == (1, 5)
+    assert tuple(rating_store.rate(conn, "song", "Song", "bob", "g1", 3)) == (2, 8)
+    assert tuple(rating_store.rate(conn, "song", None, "alice", "g2", 1)) == (2, 4)
+    assert rating_store.song(conn, "song") == ("Song", 2, 4, [1, 0, 1, 0, 0])
+    assert rating_store.song(conn, "missing") is None
+    # Alice's vote moved to g2, leaving g1 with only Bob's
+    assert rating_store.top(conn, 10, 1, "g1") == [("song", "Song", 3.0, 1)]
+    assert rating_store.top(conn, 10, 1, "g2") == [("song", "Song", 1.0, 1)]
+    with pytest.raises(ValueError):
+        rating_store.rate(conn, "song", "Song", "carol", "g1", 6)
+
+
+def test_aggregates_match_a_recount(conn):
+    rng = random.Random(3)
+    votes = {}
+    for _ in range(2000):
+        key, user = f"song{rng.randrange(30)}", f"user{rng.randrange(40)}"
+        guild, rating = f"g{rng.randrange(3)}", rng.randint(1, 5)
+        rating_store.rate(conn, key, key.title(), user, guild, rating)
+        votes[key, user] = (guild, rating)
+
+    def expected(guild=None):
+        totals = {}
+        for (key, _), (vote_guild, rating) in votes.items():
+            if guild is None or vote_guild == guild:
+                count, total = totals.get(key, (0, 0))
+                totals[key] = (count + 1, total + rating)
+        rows = [(key, key.title(), total / count, count)
+                for key, (count, total) in totals.items() if count >= 3]
+        rows.sort(key=lambda row: (-row[2], -row[3], row[0]))
+        return rows[:10]
+
+    assert rating_store.top(conn, 10, 3) == pytest.approx(expected())
+    for guild in ("g0", "g1", "g2"):
+        assert rating_store.top(conn, 10, 3, guild) == pytest.approx(expected(guild))
+
+
+def test_import_keeps_existing_votes_and_recounts(conn):
+    rating_store.rate(conn, "song", None, "alice", "g1", 2)
+    added = rating_store.import_ratings(conn, "song", "Song", [
+        ("alice", "g1", 5), ("bob", "g1", 4), ("carol", None, 3), ("dave", "g2", 9)])
+    assert added == 2
+    assert rating_store.song(conn, "song") == ("Song", 3, 9, [0, 1, 1, 1, 0])
+    assert rating_store.top(conn, 10, 1, "g1") == [("song", "Song", 3.0, 2)]
+    assert rating_store.top(conn, 10, 1, "g2") == []
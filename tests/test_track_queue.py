@@ -0,0 +1,101 @@
+import random
+import sys
+
+import pytest
+
+from track_queue import TrackQueue, _Node
+
+
+class FakeTrack:
+    def __init__(self, name, duration=0, size=100):
+        self.name = name
+        self.duration = duration
+        self.size = size
+
+    def memory_size(self):
+        return self.size
+
+
+def expected_bytes(queue, tracks):
+    return sys.getsizeof(queue) + sum(sys.getsizeof(_Node(track)) + track.size
+                                      for track in tracks)
+
+
+def test_positional_operations_match_a_list():
+    rng = random.Random(1)
+    tracks = [FakeTrack(i, rng.choice([0, None, rng.randint(1, 600)]), rng.randint(1, 500))
+              for i in range(200)]
+    queue = TrackQueue(tracks[:50])
+    model = tracks[:50]
+    spare = iter(tracks[50:])
+    for _ in range(1000):
+        op = rng.randrange(6)
+        if op == 0 and len(model) < 150:
+            track = next(spare, None) or FakeTrack("extra", 10)
+            index = rng.randint(-len(model) - 2, len(model) + 2)
+            queue.insert(index, track)
+            model.insert(index, track)
+        elif op == 1 and model:
+            index = rng.randrange(-len(model), len(model))
+            assert queue.pop(index) is model.pop(index)
+        elif op == 2 and model:
+            source, destination = rng.randrange(len(model)), rng.randrange(len(model))
+            queue.move(source, destination)
+            model.insert(destination, model.pop(source))
+        elif op == 3 and model:
+            count = rng.randint(0, 3)
+            queue.drop_front(count)
+            del model[:count]
+        elif op == 4:
+            track = FakeTrack("front", 5)
+            queue.appendleft(track)
+            model.insert(0, track)
+        else:
+            queue.extend([FakeTrack("tail", 7), FakeTrack("tail", None)])
+            model.extend(queue[-2:])
+
+        assert len(queue) == len(model)
+        assert queue.total_duration == sum(track.duration or 0 for track in model)
+        assert queue.memory_size() == expected_bytes(queue, model)
+    assert list(queue) == model
+    assert queue[3:17] == model[3:17]
+    assert queue[::3] == model[::3]
+
+
+def test_indexing_and_slices():
+    tracks = [FakeTrack(i, 60) for i in range(10)]
+    queue = TrackQueue(tracks)
+    assert queue[0] is tracks[0]
+    assert queue[-1] is tracks[-1]
+    assert queue.slice(8, 20) == tracks[8:]
+    assert queue.slice(5, 5) == []
+    with pytest.raises(IndexError):
+        queue[10]
+    with pytest.raises(IndexError):
+        TrackQueue().popleft()
+
+
+def test_version_changes_on_every_mutation():
+    queue = TrackQueue()
+    versions = {queue.version}
+    queue.append(FakeTrack("a", 1))
+    versions.add(queue.version)
+    queue.appendleft(FakeTrack("b", 1))
+    versions.add(queue.version)
+    queue.move(0, 1)
+    versions.add(queue.version)
+    queue.clear()
+    versions.add(queue.version)
+    assert len(versions) == 5
+    assert not queue
+    assert queue.total_duration == 0
+    assert queue.memory_size() == sys.getsizeof(queue)
+
+
+def test_items_without_memory_size():
+    class Plain:
+        duration = 30
+
+    queue = TrackQueue([Plain(), Plain()])
+    assert queue.total_duration == 60
+    assert queue.memory_size() == sys.getsizeof(queue) + 2 * sys.getsizeof(_Node(Plain()))
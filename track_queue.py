@@ -0,0 +1,251 @@
+"""Indexed track queue for the music bot.
+
+An implicit treap: a randomly balanced binary tree ordered by position, where
+each node records the size and total duration of its subtree. Positional
+access, insertion, removal, moves and splitting off the front are O(log n),
+slices are O(log n + k), and the count and total remaining duration are always
+available in O(1). Items only need a ``duration`` attribute (seconds, or a
+falsy value when unknown); items with a ``memory_size()`` method also count
+towards the queue's approximate memory, which is kept per subtree the same
+way, so it too is O(1) to read.
+
+``version`` goes up on every change, so callers can cache anything derived
+from the queue (rendered pages, snapshots) and tell when it is stale.
+"""
+import random
+import sys
+
+
+class _Node:
+    __slots__ = ("track", "priority", "left", "right", "size", "total", "weight", "bytes")
+
+    def __init__(self, track):
+        self.track = track
+        self.priority = random.random()
+        self.left = None
+        self.right = None
+        self.size = 1
+        self.total = track.duration or 0
+        memory_size = getattr(track, "memory_size", None)
+        self.weight = sys.getsizeof(self) + (memory_size() if memory_size else 0)
+        self.bytes = self.weight
+
+
+def _update(node):
+    size = 1
+    total = node.track.duration or 0
+    nbytes = node.weight
+    if node.left is not None:
+        size += node.left.size
+        total += node.left.total
+        nbytes += node.left.bytes
+    if node.right is not None:
+        size += node.right.size
+        total += node.right.total
+        nbytes += node.right.bytes
+    node.size = size
+    node.total = total
+    node.bytes = nbytes
+
+
+def _merge(left, right):
+    if left is None:
+        return right
+    if right is None:
+        return left
+    if left.priority > right.priority:
+        left.right = _merge(left.right, right)
+        _update(left)
+        return left
+    right.left = _merge(left, right.left)
+    _update(right)
+    return right
+
+
+def _split(node, count):
+    """Split a tree into its first count items and the rest"""
+    if node is None:
+        return None, None
+    left_size = node.left.size if node.left is not None else 0
+    if count <= left_size:
+        first, node.left = _split(node.left, count)
+        _update(node)
+        return first, node
+    node.right, rest = _split(node.right, count - left_size - 1)
+    _update(node)
+    return node, rest
+
+
+def _build(tracks):
+    """Build a treap from tracks in order in O(n)"""
+    stack = []
+    for track in tracks:
+        node = _Node(track)
+        last = None
+        while stack and stack[-1].priority < node.priority:
+            last = stack.pop()
+        node.left = last
+        if stack:
+            stack[-1].right = node
+        stack.append(node)
+    if not stack:
+        return None
+    root = stack[0]
+
+    # Sizes and totals bottom-up, without recursion
+    order = []
+    pending = [root]
+    while pending:
+        node = pending.pop()
+        order.append(node)
+        if node.left is not None:
+            pending.append(node.left)
+        if node.right is not None:
+            pending.append(node.right)
+    for node in reversed(order):
+        _update(node)
+    return root
+
+
+class TrackQueue:
+    """Queue of tracks with O(log n) positional operations"""
+
+    __slots__ = ("_root", "version")
+
+    def __init__(self, tracks=()):
+        self._root = _build(tracks)
+        self.version = 0
+
+    def __len__(self):
+        return self._root.size if self._root is not None else 0
+
+    def __bool__(self):
+        return self._root is not None
+
+    def __iter__(self):
+        return self._iter_from(0)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                return self.slice(0, len(self))[index]
+            return self.slice(start, stop)
+        return self._node_at(self._index(index)).track
+
+    @property
+    def total_duration(self):
+        """Sum of known durations of every queued track, in seconds"""
+        return self._root.total if self._root is not None else 0
+
+    def memory_size(self):
+        """Approximate bytes held by the queue and its tracks"""
+        return sys.getsizeof(self) + (self._root.bytes if self._root is not None else 0)
+
+    def _index(self, index, size=None):
+        size = len(self) if size is None else size
+        if index < 0:
+            index += size
+        if not 0 <= index < size:
+            raise IndexError("queue index out of range")
+        return index
+
+    def _node_at(self, index):
+        node = self._root
+        while True:
+            left_size = node.left.size if node.left is not None else 0
+            if index < left_size:
+                node = node.left
+            elif index == left_size:
+                return node
+            else:
+                index -= left_size + 1
+                node = node.right
+
+    def _iter_from(self, index):
+        # Ancestors still to be visited, then a normal in-order walk
+        stack = []
+        node = self._root
+        while node is not None:
+            left_size = node.left.size if node.left is not None else 0
+            if index <= left_size:
+                stack.append(node)
+                if index == left_size:
+                    break
+                node = node.left
+            else:
+                index -= left_size + 1
+                node = node.right
+        while stack:
+            node = stack.pop()
+            yield node.track
+            child = node.right
+            while child is not None:
+                stack.append(child)
+                child = child.left
+
+    def slice(self, start, stop):
+        """Tracks from start up to stop, as a list"""
+        start = max(start, 0)
+        stop = min(stop, len(self))
+        if start >= stop:
+            return []
+        tracks = []
+        for track in self._iter_from(start):
+            tracks.append(track)
+            if len(tracks) == stop - start:
+                break
+        return tracks
+
+    def append(self, track):
+        self._root = _merge(self._root, _Node(track))
+        self.version += 1
+
+    def appendleft(self, track):
+        self._root = _merge(_Node(track), self._root)
+        self.version += 1
+
+    def extend(self, tracks):
+        self._root = _merge(self._root, _build(tracks))
+        self.version += 1
+
+    def insert(self, index, track):
+        """Insert before position index, like list.insert"""
+        size = len(self)
+        if index < 0:
+            index = max(size + index, 0)
+        first, rest = _split(self._root, min(index, size))
+        self._root = _merge(_merge(first, _Node(track)), rest)
+        self.version += 1
+
+    def pop(self, index=-1):
+        """Remove and return the track at index"""
+        index = self._index(index)
+        first, rest = _split(self._root, index)
+        node, rest = _split(rest, 1)
+        self._root = _merge(first, rest)
+        self.version += 1
+        return node.track
+
+    def popleft(self):
+        if self._root is None:
+            raise IndexError("pop from an empty queue")
+        return self.pop(0)
+
+    def move(self, source, destination):
+        """Move the track at source so it ends up at destination"""
+        size = len(self)
+        source = self._index(source, size)
+        destination = self._index(destination, size)
+        track = self.pop(source)
+        self.insert(destination, track)
+        return track
+
+    def drop_front(self, count):
+        """Discard the first count tracks"""
+        _, self._root = _split(self._root, count)
+        self.version += 1
+
+    def clear(self):
+        self._root = None
+        self.version += 1